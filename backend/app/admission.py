@@ -0,0 +1,261 @@
+import asyncio
+import math
+import time
+from collections import deque
+from typing import Deque, Dict, Optional
+
+from fastapi import HTTPException, Request
+
+from .clients import get_clients
+from .config import Settings, get_settings
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request cannot be admitted; maps to 429 (this client or token budget) or 503 (server full)."""
+
+    def __init__(self, status_code: int, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+
+class TokenBucket:
+    """Tokens-per-minute budget refilled continuously; a request reserves its estimate up front."""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.available = float(per_minute)
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def take(self, amount: int) -> float:
+        """Reserve `amount` tokens; returns 0 on success, else the seconds until they would be available."""
+        self._refill()
+        # A single request larger than the whole budget is admitted once the bucket is full
+        amount = min(float(amount), self.capacity)
+        if amount <= self.available:
+            self.available -= amount
+            return 0.0
+        return (amount - self.available) / self.rate
+
+    def refund(self, amount: int):
+        self._refill()
+        self.available = min(self.capacity, self.available + amount)
+
+
+class Ticket:
+    """An admitted request's slot; `release` is idempotent so every exit path may call it."""
+
+    def __init__(self, controller: "AdmissionController", client: str, tokens: int):
+        self._controller = controller
+        self.client = client
+        self.tokens = tokens
+        self.released = False
+
+    def release(self, *, refund: bool = False):
+        if self.released:
+            return
+        self.released = True
+        self._controller._release(self, refund=refund)
+
+
+class AdmissionController:
+    """Bounds concurrent upstream LLM streams globally and per client.
+
+    Requests beyond `max_concurrent` wait in a FIFO queue of at most
+    `queue_size` for up to `queue_timeout` seconds; a full queue or an expired
+    wait is rejected with 503. A client already holding `per_client` slots is
+    rejected with 429, as is a request whose estimated tokens exceed what is
+    left of the per-minute budget. Limits of 0 disable that check.
+    """
+
+    def __init__(self, *, max_concurrent: int, per_client: int, queue_size: int, queue_timeout: float, tokens_per_minute: int = 0):
+        self.max_concurrent = max_concurrent
+        self.per_client = per_client
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.bucket = TokenBucket(tokens_per_minute) if tokens_per_minute > 0 else None
+        self.active = 0
+        self._by_client: Dict[str, int] = {}
+        self._waiters: Deque["asyncio.Future[None]"] = deque()
+        self.admitted = 0
+        self.rejected: Dict[str, int] = {}
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    @property
+    def queued(self) -> int:
+        return sum(1 for w in self._waiters if not w.done())
+
+    def _reject(self, status_code: int, reason: str, retry_after: float) -> AdmissionRejected:
+        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        return AdmissionRejected(status_code, reason, retry_after)
+
+    def _full(self) -> bool:
+        return bool(self.max_concurrent) and (self.active >= self.max_concurrent or self.queued > 0)
+
+    async def acquire(self, client: str, tokens: int = 0) -> Ticket:
+        if self.per_client and self._by_client.get(client, 0) >= self.per_client:
+            raise self._reject(429, "client_concurrency", 1)
+        if self.bucket is not None and tokens:
+            wait = self.bucket.take(tokens)
+            if wait > 0:
+                raise self._reject(429, "token_budget", wait)
+
+        ticket = Ticket(self, client, tokens)
+        if self._full() and len(self._waiters) >= self.queue_size:
+            self._refund(tokens)
+            raise self._reject(503, "queue_full", self.queue_timeout)
+        # Counted while queued too, so a client cannot park any number of requests behind the check above
+        self._by_client[client] = self._by_client.get(client, 0) + 1
+        if self._full():
+            try:
+                await self._wait(ticket)
+            except BaseException:
+                self._uncount(client)
+                raise
+        else:
+            self.active += 1
+        self.admitted += 1
+        return ticket
+
+    async def _wait(self, ticket: Ticket):
+        waiter: "asyncio.Future[None]" = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(waiter, timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._discard(waiter)
+            self._refund(ticket.tokens)
+            raise self._reject(503, "queue_timeout", self.queue_timeout)
+        except BaseException:
+            # The request went away while queued; pass on a slot it was handed meanwhile
+            self._discard(waiter)
+            if waiter.done() and not waiter.cancelled():
+                self._handoff()
+            self._refund(ticket.tokens)
+            raise
+        finally:
+            waited = time.monotonic() - started
+            self.wait_seconds_total += waited
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+
+    def _discard(self, waiter: "asyncio.Future[None]"):
+        try:
+            self._waiters.remove(waiter)
+        except ValueError:
+            pass
+
+    def _refund(self, tokens: int):
+        if self.bucket is not None and tokens:
+            self.bucket.refund(tokens)
+
+    def _handoff(self):
+        """Give a freed slot to the oldest live waiter, or return it to the pool."""
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def _uncount(self, client: str):
+        remaining = self._by_client.get(client, 0) - 1
+        if remaining > 0:
+            self._by_client[client] = remaining
+        else:
+            self._by_client.pop(client, None)
+
+    def _release(self, ticket: Ticket, *, refund: bool):
+        self._uncount(ticket.client)
+        if refund:
+            self._refund(ticket.tokens)
+        self._handoff()
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "queued": self.queued,
+            "max_concurrent": self.max_concurrent,
+            "per_client": self.per_client,
+            "queue_size": self.queue_size,
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+            "wait_seconds_total": round(self.wait_seconds_total, 3),
+            "wait_seconds_max": round(self.wait_seconds_max, 3),
+            "tokens_available": int(self.bucket.available) if self.bucket is not None else None,
+        }
+
+
+_CONTROLLER: Optional[AdmissionController] = None
+
+
+def init_admission(settings: Settings) -> AdmissionController:
+    global _CONTROLLER
+    _CONTROLLER = AdmissionController(
+        max_concurrent=settings.admission_max_concurrent,
+        per_client=settings.admission_per_client,
+        queue_size=settings.admission_queue_size,
+        queue_timeout=settings.admission_queue_timeout,
+        tokens_per_minute=settings.openai_tpm_limit,
+    )
+    return _CONTROLLER
+
+
+def get_admission() -> AdmissionController:
+    if _CONTROLLER is None:
+        return init_admission(get_settings())
+    return _CONTROLLER
+
+
+def client_key(request: Request) -> str:
+    """Who a request counts against: the X-Client-Id header, else the peer address."""
+    header = request.headers.get("x-client-id")
+    if header:
+        return header.strip()[:128]
+    return request.client.host if request.client else "anonymous"
+
+
+async def admit(request: Request, tokens: int = 0) -> Ticket:
+    controller = get_admission()
+    try:
+        breaker = get_clients().breaker
+        if breaker.state == "open":
+            # Upstream is failing; answer now instead of queueing for a certain error
+            raise controller._reject(503, "upstream_unavailable", breaker.retry_after())
+        return await controller.acquire(client_key(request), tokens)
+    except AdmissionRejected as exc:
+        raise HTTPException(
+            status_code=exc.status_code,
+            detail=exc.reason,
+            headers={"Retry-After": str(exc.retry_after)},
+        )
+
+
+async def admit_patiently(client: str, tokens: int = 0, *, deadline: float) -> Ticket:
+    """Acquire a slot for background work, waiting out rejections (and an open breaker) for up to `deadline` seconds.
+
+    Batch items would rather wait their turn than fail; the last rejection is
+    raised once the deadline has passed.
+    """
+    controller = get_admission()
+    loop = asyncio.get_running_loop()
+    give_up = loop.time() + deadline
+    while True:
+        try:
+            breaker = get_clients().breaker
+            if breaker.state == "open":
+                raise controller._reject(503, "upstream_unavailable", breaker.retry_after())
+            return await controller.acquire(client, tokens)
+        except AdmissionRejected as exc:
+            remaining = give_up - loop.time()
+            if remaining <= 0:
+                raise
+            await asyncio.sleep(min(float(exc.retry_after), remaining))
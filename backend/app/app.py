@@ -1,14 +1,25 @@
 import os
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 
-from .config import load_settings
+from .config import reload_settings
+from .admission import init_admission
+from .metrics import MetricsMiddleware
+from .clients import init_clients, get_clients, close_clients
+from .services.store import init_store, close_store
+from .services.cache import init_response_cache
+from .services.streams import init_streams
+from .utils import drain_background
 from .routes.generate import router as generate_router
 from .routes.health import router as health_router
 from .routes.stream_test import router as stream_test_router
 from .routes.session import router as session_router
 from .routes.chat import router as chat_router
+from .routes.admin import router as admin_router
+from .routes.streams import router as streams_router
+from .routes.metrics import router as metrics_router
 
 
 def create_app() -> FastAPI:
@@ -16,9 +27,30 @@ def create_app() -> FastAPI:
     if os.getenv("DOTENV_DISABLED", "false").lower() not in {"1", "true", "yes"}:
         load_dotenv()
 
-    settings = load_settings()
+    # Build the process-wide settings once; request paths read the cached copy
+    settings = reload_settings()
+    if settings.workers > 1 and settings.session_store == "memory":
+        # Each worker would hold its own sessions, so requests routed to another worker 404
+        raise RuntimeError("SESSION_STORE=memory cannot be shared between workers; use SESSION_STORE=sqlite when WEB_CONCURRENCY > 1")
 
-    app = FastAPI(title="AI Contract Generator API", version="0.2.0")
+    # Upstream clients are shared across requests; connections open lazily on first use
+    init_clients(settings)
+    init_store(settings)
+    init_response_cache(settings)
+    init_admission(settings)
+    init_streams(settings)
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        app.state.clients = get_clients()
+        try:
+            yield
+        finally:
+            await drain_background()
+            await close_clients()
+            close_store()
+
+    app = FastAPI(title="AI Contract Generator API", version="0.2.0", lifespan=lifespan)
 
     # CORS
     cors_origins = settings.cors_allow_origins
@@ -30,12 +62,18 @@ def create_app() -> FastAPI:
         allow_headers=["*"],
     )
 
+    # Outermost, so request timings cover CORS handling and the full streamed body
+    app.add_middleware(MetricsMiddleware)
+
     # Routers
     app.include_router(health_router, prefix="/api")
     app.include_router(generate_router, prefix="/api")
     app.include_router(stream_test_router, prefix="/api")
     app.include_router(session_router, prefix="/api")
     app.include_router(chat_router, prefix="/api")
+    app.include_router(admin_router, prefix="/api")
+    app.include_router(streams_router, prefix="/api")
+    app.include_router(metrics_router, prefix="/api")
 
     return app
 
@@ -0,0 +1,183 @@
+import asyncio
+from typing import Dict, Optional, Tuple
+
+import httpx
+
+try:
+    import h2  # type: ignore  # noqa: F401
+
+    HTTP2_AVAILABLE = True
+except Exception:  # pragma: no cover
+    HTTP2_AVAILABLE = False
+
+from .config import Settings, get_settings
+from .utils import CircuitBreaker, retry_async, spawn_background
+
+# The SDK classes are imported on first use: together they cost over a second
+# of import time, which would otherwise land on every cold start
+AsyncOpenAI = None  # type: ignore
+ChatOpenAI = None  # type: ignore
+
+
+def _openai_class():
+    global AsyncOpenAI
+    if AsyncOpenAI is None:
+        from openai import AsyncOpenAI as cls
+
+        AsyncOpenAI = cls
+    return AsyncOpenAI
+
+
+def _chat_openai_class():
+    global ChatOpenAI
+    if ChatOpenAI is None:
+        try:
+            from langchain_openai import ChatOpenAI as cls  # type: ignore
+        except Exception:  # pragma: no cover
+            return None
+        ChatOpenAI = cls
+    return ChatOpenAI
+
+
+class ClientManager:
+    """Long-lived upstream clients shared by every request.
+
+    One httpx connection pool backs both the raw OpenAI client and the
+    LangChain chat models, so keep-alive connections (and their TLS sessions)
+    are reused across requests instead of being rebuilt per call.
+    """
+
+    def __init__(self, settings: Settings):
+        self.settings = settings
+        self._http: Optional[httpx.AsyncClient] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._openai: Dict[Tuple[Optional[str], Optional[str]], "AsyncOpenAI"] = {}
+        self._chat_models: Dict[tuple, "ChatOpenAI"] = {}
+        self.breaker = CircuitBreaker(
+            "openai",
+            threshold=settings.openai_breaker_threshold,
+            reset_timeout=settings.openai_breaker_reset_seconds,
+        )
+
+    @property
+    def http(self) -> httpx.AsyncClient:
+        loop = _running_loop()
+        if self._http is None or self._http.is_closed or (loop is not None and loop is not self._loop):
+            # Pooled connections are bound to the loop that opened them
+            if self._http is not None and not self._http.is_closed:
+                _retire(self._http, self._loop)
+            self._http = httpx.AsyncClient(
+                http2=self.settings.http2 and HTTP2_AVAILABLE,
+                limits=httpx.Limits(
+                    max_connections=self.settings.http_max_connections,
+                    max_keepalive_connections=self.settings.http_max_keepalive,
+                    keepalive_expiry=self.settings.http_keepalive_expiry,
+                ),
+                timeout=httpx.Timeout(600.0, connect=10.0),
+            )
+            self._loop = loop
+            self._openai.clear()
+            self._chat_models.clear()
+        return self._http
+
+    def openai(self) -> "AsyncOpenAI":
+        settings = get_settings()
+        http = self.http
+        key = (settings.openai_api_key, settings.openai_base_url)
+        client = self._openai.get(key)
+        if client is None:
+            client = _openai_class()(
+                api_key=settings.openai_api_key,
+                base_url=settings.openai_base_url,
+                http_client=http,
+                # Retries happen once, in `retry`, not again inside the SDK
+                max_retries=0,
+            )
+            self._openai[key] = client
+        return client
+
+    def chat_model(self, *, model: str, temperature: float = 0.2):
+        chat_openai = _chat_openai_class()
+        if chat_openai is None:
+            raise RuntimeError("LangChain not available on server")
+        settings = get_settings()
+        http = self.http
+        key = (settings.openai_api_key, settings.openai_base_url, model, temperature)
+        llm = self._chat_models.get(key)
+        if llm is None:
+            llm = chat_openai(
+                model=model,
+                temperature=temperature,
+                streaming=True,
+                api_key=settings.openai_api_key,
+                base_url=settings.openai_base_url,
+                http_async_client=http,
+                # Usage (including cached prompt tokens) arrives on the last chunk
+                stream_usage=settings.openai_stream_usage,
+            )
+            self._chat_models[key] = llm
+        return llm
+
+    async def retry(self, fn, *, deadline: Optional[float] = None):
+        """Run an upstream call under the configured retry policy and the shared circuit breaker."""
+        settings = get_settings()
+        return await retry_async(
+            fn,
+            attempts=settings.openai_retry_attempts,
+            deadline=settings.openai_retry_deadline if deadline is None else deadline,
+            breaker=self.breaker,
+        )
+
+    async def aclose(self):
+        self._openai.clear()
+        self._chat_models.clear()
+        if self._http is not None and not self._http.is_closed:
+            await self._http.aclose()
+        self._http = None
+
+
+def _retire(http: httpx.AsyncClient, loop: Optional[asyncio.AbstractEventLoop]):
+    """Close a replaced client's pool, on its own loop while that loop still runs."""
+    if loop is not None and loop.is_running():
+        asyncio.run_coroutine_threadsafe(_close_quietly(http), loop)
+    else:
+        spawn_background(_close_quietly(http), name="http:retire")
+
+
+async def _close_quietly(http: httpx.AsyncClient):
+    try:
+        await http.aclose()
+    except Exception:
+        # Connections of a loop that is gone cannot be shut down cleanly; the pool is released either way
+        pass
+
+
+def _running_loop() -> Optional[asyncio.AbstractEventLoop]:
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+_MANAGER: Optional[ClientManager] = None
+
+
+def get_clients() -> ClientManager:
+    global _MANAGER
+    if _MANAGER is None:
+        _MANAGER = ClientManager(get_settings())
+    return _MANAGER
+
+
+def init_clients(settings: Settings) -> ClientManager:
+    """Install a fresh manager; connections are opened lazily on first use."""
+    global _MANAGER
+    _MANAGER = ClientManager(settings)
+    return _MANAGER
+
+
+async def close_clients():
+    global _MANAGER
+    manager, _MANAGER = _MANAGER, None
+    if manager is not None:
+        await manager.aclose()
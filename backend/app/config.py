@@ -1,10 +1,125 @@
+import asyncio
 import os
-from dataclasses import dataclass
-from typing import List, Optional
+import time
+import tempfile
+import string
+import hashlib
+import threading
+from dataclasses import dataclass, field, replace
+from typing import Dict, List, Optional, Tuple
 import pathlib
 import yaml
 
 
+# Look for prompts.yml in backend root (parent of app/)
+PROMPTS_PATH = pathlib.Path(__file__).resolve().parents[1] / "prompts.yml"
+
+# Default system prompt preserved for fallback
+DEFAULT_SYSTEM_PROMPT = "You are a senior technology and privacy attorney. Return ONLY Markdown."
+
+DEFAULT_EDITING_CONTEXT = (
+    "You are continuing an editing session. The current base Markdown document is provided below.\n"
+    "Apply user instructions as surgical edits to this base, preserving headings, numbering, anchors, and tables.\n"
+    "Return ONLY updated Markdown (no backticks, no code fences).\n"
+)
+
+DEFAULT_PATCH_EDITING = (
+    "You are continuing an editing session. The current base Markdown document is provided below.\n"
+    "Do NOT return the whole document. Return only the edits, as one or more blocks of the form:\n"
+    "<<<PATCH op=\"replace\" target=\"3.2\">>>\n"
+    "...the complete new Markdown for that section, including its heading...\n"
+    "<<<END>>>\n"
+    "op is one of replace, insert_after, insert_before, delete, append. target is the section number "
+    "(e.g. 3.2) or the exact heading text; a section spans its heading and everything up to the next "
+    "heading of the same or higher level, subsections included. append needs no target. "
+    "delete needs no content. Preserve numbering, anchors and defined terms. No code fences.\n"
+)
+
+DEFAULT_SUMMARY_INSTRUCTION = (
+    "Summarize the earlier part of this contract-editing conversation for your own future reference. "
+    "Keep every instruction the user gave that still applies, decisions made, defined terms, party names, "
+    "jurisdictions and section numbers that were changed. Be concise; plain text, no Markdown headings."
+)
+
+DEFAULT_OUTLINE_INSTRUCTION = """{context}
+
+You are planning this document; do not write the sections yet. Return exactly these parts, in order:
+1. The document header (title and version line) and a table of contents in Markdown listing every top-level numbered section.
+2. Every top-level section, one per line as `N. Title | what the section must cover`, inside:
+<<<OUTLINE>>>
+1. Definitions | ...
+<<<END>>>
+3. The defined terms every section must use, one per line as `"Term" means ...`, inside:
+<<<TERMS>>>
+...
+<<<END>>>
+4. The document footer (copyright notice and contact information), inside:
+<<<FOOTER>>>
+...
+<<<END>>>
+"""
+
+DEFAULT_SECTION_INSTRUCTION = """{context}
+
+You are writing one section of a longer document whose other sections are being drafted in parallel.
+Full outline:
+{outline}
+
+Defined terms (use them exactly as written; do not redefine them):
+{terms}
+
+Write ONLY section {number}. {title} ({scope}).
+Start with the heading `## {number}. {title}` and number subsections {number}.1, {number}.2, and so on. Refer to other sections by their number in the outline. Do not repeat the header, table of contents, footer or any other section. Return ONLY Markdown, no code fences.
+"""
+
+# Model tier per call stage: small, large, or auto (small when the estimated input plus output is small enough)
+DEFAULT_MODEL_ROUTES = "title=small,summary=small,chat_patch=auto,chat_full=auto,outline=large,section=large,generate=large"
+MODEL_ROUTE_RULES = ("small", "large", "auto")
+
+DEFAULT_TITLE_INSTRUCTION = (
+    "You are naming a legal document editing session. Generate a concise, professional 3-7 word title based on the user's request and, if provided, the current Markdown document. Prefer specific nouns (e.g., company name, jurisdiction) and keep it neutral. Return ONLY the title text without quotes."
+)
+
+
+class PromptTemplate:
+    """A `str.format`-style template parsed once at load time.
+
+    Rendering joins the pre-split literal segments with the supplied values,
+    so hot paths never re-parse the template text.
+    """
+
+    __slots__ = ("text", "fields", "_segments")
+
+    def __init__(self, text: str):
+        self.text = text
+        segments: List[Tuple[str, Optional[str]]] = []
+        for literal, field, _spec, _conv in string.Formatter().parse(text):
+            segments.append((literal, field))
+        self._segments = segments
+        self.fields = frozenset(f for _, f in segments if f)
+
+    def render(self, **values: str) -> str:
+        out = []
+        for literal, field in self._segments:
+            out.append(literal)
+            if field is not None:
+                out.append(str(values[field]))
+        return "".join(out)
+
+
+@dataclass(frozen=True)
+class PromptTemplates:
+    contract_generation: str
+    editing_context: str
+    patch_editing: str
+    summary_instruction: str
+    title_instruction: str
+    generation_requirements: Optional[PromptTemplate]
+    outline_instruction: PromptTemplate
+    section_instruction: PromptTemplate
+    digest: str
+
+
 @dataclass(frozen=True)
 class Settings:
     openai_api_key: Optional[str]
@@ -12,9 +127,75 @@ class Settings:
     openai_max_tokens: int
     cors_allow_origins: List[str]
     prompts: dict
+    templates: PromptTemplates
+    admin_token: Optional[str] = None
+    openai_base_url: Optional[str] = None
+    http_max_connections: int = 100
+    http_max_keepalive: int = 20
+    http_keepalive_expiry: float = 60.0
+    http2: bool = True
+    session_store: str = "memory"
+    session_db_url: str = "sqlite:///./sessions.db"
+    session_max_sessions: int = 10000
+    session_ttl_seconds: float = 0.0
+    session_memory_budget_mb: int = 512
+    history_token_budget: int = 8000
+    history_summary_max_tokens: int = 512
+    generate_cache_enabled: bool = True
+    generate_cache_memory_mb: int = 64
+    generate_cache_dir: Optional[str] = None
+    generate_cache_ttl_seconds: float = 7 * 24 * 3600
+    generate_cache_disk_mb: int = 512
+    generate_parallelism: int = 4
+    generate_section_max_tokens: int = 3000
+    admission_max_concurrent: int = 32
+    admission_per_client: int = 4
+    admission_queue_size: int = 64
+    admission_queue_timeout: float = 10.0
+    openai_tpm_limit: int = 0
+    openai_retry_attempts: int = 3
+    openai_retry_deadline: float = 30.0
+    openai_breaker_threshold: int = 5
+    openai_breaker_reset_seconds: float = 30.0
+    title_hedge_delay: float = 1.5
+    title_model: Optional[str] = None
+    title_timeout: float = 8.0
+    stream_batch_bytes: int = 1024
+    stream_batch_ms: float = 25.0
+    stream_resume_ttl: float = 300.0
+    stream_detach_grace: float = 60.0
+    stream_buffer_memory_kb: int = 256
+    stream_max_resumable: int = 1000
+    lambda_snapshot: bool = False
+    lambda_response_streaming: bool = True
+    workers: int = 1
+    openai_stream_usage: bool = True
+    prompt_snapshot_max_drift: float = 0.3
+    batch_concurrency: int = 4
+    batch_max_items: int = 100
+    batch_jobs_dir: Optional[str] = None
+    batch_admission_wait: float = 300.0
+    batch_job_retention_seconds: float = 7 * 24 * 3600
+    batch_progress_chars: int = 1024
+    document_compression: str = "zstd"
+    document_max_versions: int = 50
+    document_cache_mb: int = 16
+    chat_context_selection: bool = True
+    chat_context_min_chars: int = 12000
+    chat_context_budget_chars: int = 12000
+    openai_small_model: Optional[str] = None
+    model_routes: Dict[str, str] = field(default_factory=lambda: parse_routes(DEFAULT_MODEL_ROUTES))
+    routing_small_max_tokens: int = 4000
+    routing_output_headroom: float = 1.5
+    session_export_page_size: int = 200
+    session_import_batch_size: int = 100
 
 
 def load_settings() -> Settings:
+    """Build a fresh Settings from the environment and prompts.yml.
+
+    Request handlers should use `get_settings()`, which caches the result.
+    """
     cors_env = os.getenv("CORS_ALLOW_ORIGINS", "*")
     cors = [o.strip() for o in cors_env.split(",") if o.strip()] or ["*"]
     model = os.getenv("OPENAI_MODEL", "gpt-4o")
@@ -23,30 +204,214 @@ def load_settings() -> Settings:
         max_tokens = int(max_tokens_env) if max_tokens_env else 16000
     except ValueError:
         max_tokens = 16000
-    prompts = _load_prompts()
+    prompts, raw = _load_prompts()
     return Settings(
         openai_api_key=os.getenv("OPENAI_API_KEY"),
         openai_model=model,
         openai_max_tokens=max_tokens,
         cors_allow_origins=cors,
         prompts=prompts,
+        templates=_compile_prompts(prompts, raw),
+        admin_token=os.getenv("ADMIN_TOKEN") or None,
+        openai_base_url=os.getenv("OPENAI_BASE_URL") or None,
+        http_max_connections=_env_int("OPENAI_MAX_CONNECTIONS", 100),
+        http_max_keepalive=_env_int("OPENAI_MAX_KEEPALIVE", 20),
+        http_keepalive_expiry=_env_float("OPENAI_KEEPALIVE_EXPIRY", 60.0),
+        http2=_env_bool("OPENAI_HTTP2", True),
+        session_store=(os.getenv("SESSION_STORE") or "memory").strip().lower(),
+        session_db_url=os.getenv("SESSION_DB_URL") or "sqlite:///./sessions.db",
+        session_max_sessions=_env_int("SESSION_MAX_SESSIONS", 10000),
+        session_ttl_seconds=_env_float("SESSION_TTL_SECONDS", 0.0),
+        session_memory_budget_mb=_env_int("SESSION_MEMORY_BUDGET_MB", 512),
+        history_token_budget=_env_int("CHAT_HISTORY_TOKEN_BUDGET", 8000),
+        history_summary_max_tokens=_env_int("CHAT_SUMMARY_MAX_TOKENS", 512),
+        generate_cache_enabled=_env_bool("GENERATE_CACHE_ENABLED", True),
+        generate_cache_memory_mb=_env_int("GENERATE_CACHE_MEMORY_MB", 64),
+        generate_cache_dir=os.getenv("GENERATE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "contract-generate-cache")) or None,
+        generate_cache_ttl_seconds=_env_float("GENERATE_CACHE_TTL_SECONDS", 7 * 24 * 3600),
+        generate_cache_disk_mb=_env_int("GENERATE_CACHE_DISK_MB", 512),
+        generate_parallelism=max(1, _env_int("GENERATE_PARALLELISM", 4)),
+        generate_section_max_tokens=_env_int("GENERATE_SECTION_MAX_TOKENS", 3000),
+        admission_max_concurrent=_env_int("ADMISSION_MAX_CONCURRENT", 32),
+        admission_per_client=_env_int("ADMISSION_PER_CLIENT", 4),
+        admission_queue_size=_env_int("ADMISSION_QUEUE_SIZE", 64),
+        admission_queue_timeout=_env_float("ADMISSION_QUEUE_TIMEOUT", 10.0),
+        openai_tpm_limit=_env_int("OPENAI_TPM_LIMIT", 0),
+        openai_retry_attempts=max(1, _env_int("OPENAI_RETRY_ATTEMPTS", 3)),
+        openai_retry_deadline=_env_float("OPENAI_RETRY_DEADLINE", 30.0),
+        openai_breaker_threshold=_env_int("OPENAI_BREAKER_THRESHOLD", 5),
+        openai_breaker_reset_seconds=_env_float("OPENAI_BREAKER_RESET_SECONDS", 30.0),
+        title_hedge_delay=_env_float("TITLE_HEDGE_DELAY", 1.5),
+        title_model=os.getenv("OPENAI_TITLE_MODEL") or None,
+        title_timeout=_env_float("TITLE_TIMEOUT", 8.0),
+        stream_batch_bytes=_env_int("STREAM_BATCH_BYTES", 1024),
+        stream_batch_ms=_env_float("STREAM_BATCH_MS", 25.0),
+        stream_resume_ttl=_env_float("STREAM_RESUME_TTL", 300.0),
+        stream_detach_grace=_env_float("STREAM_DETACH_GRACE", 60.0),
+        stream_buffer_memory_kb=_env_int("STREAM_BUFFER_MEMORY_KB", 256),
+        stream_max_resumable=_env_int("STREAM_MAX_RESUMABLE", 1000),
+        lambda_snapshot=_env_bool("LAMBDA_SNAPSHOT", False),
+        lambda_response_streaming=_env_bool("LAMBDA_RESPONSE_STREAMING", True),
+        workers=max(1, _env_int("WEB_CONCURRENCY", 1)),
+        openai_stream_usage=_env_bool("OPENAI_STREAM_USAGE", True),
+        prompt_snapshot_max_drift=_env_float("PROMPT_SNAPSHOT_MAX_DRIFT", 0.3),
+        batch_concurrency=max(1, _env_int("BATCH_CONCURRENCY", 4)),
+        batch_max_items=_env_int("BATCH_MAX_ITEMS", 100),
+        batch_jobs_dir=os.getenv("BATCH_JOBS_DIR", os.path.join(tempfile.gettempdir(), "contract-batch-jobs")) or None,
+        batch_admission_wait=_env_float("BATCH_ADMISSION_WAIT", 300.0),
+        batch_job_retention_seconds=_env_float("BATCH_JOB_RETENTION_SECONDS", 7 * 24 * 3600),
+        batch_progress_chars=max(1, _env_int("BATCH_PROGRESS_CHARS", 1024)),
+        document_compression=(os.getenv("DOCUMENT_COMPRESSION") or "zstd").strip().lower(),
+        document_max_versions=_env_int("DOCUMENT_MAX_VERSIONS", 50),
+        document_cache_mb=_env_int("DOCUMENT_CACHE_MB", 16),
+        chat_context_selection=_env_bool("CHAT_CONTEXT_SELECTION", True),
+        chat_context_min_chars=_env_int("CHAT_CONTEXT_MIN_CHARS", 12000),
+        chat_context_budget_chars=_env_int("CHAT_CONTEXT_BUDGET_CHARS", 12000),
+        openai_small_model=os.getenv("OPENAI_SMALL_MODEL") or None,
+        model_routes={**parse_routes(DEFAULT_MODEL_ROUTES), **parse_routes(os.getenv("MODEL_ROUTES", ""))},
+        routing_small_max_tokens=_env_int("ROUTING_SMALL_MAX_TOKENS", 4000),
+        routing_output_headroom=max(1.0, _env_float("ROUTING_OUTPUT_HEADROOM", 1.5)),
+        session_export_page_size=max(1, _env_int("SESSION_EXPORT_PAGE_SIZE", 200)),
+        session_import_batch_size=max(1, _env_int("SESSION_IMPORT_BATCH_SIZE", 100)),
     )
 
 
-def _load_prompts() -> dict:
-    # Look for prompts.yml in backend root (parent of app/)
-    backend_root = pathlib.Path(__file__).resolve().parents[1]
-    prompts_path = backend_root / "prompts.yml"
+def parse_routes(text: str) -> Dict[str, str]:
+    """`stage=rule` pairs separated by commas; unknown rules are ignored."""
+    routes: Dict[str, str] = {}
+    for pair in text.split(","):
+        stage, _, rule = pair.partition("=")
+        stage, rule = stage.strip().lower(), rule.strip().lower()
+        if stage and rule in MODEL_ROUTE_RULES:
+            routes[stage] = rule
+    return routes
+
+
+def _env_int(name: str, default: int) -> int:
     try:
-        with open(prompts_path, "r", encoding="utf-8") as f:
-            data = yaml.safe_load(f) or {}
-            if not isinstance(data, dict):
-                return {}
-            return data
+        return int(os.getenv(name) or default)
+    except ValueError:
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name) or default)
+    except ValueError:
+        return default
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value is None or not value.strip():
+        return default
+    return value.strip().lower() in {"1", "true", "yes"}
+
+
+def _load_prompts() -> Tuple[dict, bytes]:
+    try:
+        raw = PROMPTS_PATH.read_bytes()
     except Exception:
-        return {}
+        return {}, b""
+    try:
+        data = yaml.safe_load(raw) or {}
+    except Exception:
+        return {}, raw
+    if not isinstance(data, dict):
+        return {}, raw
+    return data, raw
 
-# Default system prompt preserved for fallback
-DEFAULT_SYSTEM_PROMPT = "You are a senior technology and privacy attorney. Return ONLY Markdown."
+
+def _compile_prompts(prompts: dict, raw: bytes) -> PromptTemplates:
+    system = prompts.get("system", {}) or {}
+    user = prompts.get("user", {}) or {}
+    title = prompts.get("title", {}) or {}
+    generation = user.get("generation_requirements")
+    return PromptTemplates(
+        contract_generation=system.get("contract_generation") or DEFAULT_SYSTEM_PROMPT,
+        editing_context=system.get("editing_context") or DEFAULT_EDITING_CONTEXT,
+        patch_editing=system.get("patch_editing") or DEFAULT_PATCH_EDITING,
+        summary_instruction=(prompts.get("history", {}) or {}).get("summary_instruction") or DEFAULT_SUMMARY_INSTRUCTION,
+        title_instruction=title.get("instruction") or DEFAULT_TITLE_INSTRUCTION,
+        generation_requirements=PromptTemplate(generation) if generation else None,
+        outline_instruction=PromptTemplate(user.get("outline_instruction") or DEFAULT_OUTLINE_INSTRUCTION),
+        section_instruction=PromptTemplate(user.get("section_instruction") or DEFAULT_SECTION_INSTRUCTION),
+        digest=hashlib.sha256(raw).hexdigest(),
+    )
+
+
+def _prompts_mtime() -> Optional[float]:
+    try:
+        return PROMPTS_PATH.stat().st_mtime
+    except OSError:
+        return None
+
+
+class SettingsRegistry:
+    """Process-wide cache of Settings.
+
+    The environment is read once per `reload()`. prompts.yml is re-parsed only
+    when its mtime changes, and the mtime itself is checked at most once per
+    `check_interval` seconds. On an event loop the check and the re-parse
+    run in a worker thread while callers keep the current Settings, so
+    request paths stay free of file I/O.
+    """
+
+    def __init__(self, check_interval: float = 1.0):
+        self.check_interval = check_interval
+        self._lock = threading.RLock()
+        self._settings: Optional[Settings] = None
+        self._mtime: Optional[float] = None
+        self._checked_at = 0.0
+        self._refreshing = False
+
+    def get(self) -> Settings:
+        settings = self._settings
+        if settings is None:
+            return self.reload()
+        now = time.monotonic()
+        if now - self._checked_at >= self.check_interval and not self._refreshing:
+            self._checked_at = now
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                return self._refresh()
+            self._refreshing = True
+            loop.run_in_executor(None, self._refresh)
+        return settings
+
+    def _refresh(self) -> Settings:
+        try:
+            if _prompts_mtime() != self._mtime:
+                return self._reload_prompts()
+            return self._settings  # type: ignore[return-value]
+        finally:
+            self._refreshing = False
+
+    def reload(self) -> Settings:
+        with self._lock:
+            self._mtime = _prompts_mtime()
+            self._checked_at = time.monotonic()
+            self._settings = load_settings()
+            return self._settings
+
+    def _reload_prompts(self) -> Settings:
+        with self._lock:
+            current = self._settings
+            if current is None:
+                return self.reload()
+            self._mtime = _prompts_mtime()
+            prompts, raw = _load_prompts()
+            self._settings = replace(current, prompts=prompts, templates=_compile_prompts(prompts, raw))
+            return self._settings
+
+
+_REGISTRY = SettingsRegistry(check_interval=_env_float("PROMPTS_CHECK_INTERVAL", 1.0))
+
+
+def get_settings() -> Settings:
+    return _REGISTRY.get()
 
 
+def reload_settings() -> Settings:
+    return _REGISTRY.reload()
@@ -0,0 +1,213 @@
+import asyncio
+import json
+from typing import Any, AsyncIterator, Dict, List, Optional, Union
+
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+
+try:
+    import orjson  # type: ignore
+except Exception:  # pragma: no cover
+    orjson = None  # type: ignore
+
+from .config import get_settings
+
+
+# A stream item is either a text delta or an already-structured event
+StreamItem = Union[str, Dict[str, Any]]
+
+MEDIA_TYPES = {
+    "text": "text/markdown; charset=utf-8",
+    "json": "application/json; charset=utf-8",
+    "ndjson": "application/x-ndjson; charset=utf-8",
+    "sse": "text/event-stream; charset=utf-8",
+}
+
+STREAM_HEADERS = {
+    "Cache-Control": "no-cache, no-transform",
+    "X-Accel-Buffering": "no",
+    "Connection": "keep-alive",
+}
+
+
+def dumps(value: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _utf8_len(text: str) -> int:
+    return len(text) if text.isascii() else len(text.encode("utf-8"))
+
+
+async def coalesce(source: AsyncIterator[StreamItem], *, max_bytes: int, max_delay: float) -> AsyncIterator[StreamItem]:
+    """Merge consecutive text deltas into batches of about `max_bytes`, held at most `max_delay` seconds.
+
+    Structured events are never merged; a pending batch is flushed ahead of
+    them so order is preserved. With both limits at 0 every item passes
+    through as is.
+    """
+    iterator = source.__aiter__()
+    if max_bytes <= 0 and max_delay <= 0:
+        async for item in iterator:
+            yield item
+        return
+
+    loop = asyncio.get_running_loop()
+    parts: List[str] = []
+    size = 0
+    flush_at = 0.0
+    pending: Optional["asyncio.Future[StreamItem]"] = None
+    try:
+        while True:
+            if parts and max_delay > 0:
+                # Wait for the next item only until the batch is due
+                if pending is None:
+                    pending = asyncio.ensure_future(iterator.__anext__())
+                done, _ = await asyncio.wait({pending}, timeout=max(0.0, flush_at - loop.time()))
+                if not done:
+                    yield "".join(parts)
+                    parts, size = [], 0
+                    continue
+                task, pending = pending, None
+                try:
+                    item = task.result()
+                except StopAsyncIteration:
+                    break
+            elif pending is not None:
+                task, pending = pending, None
+                try:
+                    item = await task
+                except StopAsyncIteration:
+                    break
+            else:
+                try:
+                    item = await iterator.__anext__()
+                except StopAsyncIteration:
+                    break
+
+            if not isinstance(item, str):
+                if parts:
+                    yield "".join(parts)
+                    parts, size = [], 0
+                yield item
+                continue
+            if not item:
+                continue
+            if not parts:
+                flush_at = loop.time() + max_delay
+            parts.append(item)
+            size += _utf8_len(item)
+            if max_bytes > 0 and size >= max_bytes:
+                yield "".join(parts)
+                parts, size = [], 0
+    except Exception:
+        # Deliver what already arrived before reporting the failure
+        if parts:
+            yield "".join(parts)
+        raise
+    else:
+        if parts:
+            yield "".join(parts)
+    finally:
+        if pending is not None:
+            pending.cancel()
+            await asyncio.gather(pending, return_exceptions=True)
+        closer = getattr(iterator, "aclose", None)
+        if closer is not None:
+            await closer()
+
+
+def _frame(item: StreamItem, fmt: str, event_id: Optional[int] = None) -> bytes:
+    if fmt == "text":
+        return item.encode("utf-8") if isinstance(item, str) else dumps(item) + b"\n"
+    if fmt == "json":
+        # Body of the legacy {"data":"..."} string: the escaped text without its quotes
+        return dumps(item if isinstance(item, str) else dumps(item).decode("utf-8"))[1:-1]
+    event = {"type": "delta", "data": item} if isinstance(item, str) else item
+    if fmt == "sse":
+        head = b"id: %d\n" % event_id if event_id is not None else b""
+        return head + b"event: " + str(event.get("type", "message")).encode("utf-8") + b"\ndata: " + dumps(event) + b"\n\n"
+    if event_id is not None:
+        event = {**event, "id": event_id}
+    return dumps(event) + b"\n"
+
+
+async def encode_stream(
+    source: AsyncIterator[StreamItem],
+    fmt: str,
+    *,
+    max_bytes: int = 0,
+    max_delay: float = 0.0,
+    first_id: Optional[int] = None,
+) -> AsyncIterator[bytes]:
+    """Frame a token/event stream as raw text, legacy JSON, NDJSON or SSE.
+
+    NDJSON and SSE report a failure in-band as an `error` event, since the
+    status line has already been sent; the other formats end the response.
+    With `first_id`, items are already batched resumable events: NDJSON and
+    SSE events carry the offset to resume from (`id`), starting after
+    `first_id`.
+    """
+    if fmt == "json":
+        yield b'{"data":"'
+    event_id = first_id
+    if first_id is not None:
+        items = source
+    else:
+        items = coalesce(source, max_bytes=max_bytes, max_delay=max_delay)
+    try:
+        async for item in items:
+            if event_id is not None:
+                event_id += 1
+            yield _frame(item, fmt, event_id)
+    except Exception as exc:
+        if fmt == "json":
+            yield b'"}'
+        if fmt not in {"ndjson", "sse"}:
+            raise
+        yield _frame({"type": "error", "error": str(exc) or type(exc).__name__}, fmt)
+    else:
+        if fmt == "json":
+            yield b'"}'
+    finally:
+        # Close the source now rather than at garbage collection, so upstream work stops promptly
+        closer = getattr(items, "aclose", None)
+        if closer is not None:
+            await closer()
+
+
+def negotiate(request: Request, default: str, allowed=("text", "json", "ndjson", "sse")) -> str:
+    """Pick the stream format from `?format=`, else the Accept header, else `default`."""
+    wanted = (request.query_params.get("format") or "").strip().lower()
+    if wanted in allowed:
+        return wanted
+    accept = request.headers.get("accept", "")
+    if "text/event-stream" in accept and "sse" in allowed:
+        return "sse"
+    if "application/x-ndjson" in accept and "ndjson" in allowed:
+        return "ndjson"
+    return default
+
+
+def stream_response(
+    source: AsyncIterator[StreamItem],
+    fmt: str,
+    *,
+    headers: Optional[Dict[str, str]] = None,
+    background=None,
+    first_id: Optional[int] = None,
+) -> StreamingResponse:
+    settings = get_settings()
+    return StreamingResponse(
+        encode_stream(
+            source,
+            fmt,
+            max_bytes=settings.stream_batch_bytes,
+            max_delay=settings.stream_batch_ms / 1000.0,
+            first_id=first_id,
+        ),
+        media_type=MEDIA_TYPES[fmt],
+        headers={**STREAM_HEADERS, **(headers or {})},
+        background=background,
+    )
@@ -0,0 +1,297 @@
+import asyncio
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, List, Optional, Sequence, Tuple, TypeVar
+
+try:
+    from opentelemetry import trace as otel_trace  # type: ignore
+except Exception:  # pragma: no cover
+    otel_trace = None  # type: ignore
+
+
+T = TypeVar("T")
+
+# Latency buckets in seconds, from sub-token gaps up to multi-minute generations
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+RATE_BUCKETS = (1, 5, 10, 20, 40, 60, 80, 100, 150, 200, 400)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self) -> Iterable[str]:  # pragma: no cover - overridden
+        return ()
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class _Scalar(Metric):
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), collect: Optional[Callable[[], Iterable[Tuple[Dict[str, str], float]]]] = None):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._collect = collect
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def samples(self) -> Iterable[str]:
+        values = dict(self._values)
+        if self._collect is not None:
+            try:
+                for labels, value in self._collect():
+                    values[self._key(labels)] = value
+            except Exception:
+                # A failing collector must not break the whole scrape
+                pass
+        for key, value in sorted(values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Counter(_Scalar):
+    """A monotonically increasing count; with `collect`, read from the callback at scrape time."""
+
+    kind = "counter"
+
+
+class Gauge(_Scalar):
+    """A value that goes up and down; with `collect`, read from the callback at scrape time."""
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels: str):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def dec(self, amount: float = 1.0, **labels: str):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket counts (last one is +Inf), then sum and count
+                state = self._values[key] = [0.0] * (len(self.buckets) + 3)
+            state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def count(self, **labels: str) -> float:
+        state = self._values.get(self._key(labels))
+        return state[-1] if state else 0.0
+
+    def samples(self) -> Iterable[str]:
+        for key, state in sorted(self._values.items()):
+            cumulative = 0.0
+            for bound, hits in zip(self.buckets + (math.inf,), state):
+                cumulative += hits
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', _format_value(bound)))} {_format_value(cumulative)}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(state[-2])}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {_format_value(state[-1])}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric):
+        self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        return "\n".join(m.render() for m in self._metrics.values()) + "\n"
+
+
+REGISTRY = Registry()
+
+HTTP_REQUESTS = Counter("http_requests_total", "HTTP requests by route and status.", ("method", "route", "status"))
+HTTP_DURATION = Histogram("http_request_duration_seconds", "Time from request to the last body byte.", ("method", "route"))
+STREAM_TTFT = Histogram("llm_stream_ttft_seconds", "Time from starting an upstream stream to its first token.", ("stage",))
+STREAM_INTER_TOKEN = Histogram("llm_stream_inter_token_seconds", "Gap between consecutive streamed tokens.", ("stage",))
+STREAM_DURATION = Histogram("llm_stream_duration_seconds", "Total duration of an upstream stream.", ("stage",))
+STREAM_RATE = Histogram("llm_stream_tokens_per_second", "Streamed tokens per second after the first token.", ("stage",), buckets=RATE_BUCKETS)
+STREAM_TOKENS = Counter("llm_stream_tokens_total", "Streamed tokens (upstream deltas).", ("stage",))
+STREAM_OUTCOMES = Counter("llm_streams_total", "Finished upstream streams by outcome.", ("stage", "outcome"))
+ACTIVE_STREAMS = Gauge("llm_active_streams", "Upstream streams in progress.", ("stage",))
+UPSTREAM_RETRIES = Counter("upstream_retries_total", "Upstream calls retried after a transient failure.")
+UPSTREAM_ERRORS = Counter("upstream_errors_total", "Failed upstream attempts by error class.", ("error",))
+TITLE_DURATION = Histogram("session_title_seconds", "Session title generation time by outcome.", ("outcome",))
+PROMPT_TOKENS = Counter("llm_prompt_tokens_total", "Prompt tokens reported by upstream usage.", ("stage",))
+CACHED_PROMPT_TOKENS = Counter("llm_prompt_cached_tokens_total", "Prompt tokens upstream served from its prompt cache.", ("stage",))
+PROMPT_PREFIXES = Counter("llm_prompt_prefixes_total", "Chat prompt prefixes by whether they match the session's previous turn.", ("outcome",))
+LLM_ROUTES = Counter("llm_routes_total", "Upstream calls by stage and the model tier routed to.", ("stage", "tier"))
+BATCH_ITEMS = Counter("batch_items_total", "Batch generation items by outcome.", ("outcome",))
+CHAT_CONTEXT = Counter("chat_context_selections_total", "Patch-mode document context by outcome: an excerpt (named, relevant) or the full document and why.", ("outcome",))
+CHAT_CONTEXT_CHARS = Counter("chat_context_chars_total", "Document characters available (document) and sent (sent) in patch-mode prompts.", ("part",))
+
+
+def _cache_hit_ratios():
+    for key, prompt in list(PROMPT_TOKENS._values.items()):
+        if prompt:
+            yield {"stage": key[0]}, CACHED_PROMPT_TOKENS._values.get(key, 0.0) / prompt
+
+
+PROMPT_CACHE_HIT_RATIO = Gauge("llm_prompt_cache_hit_ratio", "Share of prompt tokens served from the upstream prompt cache.", ("stage",), collect=_cache_hit_ratios)
+
+
+def usage_counts(usage: Any) -> Tuple[int, int]:
+    """(prompt tokens, cached prompt tokens) from an OpenAI `usage` object or a LangChain `usage_metadata` dict."""
+    if not usage:
+        return 0, 0
+    if isinstance(usage, dict):
+        details = usage.get("input_token_details") or {}
+        return int(usage.get("input_tokens") or 0), int(details.get("cache_read") or 0)
+    details = getattr(usage, "prompt_tokens_details", None)
+    return int(getattr(usage, "prompt_tokens", 0) or 0), int(getattr(details, "cached_tokens", 0) or 0)
+
+
+def record_usage(usage: Any, *, stage: str) -> Tuple[int, int]:
+    prompt, cached = usage_counts(usage)
+    if prompt:
+        PROMPT_TOKENS.inc(prompt, stage=stage)
+        CACHED_PROMPT_TOKENS.inc(cached, stage=stage)
+    return prompt, cached
+
+
+def error_class(exc: BaseException) -> str:
+    """Low-cardinality label for an upstream failure: the HTTP status when there is one, else the exception type."""
+    status = getattr(exc, "status_code", None) or getattr(getattr(exc, "response", None), "status_code", None)
+    if isinstance(status, int):
+        return f"http_{status}"
+    return type(exc).__name__
+
+
+async def instrument_stream(source: AsyncIterator[T], *, stage: str) -> AsyncIterator[T]:
+    """Pass `source` through while recording TTFT, inter-token gaps, throughput and outcome under `stage`.
+
+    The source is closed when this stream is, so wrapping an upstream stream
+    does not delay releasing its connection.
+    """
+    started = time.perf_counter()
+    first: Optional[float] = None
+    last = started
+    tokens = 0
+    outcome = "ok"
+    ACTIVE_STREAMS.inc(stage=stage)
+    try:
+        async for item in source:
+            now = time.perf_counter()
+            if first is None:
+                first = now
+                STREAM_TTFT.observe(now - started, stage=stage)
+            else:
+                STREAM_INTER_TOKEN.observe(now - last, stage=stage)
+            last = now
+            tokens += 1
+            yield item
+    except GeneratorExit:
+        outcome = "closed"
+        raise
+    except BaseException as exc:
+        outcome = "cancelled" if isinstance(exc, asyncio.CancelledError) else "error"
+        raise
+    finally:
+        closer = getattr(source, "aclose", None)
+        if closer is not None:
+            await closer()
+        ACTIVE_STREAMS.dec(stage=stage)
+        end = time.perf_counter()
+        STREAM_DURATION.observe(end - started, stage=stage)
+        STREAM_OUTCOMES.inc(stage=stage, outcome=outcome)
+        if tokens:
+            STREAM_TOKENS.inc(tokens, stage=stage)
+        if first is not None and tokens > 1 and end > first:
+            STREAM_RATE.observe((tokens - 1) / (end - first), stage=stage)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """An OpenTelemetry span when the SDK is installed, otherwise nothing."""
+    if otel_trace is None:
+        yield None
+        return
+    with otel_trace.get_tracer("contract-backend").start_as_current_span(name) as current:
+        for key, value in attributes.items():
+            if value is not None:
+                current.set_attribute(key, value)
+        yield current
+
+
+def render() -> str:
+    return REGISTRY.render()
+
+
+class MetricsMiddleware:
+    """Counts requests and times them to the last body byte, labelled by route template."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = {"code": 500}
+
+        async def _send(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            route = scope.get("route")
+            # Unmatched paths share one label so scanners cannot blow up cardinality
+            template = getattr(route, "path", None) or "unmatched"
+            method = scope.get("method", "")
+            HTTP_REQUESTS.inc(method=method, route=template, status=str(status["code"]))
+            HTTP_DURATION.observe(time.perf_counter() - started, method=method, route=template)
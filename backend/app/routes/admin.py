@@ -0,0 +1,25 @@
+import hmac
+from typing import Optional
+from fastapi import APIRouter, Header, HTTPException
+from fastapi.concurrency import run_in_threadpool
+
+from ..config import get_settings, reload_settings
+
+router = APIRouter()
+
+
+def require_admin(token: Optional[str]):
+    """Admin routes exist only when ADMIN_TOKEN is set, and then only for callers presenting it."""
+    expected = get_settings().admin_token
+    if not expected:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not token or not hmac.compare_digest(token.encode("utf-8"), expected.encode("utf-8")):
+        raise HTTPException(status_code=403, detail="forbidden")
+
+
+@router.post("/admin/reload")
+async def reload_config(x_admin_token: Optional[str] = Header(None)):
+    require_admin(x_admin_token)
+    # Re-reading the environment and prompts.yml is blocking I/O; keep it off the event loop
+    settings = await run_in_threadpool(reload_settings)
+    return {"ok": True, "prompts_digest": settings.templates.digest}
@@ -1,61 +1,74 @@
-from typing import AsyncGenerator
-from fastapi import APIRouter, HTTPException
-from fastapi.responses import StreamingResponse
+import asyncio
 
+from fastapi import APIRouter, HTTPException, Request
+
+from ..admission import admit
+from ..config import get_settings
+from ..encoders import negotiate, stream_response
 from ..schemas import ChatRequest
-from ..services.session import get_history as svc_get_history, SESSION_META
-from ..services.chat import stream_chat
-from ..services.title import generate_session_title
-from ..utils import json_stream_wrapper
+from ..tokens import count_tokens
+from ..services.session import get_document as svc_get_document, get_history as svc_get_history, get_meta as svc_get_meta
+from ..services.chat import stream_chat, stream_chat_patches
+from ..services.streams import start_resumable
+from ..services.title import schedule_session_title
 
 router = APIRouter()
 
 
 @router.post("/chat")
-async def chat_stream(req: ChatRequest):
-    try:
-        meta = SESSION_META.get(req.session_id)
-        if meta is None:
-            raise HTTPException(status_code=404, detail="session not found")
-
-        base_doc = meta.get("document_html")
+async def chat_stream(req: ChatRequest, request: Request):
+    # Store reads may block (SQL); keep them off the event loop
+    meta = await asyncio.to_thread(svc_get_meta, req.session_id)
+    if meta is None:
+        raise HTTPException(status_code=404, detail="session not found")
 
+    # Decompressed here, only for the turn that uses it
+    base_doc = await asyncio.to_thread(svc_get_document, req.session_id, meta=meta)
+    settings = get_settings()
+    # Prompt (input, document, history window) plus a reply about the size of the document
+    doc_tokens = count_tokens(base_doc or "", settings.openai_model)
+    estimate = count_tokens(req.message.content, settings.openai_model) + 2 * doc_tokens + settings.history_token_budget
+    ticket = await admit(request, estimate)
+    try:
         def _get_history(_: str):
             return svc_get_history(req.session_id)
 
-        # Generate a session title on first prompt if missing
+        # Generate a session title on first prompt if missing, off the streaming path
         if not meta.get("document_title") and req.message and req.message.content:
-            try:
-                title = await generate_session_title(user_input=req.message.content, base_doc_markdown=base_doc)
-                if title:
-                    meta["document_title"] = title
-            except Exception:
-                pass
-
-        async def generator() -> AsyncGenerator[str, None]:
-            async for token in stream_chat(
-                session_id=req.session_id,
-                input_text=req.message.content,
-                base_doc=base_doc,
-                system_prompt=meta.get("system_prompt"),
-                get_history_cb=_get_history,
-            ):
-                yield token
-
-        return StreamingResponse(
-            json_stream_wrapper(generator()),
-            media_type="application/json; charset=utf-8",
-            headers={
-                "Cache-Control": "no-cache, no-transform",
-                "X-Accel-Buffering": "no",
-                "Connection": "keep-alive",
-            },
+            schedule_session_title(session_id=req.session_id, user_input=req.message.content, base_doc_markdown=base_doc)
+
+        patch_mode = req.mode == "patch" and bool(base_doc)
+
+        common = dict(
+            session_id=req.session_id,
+            input_text=req.message.content,
+            base_doc=base_doc,
+            base_version=meta.get("document_version"),
+            system_prompt=meta.get("system_prompt"),
+            get_history_cb=_get_history,
+        )
+        events = stream_chat_patches(**common) if patch_mode else stream_chat(**common)
+        # The turn runs detached from this connection; GET /api/stream/{id} resumes it after a drop
+        run = start_resumable(events, name=f"chat:{req.session_id}")
+        # The slot is held until the turn itself ends, not until this connection does
+        run.add_done_callback(ticket.release)
+
+        # Patch events are structured, so they need a framed format; full mode keeps the legacy {"data": "..."} body by default
+        fmt = negotiate(request, "ndjson", allowed=("ndjson", "sse")) if patch_mode else negotiate(request, "json")
+        return stream_response(
+            run.subscribe(),
+            fmt,
+            headers={"X-Stream-Id": run.id},
+            first_id=0,
         )
     except HTTPException:
+        ticket.release()
         raise
     except RuntimeError as exc:
+        ticket.release()
         raise HTTPException(status_code=500, detail=str(exc))
     except Exception as exc:  # pragma: no cover
+        ticket.release()
         raise HTTPException(status_code=500, detail=str(exc))
 
 
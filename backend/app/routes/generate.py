@@ -1,37 +1,117 @@
-from typing import AsyncGenerator
-from fastapi import APIRouter, HTTPException
-from fastapi.responses import StreamingResponse, JSONResponse
+import asyncio
 
-from ..schemas import GenerateRequest
-from ..services.generation import stream_contract_md
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import FileResponse, JSONResponse, Response
+
+from ..admission import admit, client_key
+from ..config import get_settings
+from ..encoders import MEDIA_TYPES, negotiate, stream_response
+from ..schemas import BatchGenerateRequest, GenerateRequest
+from ..tokens import count_tokens
+from ..services.batch import batch_concurrency, batch_entries, get_batch_jobs, run_batch
+from ..services.generation import open_contract_stream
 
 router = APIRouter()
 
 
 @router.post("/generate")
-async def generate_contract(data: GenerateRequest):
+async def generate_contract(data: GenerateRequest, request: Request):
+    settings = get_settings()
+    # Reserve the prompt plus the completion ceiling, as the upstream rate limiter does
+    ticket = await admit(request, count_tokens(data.prompt, settings.openai_model) + settings.openai_max_tokens)
+    try:
+        opened = await open_contract_stream(data=data)
+    except RuntimeError as exc:
+        ticket.release(refund=True)
+        # configuration errors
+        raise HTTPException(status_code=500, detail=str(exc))
+    except BaseException:
+        ticket.release(refund=True)
+        raise
+    if opened.run is None:
+        # Served without a new upstream stream
+        ticket.release(refund=True)
+    else:
+        # The slot lasts as long as the upstream run, which outlives a dropped connection
+        opened.run.add_done_callback(ticket.release)
     try:
-        async def _event_stream() -> AsyncGenerator[bytes, None]:
-            try:
-                async for delta in stream_contract_md(data=data):
-                    if delta:
-                        yield delta.encode("utf-8", errors="ignore")
-            except RuntimeError as exc:
-                # configuration errors
-                raise HTTPException(status_code=500, detail=str(exc))
-
-        return StreamingResponse(
-            _event_stream(),
-            media_type="text/markdown; charset=utf-8",
-            headers={
-                "Cache-Control": "no-cache, no-transform",
-                "X-Accel-Buffering": "no",
-                "Connection": "keep-alive",
-            },
+        headers = {"X-Cache": opened.status}
+        if opened.stream_id:
+            # The run continues if this connection drops; GET /api/stream/{id} resumes it
+            headers["X-Stream-Id"] = opened.stream_id
+        return stream_response(
+            opened.stream,
+            negotiate(request, "text"),
+            headers=headers,
+            first_id=0 if opened.stream_id else None,
         )
     except HTTPException:
         raise
     except Exception as exc:  # pragma: no cover
+        ticket.release()
         return JSONResponse(status_code=500, content={"error": str(exc)})
 
 
+@router.post("/generate/batch")
+async def generate_batch(data: BatchGenerateRequest, request: Request):
+    settings = get_settings()
+    if settings.batch_max_items and len(data.items) > settings.batch_max_items:
+        raise HTTPException(status_code=413, detail=f"at most {settings.batch_max_items} items per batch")
+    try:
+        entries = batch_entries(data.items)
+    except ValueError as exc:
+        raise HTTPException(status_code=422, detail=str(exc))
+    concurrency = batch_concurrency(data.concurrency, settings)
+    if data.job:
+        try:
+            jobs = get_batch_jobs()
+        except RuntimeError as exc:
+            raise HTTPException(status_code=500, detail=str(exc))
+        items = [{**entry.request.model_dump(), "id": entry.id} for entry in entries]
+        job_id = await jobs.start(items, client=client_key(request), concurrency=concurrency, skip_ids=data.skip_ids)
+        return JSONResponse(status_code=202, content=await asyncio.to_thread(jobs.status, job_id))
+    # Per-item results are complete documents; only NDJSON and SSE can carry them
+    return stream_response(
+        run_batch(entries, client=client_key(request), concurrency=concurrency, skip_ids=data.skip_ids, settings=settings),
+        negotiate(request, "ndjson", allowed=("ndjson", "sse")),
+        headers={"X-Batch-Concurrency": str(concurrency)},
+    )
+
+
+# Job status and results read the job's files: plain `def` routes run in the threadpool, off the event loop
+@router.get("/generate/batch/{job_id}")
+def batch_job_status(job_id: str):
+    try:
+        return get_batch_jobs().status(job_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="job not found")
+    except RuntimeError as exc:
+        raise HTTPException(status_code=500, detail=str(exc))
+
+
+@router.get("/generate/batch/{job_id}/results")
+def batch_job_results(job_id: str):
+    try:
+        path = get_batch_jobs().results_path(job_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="job not found")
+    except RuntimeError as exc:
+        raise HTTPException(status_code=500, detail=str(exc))
+    if not path.exists():
+        # No item has finished yet
+        return Response(content=b"", media_type=MEDIA_TYPES["ndjson"])
+    return FileResponse(path, media_type=MEDIA_TYPES["ndjson"])
+
+
+@router.post("/generate/batch/{job_id}/resume")
+async def resume_batch_job(job_id: str):
+    jobs = None
+    try:
+        jobs = get_batch_jobs()
+        resumed = await jobs.resume(job_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="job not found")
+    except RuntimeError as exc:
+        status_code = 409 if jobs is not None else 500
+        raise HTTPException(status_code=status_code, detail=str(exc))
+    return {**await asyncio.to_thread(jobs.status, job_id), "resumed": resumed}
@@ -1,5 +1,7 @@
 from fastapi import APIRouter
 
+from ..admission import get_admission
+
 router = APIRouter()
 
 
@@ -8,3 +10,6 @@ async def health():
     return {"status": "ok"}
 
 
+@router.get("/health/admission")
+async def admission_stats():
+    return get_admission().stats()
@@ -0,0 +1,64 @@
+import asyncio
+from typing import Any, Dict, List, Tuple
+
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from ..admission import get_admission
+from ..clients import get_clients
+from ..metrics import Counter, Gauge, render
+from ..services.cache import get_response_cache
+from ..services.store import get_store
+from ..services.streams import get_stream_registry
+
+router = APIRouter()
+
+
+# Filled in a worker thread before each scrape: counting SQL rows blocks
+_STORE_STATS: List[Tuple[Dict[str, Any], float]] = []
+
+
+def _read_store_stats():
+    store = get_store()
+    stats = [({"kind": "sessions"}, store.size())]
+    nbytes = getattr(store, "nbytes", None)
+    if nbytes is not None:
+        stats.append(({"kind": "bytes"}, nbytes))
+    _STORE_STATS[:] = stats
+
+
+def _store_stats():
+    return list(_STORE_STATS)
+
+
+def _cache_stats():
+    cache = get_response_cache()
+    if cache is not None:
+        stats = cache.stats()
+        yield {"kind": "entries"}, stats["entries"]
+        yield {"kind": "bytes"}, stats["bytes"]
+        yield {"kind": "disk_bytes"}, stats["disk_bytes"]
+
+
+# Read from the live objects at scrape time
+Gauge("session_store_size", "Session store size (sessions, and bytes for the memory store).", ("kind",), collect=_store_stats)
+Gauge("generate_cache_size", "Generation cache size (disk bytes as of the last write).", ("kind",), collect=_cache_stats)
+Gauge("admission_active", "Requests holding an admission slot.", collect=lambda: [({}, get_admission().active)])
+Gauge("admission_queue_depth", "Requests waiting for an admission slot.", collect=lambda: [({}, get_admission().queued)])
+Gauge("admission_wait_seconds_max", "Longest admission queue wait so far.", collect=lambda: [({}, get_admission().wait_seconds_max)])
+Counter("admission_wait_seconds_total", "Total time spent waiting in the admission queue.", collect=lambda: [({}, get_admission().wait_seconds_total)])
+Counter("admission_admitted_total", "Requests admitted.", collect=lambda: [({}, get_admission().admitted)])
+Counter(
+    "admission_rejected_total",
+    "Requests rejected by admission control, by reason.",
+    ("reason",),
+    collect=lambda: [({"reason": r}, n) for r, n in get_admission().rejected.items()],
+)
+Gauge("resumable_streams", "Streams currently registered for resumption.", collect=lambda: [({}, len(get_stream_registry()))])
+Gauge("upstream_circuit_open", "1 while the upstream circuit breaker is open.", collect=lambda: [({}, int(get_clients().breaker.state == "open"))])
+
+
+@router.get("/metrics")
+async def metrics():
+    await asyncio.to_thread(_read_store_stats)
+    return PlainTextResponse(render(), media_type="text/plain; version=0.0.4; charset=utf-8")
@@ -1,20 +1,39 @@
-from fastapi import APIRouter, HTTPException
+from typing import Optional
+from fastapi import APIRouter, Header, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
 
+from ..config import get_settings
+from ..encoders import MEDIA_TYPES
+from .admin import require_admin
 from ..schemas import StartSessionRequest, SetDocumentRequest
+from ..services.history import session_token_stats
 from ..services.session import (
     start_session as svc_start_session,
     list_sessions as svc_list_sessions,
     clear_history as svc_clear_history,
     get_history as svc_get_history,
     set_document as svc_set_document,
+    set_title as svc_set_title,
+    get_meta as svc_get_meta,
+    get_document as svc_get_document,
+    list_document_versions as svc_list_document_versions,
+    DocumentConflict,
+)
+from ..services.transfer import (
+    ImportFailed,
+    export_sessions as svc_export_sessions,
+    import_sessions as svc_import_sessions,
+    parse_timestamp,
 )
-from ..services.session import SESSION_META
 
 router = APIRouter()
 
+# Store calls are blocking (SQL, the SQLite write lock), so the handlers that make them are plain
+# functions, which FastAPI runs in its threadpool; only the streaming import stays on the event loop.
+
 
 @router.post("/session/start")
-async def start_session(payload: StartSessionRequest):
+def start_session(payload: StartSessionRequest):
     try:
         sid = svc_start_session(system_prompt=payload.system_prompt, metadata=payload.metadata)
         return {"session_id": sid}
@@ -23,7 +42,7 @@ async def start_session(payload: StartSessionRequest):
 
 
 @router.get("/session/{session_id}/history")
-async def get_history(session_id: str):
+def get_history(session_id: str):
     try:
         history = svc_get_history(session_id)
     except KeyError:
@@ -33,13 +52,27 @@ async def get_history(session_id: str):
     messages = [
         {"role": m.type, "content": m.content} for m in history.messages  # type: ignore[attr-defined]
     ]
-    from ..services.session import SESSION_META
-
-    return {"session_id": session_id, "messages": messages, "meta": SESSION_META.get(session_id, {})}
+    meta = svc_get_meta(session_id) or {}
+    # Prompt-cache bookkeeping is internal to the server
+    for key in [key for key in meta if key.startswith("prompt_snapshot")]:
+        del meta[key]
+    # Clients read the document from meta; it is stored as chunks and decompressed only here
+    manifest = meta.pop("document_manifest", None)
+    if manifest is not None:
+        meta["document_html"] = svc_get_document(session_id, meta={**meta, "document_manifest": manifest})
+    return {"session_id": session_id, "messages": messages, "meta": meta}
+
+
+@router.get("/session/{session_id}/tokens")
+def get_token_stats(session_id: str):
+    try:
+        return {"session_id": session_id, **session_token_stats(session_id, get_settings())}
+    except KeyError:
+        raise HTTPException(status_code=404, detail="session not found")
 
 
 @router.post("/session/{session_id}/clear")
-async def clear_history(session_id: str):
+def clear_history(session_id: str):
     try:
         svc_clear_history(session_id)
         return {"ok": True}
@@ -50,33 +83,108 @@ async def clear_history(session_id: str):
 
 
 @router.get("/session/list")
-async def list_sessions():
+def list_sessions(
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = Query(None, description="Comma-separated metadata fields to include"),
+):
+    projection = [f.strip() for f in fields.split(",") if f.strip()] if fields else None
+    try:
+        sessions, next_cursor = svc_list_sessions(limit=limit, cursor=cursor, fields=projection)
+        return {"sessions": sessions, "next_cursor": next_cursor}
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    except RuntimeError as exc:
+        raise HTTPException(status_code=500, detail=str(exc))
+
+
+@router.get("/session/export")
+async def export_sessions(
+    since: Optional[str] = Query(None, description="Only sessions updated at or after this ISO 8601 time"),
+    until: Optional[str] = Query(None, description="Only sessions updated before this ISO 8601 time"),
+    x_admin_token: Optional[str] = Header(None),
+):
+    # Every user's sessions: refused outright unless ADMIN_TOKEN is configured
+    require_admin(x_admin_token)
+    try:
+        lines = svc_export_sessions(since=parse_timestamp(since), until=parse_timestamp(until))
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    except RuntimeError as exc:
+        raise HTTPException(status_code=500, detail=str(exc))
+    # A sync iterator: Starlette pulls each line in the threadpool, off the event loop
+    return StreamingResponse(
+        lines,
+        media_type=MEDIA_TYPES["ndjson"],
+        headers={"Content-Disposition": 'attachment; filename="sessions.ndjson"'},
+    )
+
+
+@router.post("/session/import")
+async def import_sessions(
+    request: Request,
+    since: Optional[str] = Query(None, description="Only import sessions updated at or after this ISO 8601 time"),
+    until: Optional[str] = Query(None, description="Only import sessions updated before this ISO 8601 time"),
+    replace: bool = Query(False, description="Overwrite sessions that already exist"),
+    x_admin_token: Optional[str] = Header(None),
+):
+    require_admin(x_admin_token)
     try:
-        return {"sessions": svc_list_sessions()}
+        return await svc_import_sessions(request.stream(), since=parse_timestamp(since), until=parse_timestamp(until), replace=replace)
+    except ImportFailed as exc:
+        raise HTTPException(status_code=400, detail={"error": str(exc), **exc.summary})
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
     except RuntimeError as exc:
         raise HTTPException(status_code=500, detail=str(exc))
 
 
 @router.post("/session/{session_id}/document")
-async def set_document(session_id: str, payload: SetDocumentRequest):
+def set_document(session_id: str, payload: SetDocumentRequest):
     try:
-        svc_set_document(session_id, html=payload.html, title=payload.title)
-        return {"ok": True}
+        version = svc_set_document(session_id, html=payload.html, title=payload.title, base_version=payload.base_version)
+        return {"ok": True, "version": version}
     except KeyError:
         raise HTTPException(status_code=404, detail="session not found")
+    except DocumentConflict as exc:
+        raise HTTPException(status_code=409, detail={"error": str(exc), "version": exc.current_version})
     except RuntimeError as exc:
         raise HTTPException(status_code=500, detail=str(exc))
 
 
+@router.get("/session/{session_id}/document")
+def get_document(session_id: str, version: Optional[int] = Query(None, ge=1)):
+    try:
+        meta = svc_get_meta(session_id)
+        if meta is None:
+            raise KeyError("session not found")
+        html = svc_get_document(session_id, meta=meta, version=version)
+    except KeyError as exc:
+        raise HTTPException(status_code=404, detail=str(exc).strip("'"))
+    except RuntimeError as exc:
+        raise HTTPException(status_code=500, detail=str(exc))
+    return {"session_id": session_id, "version": version or meta.get("document_version") or 0, "html": html}
+
+
+@router.get("/session/{session_id}/document/versions")
+def list_document_versions(session_id: str):
+    try:
+        return {"session_id": session_id, "versions": svc_list_document_versions(session_id)}
+    except KeyError:
+        raise HTTPException(status_code=404, detail="session not found")
+
+
 @router.post("/session/{session_id}/title")
-async def set_title(session_id: str, payload: dict):
-    meta = SESSION_META.get(session_id)
-    if meta is None:
+def set_title(session_id: str, payload: dict):
+    if svc_get_meta(session_id) is None:
         raise HTTPException(status_code=404, detail="session not found")
     title = str(payload.get("title", "")).strip()
     if not title:
         raise HTTPException(status_code=400, detail="title required")
-    meta["document_title"] = title
+    try:
+        svc_set_title(session_id, title)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="session not found")
     return {"ok": True, "title": title}
 
 
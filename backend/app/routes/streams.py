@@ -0,0 +1,41 @@
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException, Query, Request
+
+from ..encoders import negotiate, stream_response
+from ..services.streams import get_stream_registry
+
+router = APIRouter()
+
+
+@router.get("/stream/{stream_id}")
+async def resume_stream(
+    stream_id: str,
+    request: Request,
+    offset: Optional[int] = Query(None, ge=0),
+    chars: Optional[int] = Query(None, ge=0),
+):
+    """Replay a stream from an event id (`offset` or Last-Event-ID), or from `chars` characters of text already received."""
+    run = get_stream_registry().get(stream_id)
+    if run is None:
+        raise HTTPException(status_code=404, detail="stream not found or expired")
+    skip = 0
+    if chars is not None:
+        # Plain-text and legacy JSON responses carry no event ids; their clients count characters
+        try:
+            offset, skip = await run.locate(chars)
+        except ValueError as exc:
+            raise HTTPException(status_code=400, detail=str(exc))
+    elif offset is None:
+        last_event_id = request.headers.get("last-event-id", "0").strip() or "0"
+        if not last_event_id.isdigit():
+            raise HTTPException(status_code=400, detail="invalid Last-Event-ID")
+        offset = int(last_event_id)
+    if offset > len(run.buffer):
+        raise HTTPException(status_code=400, detail="offset is beyond the end of the stream")
+    return stream_response(
+        run.subscribe(offset, skip_chars=skip),
+        negotiate(request, "ndjson"),
+        headers={"X-Stream-Id": stream_id},
+        first_id=offset,
+    )
@@ -0,0 +1,104 @@
+import logging
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+from .config import Settings, get_settings
+from .metrics import LLM_ROUTES
+from .tokens import count_message_tokens
+
+logger = logging.getLogger(__name__)
+
+MODEL_TIERS = ("small", "large")
+
+
+@dataclass(frozen=True)
+class ModelRoute:
+    """The model and completion budget chosen for one upstream call."""
+
+    stage: str
+    tier: str
+    model: str
+    max_tokens: int
+    input_tokens: int
+    output_tokens: int
+    reason: str
+
+
+def choose_route(
+    stage: str,
+    *,
+    input_tokens: int,
+    output_tokens: int,
+    ceiling: int,
+    settings: Optional[Settings] = None,
+    record: bool = True,
+    pinned: Optional[str] = None,
+    sized: bool = True,
+) -> ModelRoute:
+    """Pick the tier for `stage` from MODEL_ROUTES and bound max_tokens by the expected output.
+
+    `output_tokens` is the caller's estimate of the reply; max_tokens is that
+    times ROUTING_OUTPUT_HEADROOM plus a small margin, never above `ceiling`.
+    With `sized` false max_tokens is `ceiling` and the estimate only picks
+    the tier, for replies whose length cannot be known up front.
+    Without OPENAI_SMALL_MODEL both tiers use OPENAI_MODEL. With `record`
+    false the decision is neither logged nor counted (a lookup, not a call).
+    `pinned` is the tier an `auto` stage chose earlier for the same session:
+    it is kept so the upstream prompt cache stays warm, except that a turn
+    too large for the small tier moves it up to large.
+    """
+    settings = settings or get_settings()
+    rule = settings.model_routes.get(stage, "large")
+    total = input_tokens + output_tokens
+    if rule == "auto":
+        tier = "small" if total <= settings.routing_small_max_tokens else "large"
+        reason = f"auto: {total} {'<=' if tier == 'small' else '>'} {settings.routing_small_max_tokens} tokens"
+        if pinned in MODEL_TIERS and pinned != tier:
+            if pinned == "large":
+                tier, reason = pinned, "pinned for the session"
+            else:
+                reason += " (moved up from the session's pinned small tier)"
+    else:
+        tier, reason = rule, "rule"
+    model = settings.openai_model
+    if tier == "small":
+        if settings.openai_small_model:
+            model = settings.openai_small_model
+        else:
+            reason += " (no OPENAI_SMALL_MODEL)"
+    max_tokens = max(1, min(ceiling, int(output_tokens * settings.routing_output_headroom) + 256) if sized else ceiling)
+    route = ModelRoute(stage, tier, model, max_tokens, input_tokens, output_tokens, reason)
+    if not record:
+        return route
+    LLM_ROUTES.inc(stage=stage, tier=tier)
+    logger.info(
+        "model route stage=%s tier=%s model=%s input_tokens=%d output_tokens=%d max_tokens=%d reason=%s",
+        stage, tier, model, input_tokens, output_tokens, max_tokens, reason,
+    )
+    return route
+
+
+def route_messages(
+    stage: str,
+    messages: Iterable,
+    *,
+    output_tokens: int,
+    ceiling: int,
+    settings: Optional[Settings] = None,
+    record: bool = True,
+    pinned: Optional[str] = None,
+    sized: bool = True,
+) -> ModelRoute:
+    """`choose_route` with the input measured from chat messages (dicts or LangChain messages)."""
+    settings = settings or get_settings()
+    texts = [m.get("content", "") if isinstance(m, dict) else m for m in messages]
+    return choose_route(
+        stage,
+        input_tokens=count_message_tokens(texts, settings.openai_model),
+        output_tokens=output_tokens,
+        ceiling=ceiling,
+        settings=settings,
+        record=record,
+        pinned=pinned,
+        sized=sized,
+    )
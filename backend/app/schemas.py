@@ -1,4 +1,4 @@
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 from pydantic import BaseModel, Field
 
 
@@ -7,6 +7,18 @@ class GenerateRequest(BaseModel):
     company_name: Optional[str] = Field(None, description="Optional company or product name to include")
     jurisdiction: Optional[str] = Field(None, description="Optional governing law or location context")
     tone: Optional[str] = Field(None, description="Optional tone/style guidance")
+    mode: Optional[str] = Field(None, description="'single' (default) streams one completion; 'parallel' outlines first and drafts sections concurrently")
+
+
+class BatchItem(GenerateRequest):
+    id: Optional[str] = Field(None, description="Caller's id for this item; defaults to its position in the batch")
+
+
+class BatchGenerateRequest(BaseModel):
+    items: List[BatchItem] = Field(..., min_length=1)
+    concurrency: Optional[int] = Field(None, ge=1, description="Items generated at once; capped by BATCH_CONCURRENCY")
+    skip_ids: List[str] = Field(default_factory=list, description="Ids already done by an earlier run; they are reported as skipped")
+    job: bool = Field(False, description="Run in the background and write results to disk instead of streaming them")
 
 
 class StartSessionRequest(BaseModel):
@@ -22,10 +34,12 @@ class ChatMessage(BaseModel):
 class ChatRequest(BaseModel):
     session_id: str
     message: ChatMessage
+    mode: Optional[str] = Field(None, description="'full' (default) returns the whole document, 'patch' returns section patches")
 
 
 class SetDocumentRequest(BaseModel):
     html: str = Field(..., description="The current base HTML document to modify")
     title: Optional[str] = None
+    base_version: Optional[int] = Field(None, description="Reject the write unless the stored document is still at this version")
 
 
@@ -0,0 +1,317 @@
+import asyncio
+import json
+import pathlib
+import re
+import shutil
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from ..admission import AdmissionRejected, admit_patiently
+from ..config import Settings, get_settings
+from ..encoders import dumps
+from ..metrics import BATCH_ITEMS
+from ..tokens import count_tokens
+from ..utils import CircuitOpenError, is_retryable, spawn_background
+from .generation import open_contract_stream
+
+
+@dataclass
+class BatchEntry:
+    id: str
+    request: Any
+
+
+def batch_entries(items: List[Any]) -> List[BatchEntry]:
+    """Pair each item with its id (its position when the caller gave none); duplicate ids are a ValueError."""
+    entries: List[BatchEntry] = []
+    seen = set()
+    for index, item in enumerate(items):
+        item_id = item.id if item.id is not None else str(index)
+        if item_id in seen:
+            raise ValueError(f"duplicate item id: {item_id}")
+        seen.add(item_id)
+        entries.append(BatchEntry(item_id, item))
+    return entries
+
+
+def batch_concurrency(requested: Optional[int], settings: Settings) -> int:
+    """Items in flight at once: the request's wish, capped by BATCH_CONCURRENCY and the per-client admission limit."""
+    limit = settings.batch_concurrency
+    if settings.admission_per_client:
+        # More would only collect client_concurrency rejections
+        limit = min(limit, settings.admission_per_client)
+    return max(1, min(requested or limit, limit))
+
+
+def _retryable(exc: BaseException) -> bool:
+    return isinstance(exc, (AdmissionRejected, CircuitOpenError)) or is_retryable(exc)
+
+
+# At most one `progress` event per item in this many seconds, unless BATCH_PROGRESS_CHARS have arrived
+PROGRESS_INTERVAL = 0.5
+
+
+async def _generate(entry: BatchEntry, *, client: str, emit: Callable[[Dict[str, Any]], None], settings: Settings) -> Dict[str, Any]:
+    started = time.monotonic()
+    ticket = None
+    try:
+        # Same reservation as /api/generate: the prompt plus the completion ceiling
+        tokens = count_tokens(entry.request.prompt, settings.openai_model) + settings.openai_max_tokens
+        ticket = await admit_patiently(client, tokens, deadline=settings.batch_admission_wait)
+        opened = await open_contract_stream(data=entry.request)
+        if opened.run is None:
+            ticket.release(refund=True)
+        else:
+            # Held until the upstream run ends, even if this batch is cancelled first
+            opened.run.add_done_callback(ticket.release)
+            ticket = None
+        emit({"type": "start", "id": entry.id, "cache": opened.status, "stream_id": opened.stream_id})
+        parts: List[str] = []
+        size = reported = 0
+        reported_at = 0.0
+        async for delta in opened.stream:
+            parts.append(delta)
+            size += len(delta)
+            now = time.monotonic()
+            if size - reported >= settings.batch_progress_chars or now - reported_at >= PROGRESS_INTERVAL:
+                emit({"type": "progress", "id": entry.id, "chars": size})
+                reported, reported_at = size, now
+        result = {"type": "result", "id": entry.id, "status": "ok", "cache": opened.status, "markdown": "".join(parts)}
+    except Exception as exc:
+        result = {
+            "type": "result",
+            "id": entry.id,
+            "status": "error",
+            "error": str(exc) or type(exc).__name__,
+            "retryable": _retryable(exc),
+        }
+    finally:
+        if ticket is not None:
+            ticket.release()
+    result["seconds"] = round(time.monotonic() - started, 3)
+    BATCH_ITEMS.inc(outcome=result["status"])
+    return result
+
+
+async def run_batch(
+    entries: List[BatchEntry],
+    *,
+    client: str,
+    concurrency: int,
+    skip_ids: Optional[List[str]] = None,
+    settings: Optional[Settings] = None,
+) -> AsyncIterator[Dict[str, Any]]:
+    """Generate every entry with at most `concurrency` in flight, yielding events as they happen.
+
+    Events are `start`, `progress` (characters so far, throttled by
+    BATCH_PROGRESS_CHARS and PROGRESS_INTERVAL) and `result` per item,
+    in completion order, then one `summary`. A failed item is reported as a
+    `result` with `status: "error"` and does not stop the rest; `retryable`
+    says whether running it again may help. Entries in `skip_ids` are not run.
+    Items share the pooled upstream clients, the response cache and the
+    admission limits of the caller's client id.
+    """
+    settings = settings or get_settings()
+    skip = set(skip_ids or ())
+    events: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    pending = [entry for entry in entries if entry.id not in skip]
+
+    async def _run(entry: BatchEntry):
+        async with semaphore:
+            events.put_nowait(await _generate(entry, client=client, emit=events.put_nowait, settings=settings))
+
+    tasks = [asyncio.ensure_future(_run(entry)) for entry in pending]
+    ok: List[str] = []
+    failed: List[str] = []
+    try:
+        while len(ok) + len(failed) < len(pending):
+            event = await events.get()
+            if event["type"] == "result":
+                (ok if event["status"] == "ok" else failed).append(event["id"])
+            yield event
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    yield {
+        "type": "summary",
+        "total": len(entries),
+        "ok": ok,
+        "failed": failed,
+        "skipped": [entry.id for entry in entries if entry.id in skip],
+    }
+
+
+_JOB_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+
+def _append(path: pathlib.Path, data: bytes):
+    with path.open("ab") as out:
+        out.write(data)
+
+
+class BatchJobs:
+    """Batch runs in the background, with their results on disk.
+
+    Each job is a directory holding `request.json` (the items and settings
+    it was started with) and `results.ndjson`, one `result` event per line
+    appended as items finish. A job that was interrupted (or had failures)
+    can be resumed: only items without an `ok` result run again. `start`
+    and `resume` do their file I/O in worker threads; the other methods
+    block and belong in a thread or a plain `def` route. Jobs that
+    are not running and were last written more than `retention_seconds`
+    ago are deleted by `prune`, which `start` runs in the background at
+    most once per PRUNE_INTERVAL.
+    """
+
+    PRUNE_INTERVAL = 3600.0
+
+    def __init__(self, directory: str, *, retention_seconds: float = 0):
+        self.directory = pathlib.Path(directory)
+        self.retention_seconds = retention_seconds
+        self._running: Dict[str, "asyncio.Task[None]"] = {}
+        self._pruned_at = 0.0
+
+    def _path(self, job_id: str) -> pathlib.Path:
+        if not _JOB_ID_RE.match(job_id):
+            raise KeyError("job not found")
+        path = self.directory / job_id
+        if not (path / "request.json").exists():
+            raise KeyError("job not found")
+        return path
+
+    def results_path(self, job_id: str) -> pathlib.Path:
+        return self._path(job_id) / "results.ndjson"
+
+    def _results(self, job_id: str) -> Dict[str, Dict[str, Any]]:
+        """The latest result per item id."""
+        latest: Dict[str, Dict[str, Any]] = {}
+        path = self.results_path(job_id)
+        if path.exists():
+            with path.open("rb") as fh:
+                for line in fh:
+                    if line.strip():
+                        event = json.loads(line)
+                        latest[event["id"]] = event
+        return latest
+
+    def _create(self, request: Dict[str, Any]) -> str:
+        job_id = uuid.uuid4().hex
+        path = self.directory / job_id
+        path.mkdir(parents=True)
+        (path / "request.json").write_bytes(dumps(request))
+        return job_id
+
+    async def start(self, items: List[Dict[str, Any]], *, client: str, concurrency: int, skip_ids: List[str]) -> str:
+        request = {"items": items, "client": client, "concurrency": concurrency, "skip_ids": skip_ids, "created_at": time.time()}
+        job_id = await asyncio.to_thread(self._create, request)
+        await self._launch(job_id)
+        if self.retention_seconds and time.time() - self._pruned_at > self.PRUNE_INTERVAL:
+            self._pruned_at = time.time()
+            spawn_background(asyncio.to_thread(self.prune), name="batch:prune")
+        return job_id
+
+    def prune(self) -> List[str]:
+        """Delete the jobs past retention that are not running; returns their ids."""
+        if not self.retention_seconds:
+            return []
+        cutoff = time.time() - self.retention_seconds
+        removed: List[str] = []
+        for path in self.directory.glob("*"):
+            if not _JOB_ID_RE.match(path.name) or path.name in self._running:
+                continue
+            try:
+                written = max(child.stat().st_mtime for child in [path, *path.iterdir()])
+            except (OSError, ValueError):
+                continue
+            if written < cutoff:
+                shutil.rmtree(path, ignore_errors=True)
+                removed.append(path.name)
+        return removed
+
+    def _remaining(self, job_id: str) -> List[str]:
+        done = {item_id for item_id, event in self._results(job_id).items() if event["status"] == "ok"}
+        request = json.loads((self._path(job_id) / "request.json").read_bytes())
+        return [item["id"] for item in request["items"] if item["id"] not in done and item["id"] not in request["skip_ids"]]
+
+    async def resume(self, job_id: str) -> List[str]:
+        """Run the items of `job_id` that have no `ok` result yet; returns their ids."""
+        if job_id in self._running:
+            raise RuntimeError("job is still running")
+        remaining = await asyncio.to_thread(self._remaining, job_id)
+        if remaining:
+            await self._launch(job_id, skip_done=True)
+        return remaining
+
+    def _plan(self, job_id: str, skip_done: bool) -> Tuple[pathlib.Path, Dict[str, Any], List[str]]:
+        path = self._path(job_id)
+        request = json.loads((path / "request.json").read_bytes())
+        skip = list(request["skip_ids"])
+        if skip_done:
+            skip += [item_id for item_id, event in self._results(job_id).items() if event["status"] == "ok"]
+        return path, request, skip
+
+    async def _launch(self, job_id: str, *, skip_done: bool = False):
+        from ..schemas import BatchItem
+
+        path, request, skip = await asyncio.to_thread(self._plan, job_id, skip_done)
+        entries = [BatchEntry(item["id"], BatchItem(**item)) for item in request["items"]]
+        results = path / "results.ndjson"
+
+        async def _run():
+            try:
+                async for event in run_batch(entries, client=request["client"], concurrency=request["concurrency"], skip_ids=skip):
+                    if event["type"] == "result":
+                        await asyncio.to_thread(_append, results, dumps(event) + b"\n")
+            finally:
+                self._running.pop(job_id, None)
+
+        # Checked again after the reads above: a concurrent resume may have launched it meanwhile
+        if job_id in self._running:
+            raise RuntimeError("job is still running")
+        self._running[job_id] = spawn_background(_run(), name=f"batch:{job_id[:12]}")
+
+    def status(self, job_id: str) -> Dict[str, Any]:
+        request = json.loads((self._path(job_id) / "request.json").read_bytes())
+        results = self._results(job_id)
+        items = {}
+        for item in request["items"]:
+            item_id = item["id"]
+            event = results.get(item_id)
+            if item_id in request["skip_ids"]:
+                items[item_id] = "skipped"
+            elif event is None:
+                items[item_id] = "pending"
+            else:
+                items[item_id] = event["status"]
+        running = job_id in self._running
+        waiting = sum(1 for state in items.values() if state == "pending")
+        return {
+            "job_id": job_id,
+            "state": "running" if running else "interrupted" if waiting else "done",
+            "total": len(items),
+            "ok": sum(1 for state in items.values() if state == "ok"),
+            "failed": sum(1 for state in items.values() if state == "error"),
+            "pending": waiting,
+            "items": items,
+        }
+
+
+_JOBS: Optional[BatchJobs] = None
+
+
+def get_batch_jobs() -> BatchJobs:
+    global _JOBS
+    settings = get_settings()
+    if not settings.batch_jobs_dir:
+        raise RuntimeError("batch jobs are disabled (BATCH_JOBS_DIR is empty)")
+    if _JOBS is None:
+        _JOBS = BatchJobs(settings.batch_jobs_dir, retention_seconds=settings.batch_job_retention_seconds)
+    else:
+        # One registry for the process, so a settings reload does not forget the jobs still running
+        _JOBS.directory = pathlib.Path(settings.batch_jobs_dir)
+        _JOBS.retention_seconds = settings.batch_job_retention_seconds
+    return _JOBS
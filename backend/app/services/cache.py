@@ -0,0 +1,196 @@
+import asyncio
+import hashlib
+import json
+import os
+import pathlib
+import threading
+import time
+import unicodedata
+import zlib
+from collections import OrderedDict
+from typing import Any, AsyncGenerator, Dict, Optional
+
+from ..config import Settings, get_settings
+
+
+# Cached documents are replayed in slices of this size
+REPLAY_CHUNK_CHARS = 4096
+
+# A sweep trims the disk tier to this share of its budget, so the next few writes do not sweep again
+DISK_SWEEP_TARGET = 0.9
+
+
+def _norm(value: Optional[str], *, casefold: bool = False) -> Optional[str]:
+    if value is None:
+        return None
+    text = " ".join(unicodedata.normalize("NFC", value).split())
+    if casefold:
+        text = text.casefold()
+    return text or None
+
+
+def contract_cache_key(data: Any, settings: Settings, *, model: Optional[str] = None) -> str:
+    """Content address of a generation: the normalized request plus everything that shapes the output."""
+    payload = {
+        "prompt": _norm(data.prompt),
+        "company_name": _norm(data.company_name),
+        "jurisdiction": _norm(data.jurisdiction, casefold=True),
+        "tone": _norm(data.tone, casefold=True),
+        "mode": getattr(data, "mode", None) or "single",
+        "model": model or settings.openai_model,
+        "max_tokens": settings.openai_max_tokens,
+        "prompts": settings.templates.digest,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Two-tier cache of finished generations: an in-memory LRU bounded by bytes, then zlib files on disk.
+
+    The disk tier is bounded too: once the files written exceed
+    `max_disk_bytes`, a sweep drops expired files and then the least
+    recently written ones. Sweeps also run every `ttl_seconds`, so expired
+    entries that are never read again do not linger.
+    """
+
+    def __init__(self, *, max_bytes: int, directory: Optional[str] = None, ttl_seconds: float = 0, max_disk_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl_seconds = ttl_seconds
+        self.directory = pathlib.Path(directory) if directory else None
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._bytes = 0
+        # Bytes on disk as of the last sweep plus everything written since; None until the first sweep
+        self._disk_bytes: Optional[int] = None
+        self._swept_at = 0.0
+        self._disk_lock = threading.Lock()
+        if self.directory is not None:
+            try:
+                self.directory.mkdir(parents=True, exist_ok=True)
+            except OSError:
+                self.directory = None
+
+    def _expired(self, stored_at: float) -> bool:
+        return bool(self.ttl_seconds) and time.time() - stored_at > self.ttl_seconds
+
+    def _remember(self, key: str, text: str, stored_at: float):
+        size = len(text.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._bytes -= old[2]
+        self._memory[key] = (text, stored_at, size)
+        self._bytes += size
+        while self._bytes > self.max_bytes and self._memory:
+            _, (_, _, evicted) = self._memory.popitem(last=False)
+            self._bytes -= evicted
+
+    def _path(self, key: str) -> pathlib.Path:
+        assert self.directory is not None
+        return self.directory / key[:2] / f"{key}.z"
+
+    def _read_disk(self, key: str) -> Optional[tuple]:
+        path = self._path(key)
+        try:
+            stored_at = path.stat().st_mtime
+            if self._expired(stored_at):
+                path.unlink(missing_ok=True)
+                return None
+            return zlib.decompress(path.read_bytes()).decode("utf-8"), stored_at
+        except (OSError, zlib.error, UnicodeDecodeError):
+            return None
+
+    def _write_disk(self, key: str, text: str):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        blob = zlib.compress(text.encode("utf-8"), 6)
+        tmp.write_bytes(blob)
+        os.replace(tmp, path)
+        with self._disk_lock:
+            if self._disk_bytes is not None:
+                self._disk_bytes += len(blob)
+            over = self._disk_bytes is None or bool(self.max_disk_bytes) and self._disk_bytes > self.max_disk_bytes
+            stale = bool(self.ttl_seconds) and time.time() - self._swept_at > self.ttl_seconds
+            if over or stale:
+                self._sweep()
+
+    def _sweep(self):
+        # Caller holds _disk_lock; other workers sharing the directory may race us, hence the missing_ok
+        assert self.directory is not None
+        files = []
+        for path in self.directory.glob("*/*.z"):
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            if self._expired(st.st_mtime):
+                path.unlink(missing_ok=True)
+            else:
+                files.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in files)
+        if self.max_disk_bytes and total > self.max_disk_bytes:
+            files.sort()
+            target = self.max_disk_bytes * DISK_SWEEP_TARGET
+            for _, size, path in files:
+                if total <= target:
+                    break
+                path.unlink(missing_ok=True)
+                total -= size
+        self._disk_bytes = total
+        self._swept_at = time.time()
+
+    async def get(self, key: str) -> Optional[str]:
+        hit = self._memory.get(key)
+        if hit is not None:
+            if not self._expired(hit[1]):
+                self._memory.move_to_end(key)
+                return hit[0]
+            self._bytes -= self._memory.pop(key)[2]
+        if self.directory is None:
+            return None
+        found = await asyncio.to_thread(self._read_disk, key)
+        if found is None:
+            return None
+        self._remember(key, found[0], found[1])
+        return found[0]
+
+    async def put(self, key: str, text: str):
+        self._remember(key, text, time.time())
+        if self.directory is not None:
+            try:
+                await asyncio.to_thread(self._write_disk, key, text)
+            except OSError:
+                # The memory tier still serves this entry
+                pass
+
+    def stats(self) -> Dict[str, int]:
+        return {"entries": len(self._memory), "bytes": self._bytes, "disk_bytes": self._disk_bytes or 0}
+
+
+async def replay(text: str) -> AsyncGenerator[str, None]:
+    for i in range(0, len(text), REPLAY_CHUNK_CHARS):
+        yield text[i:i + REPLAY_CHUNK_CHARS]
+
+
+_CACHE: Optional[ResponseCache] = None
+
+
+def init_response_cache(settings: Settings) -> Optional[ResponseCache]:
+    global _CACHE
+    _CACHE = None
+    if settings.generate_cache_enabled:
+        _CACHE = ResponseCache(
+            max_bytes=settings.generate_cache_memory_mb * 1024 * 1024,
+            directory=settings.generate_cache_dir or None,
+            ttl_seconds=settings.generate_cache_ttl_seconds,
+            max_disk_bytes=settings.generate_cache_disk_mb * 1024 * 1024,
+        )
+    return _CACHE
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    if _CACHE is None and get_settings().generate_cache_enabled:
+        return init_response_cache(get_settings())
+    return _CACHE
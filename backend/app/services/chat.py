@@ -1,91 +1,168 @@
-import os
-from typing import AsyncGenerator, Optional
-
-try:
-    from langchain_openai import ChatOpenAI  # type: ignore
-    from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder  # type: ignore
-    from langchain_core.runnables.history import RunnableWithMessageHistory  # type: ignore
-    from langchain_community.chat_message_histories import ChatMessageHistory  # type: ignore
-    from langchain.callbacks import AsyncIteratorCallbackHandler  # type: ignore
-except Exception:  # pragma: no cover
-    ChatOpenAI = None  # type: ignore
-    ChatPromptTemplate = None  # type: ignore
-    MessagesPlaceholder = None  # type: ignore
-    RunnableWithMessageHistory = None  # type: ignore
-    ChatMessageHistory = None  # type: ignore
-    AsyncIteratorCallbackHandler = None  # type: ignore
-
-from ..config import load_settings, DEFAULT_SYSTEM_PROMPT
+import asyncio
+from contextlib import aclosing
+from typing import Any, AsyncGenerator, Dict, Optional
+
+from ..config import get_settings
+from ..clients import get_clients
+from ..metrics import instrument_stream, record_usage
+from ..routing import route_messages
+from ..tokens import count_tokens
+from ..utils import module_available
+from .sections import PatchStreamParser
+from .session import DocumentConflict, apply_document_patches
+from .store import get_store
+from .history import prepare_history
+from .prompts import build_chat_prompt, record_session_usage
 
 
 def ensure_langchain():
-    if ChatOpenAI is None:
+    # LangChain itself is imported on first use, not with this module
+    if not module_available("langchain_core"):
         raise RuntimeError("LangChain not available on server")
 
 
-async def stream_chat(*, session_id: str, input_text: str, base_doc: Optional[str] = None, system_prompt: Optional[str] = None, get_history_cb=None) -> AsyncGenerator[str, None]:
-    ensure_langchain()
-    settings = load_settings()
+_CHAT_PROMPTS: Dict[bool, Any] = {}
 
-    prompts = settings.prompts or {}
-    system_text = system_prompt or prompts.get("system", {}).get("contract_generation") or DEFAULT_SYSTEM_PROMPT
-    if base_doc:
-        editing_block = prompts.get("system", {}).get("editing_context") or (
-            "You are continuing an editing session. The current base Markdown document is provided below.\n"
-            "Apply user instructions as surgical edits to this base, preserving headings, numbering, anchors, and tables.\n"
-            "Return ONLY updated Markdown (no backticks, no code fences).\n"
-        )
-        system_text = (
-            system_text + "\n\n" + editing_block + "\n\n<BASE_DOCUMENT>\n" + base_doc + "\n</BASE_DOCUMENT>\n"
-        )
-
-    prompt = ChatPromptTemplate.from_messages(
-        [
-            ("system", system_text),
-            MessagesPlaceholder(variable_name="history"),
-            ("human", "{input}"),
-        ]
-    )
 
-    llm = ChatOpenAI(
-        model=settings.openai_model,
-        temperature=0.2,
-        streaming=True,
-    )
+def _chat_prompt(with_document: bool = True):
+    prompt = _CHAT_PROMPTS.get(with_document)
+    if prompt is None:
+        from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder  # type: ignore
 
-    callback = AsyncIteratorCallbackHandler()
-    chain = prompt | llm
+        # Stable to volatile, so the upstream prompt cache covers instructions, document and earlier turns.
+        # Texts are variables so document braces are never parsed as template fields.
+        parts: list = [("system", "{system}")]
+        if with_document:
+            parts.append(("system", "{document}"))
+        parts += [MessagesPlaceholder(variable_name="history"), ("human", "{input}")]
+        prompt = _CHAT_PROMPTS[with_document] = ChatPromptTemplate.from_messages(parts)
+    return prompt
 
-    chain_with_history = RunnableWithMessageHistory(
-        chain,
-        get_history_cb,
-        input_messages_key="input",
-        history_messages_key="history",
-        output_messages_key="output",
-    )
 
-    async def _consumer():
-        try:
-            await chain_with_history.ainvoke(
-                {"input": input_text},
-                config={
-                    "configurable": {"session_id": session_id},
-                    "callbacks": [callback],
-                },
-            )
-        except Exception as exc:  # pragma: no cover
-            await callback.on_llm_error(exc, run_id=None)
-        finally:
-            try:
-                callback.done.set()  # type: ignore[attr-defined]
-            except Exception:
-                pass
+def _pin_tier(session_id: str, previous: Optional[str], tier: str):
+    try:
+        get_store().update_meta_if(session_id, {"chat_tier": previous}, chat_tier=tier)
+    except KeyError:
+        pass
 
-    import asyncio
 
-    asyncio.create_task(_consumer())
+async def stream_chat(*, session_id: str, input_text: str, base_doc: Optional[str] = None, base_version: Optional[int] = None, system_prompt: Optional[str] = None, get_history_cb=None, mode: str = "full") -> AsyncGenerator[str, None]:
+    """Stream one chat turn straight from the upstream token stream.
 
-    async for token in callback.aiter():
-        yield token.get("content") if isinstance(token, dict) else str(token)
+    The upstream request lives exactly as long as this generator: if the
+    consumer stops iterating (e.g. the HTTP client disconnected), closing the
+    generator closes the upstream stream. The turn is appended to the session
+    history only once the model has finished answering.
+    """
+    ensure_langchain()
+    settings = get_settings()
 
+    templates = settings.templates
+    system_text = system_prompt or templates.contract_generation
+    if base_doc:
+        editing_block = templates.patch_editing if mode == "patch" else templates.editing_context
+        system_text = system_text + "\n\n" + editing_block
+    # Store reads and writes below can block (SQL), so they run in worker threads
+    prompt = await asyncio.to_thread(
+        build_chat_prompt,
+        session_id=session_id,
+        system_text=system_text,
+        base_doc=base_doc,
+        base_version=base_version,
+        input_text=input_text,
+        settings=settings,
+        # Patch turns only return the sections they change, so they can work from an excerpt
+        selective=mode == "patch",
+    )
 
+    history = await asyncio.to_thread(get_history_cb, session_id)
+    window = await prepare_history(session_id, await asyncio.to_thread(lambda: history.messages), settings)
+    stage = f"chat_{mode}"
+    # Full turns rewrite the whole document; patch turns return only the sections they touch
+    working = prompt.input if prompt.context == "excerpt" else base_doc
+    doc_tokens = count_tokens(working or "", settings.openai_model)
+    if mode == "patch":
+        expected = max(512, doc_tokens // 2)
+    else:
+        expected = doc_tokens + 256 if base_doc else settings.openai_max_tokens
+    store = get_store()
+    pinned = (await asyncio.to_thread(store.get_meta, session_id) or {}).get("chat_tier")
+    route = route_messages(
+        stage,
+        [prompt.system, prompt.document or "", *window.messages, prompt.input],
+        output_tokens=expected,
+        ceiling=settings.openai_max_tokens,
+        settings=settings,
+        pinned=pinned,
+        # The estimate only picks the tier: an edit may grow the document well past it, and a
+        # reply cut at max_tokens would be a truncated document or a lost patch
+        sized=False,
+    )
+    if route.tier != pinned:
+        # Later turns stay on this tier, so the cached prompt prefix keeps matching
+        await asyncio.to_thread(_pin_tier, session_id, pinned, route.tier)
+    llm = get_clients().chat_model(model=route.model, temperature=0.2).bind(max_tokens=route.max_tokens)
+    chain = _chat_prompt(prompt.document is not None) | llm
+    variables = {"system": prompt.system, "history": window.messages, "input": prompt.input}
+    if prompt.document is not None:
+        variables["document"] = prompt.document
+
+    parts = []
+    usage = None
+    stream = instrument_stream(chain.astream(variables), stage=stage)
+    finish_reason = None
+    async with aclosing(stream):
+        async for chunk in stream:
+            usage = getattr(chunk, "usage_metadata", None) or usage
+            finish_reason = (getattr(chunk, "response_metadata", None) or {}).get("finish_reason") or finish_reason
+            token = chunk.content if isinstance(chunk.content, str) else ""
+            if token:
+                parts.append(token)
+                yield token
+
+    await asyncio.to_thread(record_session_usage, session_id, *record_usage(usage, stage=stage))
+    if finish_reason == "length":
+        # Nothing is recorded or applied from a reply the token limit cut short
+        raise RuntimeError("the reply was cut off at the max_tokens limit")
+
+    from langchain_core.messages import AIMessage, HumanMessage  # type: ignore
+
+    await asyncio.to_thread(history.add_messages, [HumanMessage(content=input_text), AIMessage(content="".join(parts))])
+
+
+async def stream_chat_patches(*, session_id: str, input_text: str, base_doc: str, base_version: Optional[int] = None, system_prompt: Optional[str] = None, get_history_cb=None) -> AsyncGenerator[Dict[str, Any], None]:
+    """Patch-mode chat turn: yields each section patch as soon as the model closes it.
+
+    Once the model is done, the patches are applied to the latest stored
+    document and a final `document` event reports the new version and any
+    patches whose target section could not be found. If they cannot be
+    stored (the session is gone, or concurrent writers kept winning) the
+    final event is an `error` instead.
+    """
+    parser = PatchStreamParser()
+    patches = []
+    stream = stream_chat(
+        session_id=session_id,
+        input_text=input_text,
+        base_doc=base_doc,
+        base_version=base_version,
+        system_prompt=system_prompt,
+        get_history_cb=get_history_cb,
+        mode="patch",
+    )
+    async with aclosing(stream):
+        async for token in stream:
+            for patch in parser.feed(token):
+                patches.append(patch)
+                yield {"type": "patch", **patch.to_dict()}
+
+    try:
+        version, failed = await asyncio.to_thread(apply_document_patches, session_id, patches)
+    except DocumentConflict as exc:
+        # Other writers kept winning; the patches above were streamed but not stored
+        yield {"type": "error", "error": f"patches not applied: {exc}", "version": exc.current_version}
+        return
+    except KeyError:
+        yield {"type": "error", "error": "patches not applied: session not found"}
+        return
+    yield {"type": "document", "version": version, "applied": len(patches) - len(failed), "failed": [p.to_dict() for p in failed]}
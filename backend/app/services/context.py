@@ -0,0 +1,141 @@
+import math
+import re
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Set
+
+from .documents import section_index
+from .sections import _normalize
+
+
+# "section 3.2", "clause 7", "§ 4", "art. 12"; bare dotted numbers like 3.2 count too
+_REFERENCE_RE = re.compile(r"(?:\bsections?|\bclauses?|\barticles?|\bart\.|\bsec\.|§)\s*(\d+(?:\.\d+)*)|\b(\d+\.\d+(?:\.\d+)*)\b", re.IGNORECASE)
+# Requests that touch the whole document cannot be answered from an excerpt
+_WHOLE_DOCUMENT_RE = re.compile(
+    r"\b(whole|entire|every|all)\s+(document|contract|agreement|sections?|clauses?|terms)\b|\bthroughout\b|\brenumber|\breorder|\bconsisten",
+    re.IGNORECASE,
+)
+_TOC_RE = re.compile(r"\b(table of )?contents\b", re.IGNORECASE)
+_TERMS_RE = re.compile(r"\bdefinitions?\b|\bdefined terms\b|\binterpretation\b", re.IGNORECASE)
+_WORD_RE = re.compile(r"[a-z][a-z'-]{3,}")
+_STOPWORDS = frozenset(
+    "this that with from into have will shall must should would could make change update edit please section clause "
+    "article document contract agreement terms more less about under over they them their there these those which what "
+    "when where also only such than then user users".split()
+)
+
+
+@dataclass
+class ContextSelection:
+    """What a chat turn sends of the document: the whole text, or an excerpt of selected sections."""
+
+    text: str
+    full: bool
+    reason: str
+    sections: List[str] = field(default_factory=list)
+
+
+def _references(query: str) -> Set[str]:
+    return {a or b for a, b in _REFERENCE_RE.findall(query)}
+
+
+def _words(text: str) -> Set[str]:
+    return {w for w in _WORD_RE.findall(text.lower()) if w not in _STOPWORDS}
+
+
+def _label(entry: Dict[str, Any]) -> str:
+    return entry["heading"] or "(preamble)"
+
+
+def select_context(
+    document: str,
+    query: str,
+    *,
+    index: Optional[List[Dict[str, Any]]] = None,
+    budget_chars: int,
+    min_chars: int,
+    max_share: float = 0.6,
+) -> ContextSelection:
+    """Pick the sections of `document` that an edit request needs.
+
+    Sections the request names (by number or heading) are included with
+    their subsections, then the preamble, the table of contents and the
+    definitions, then the sections whose text best matches the request's
+    words while `budget_chars` allows. Omitted sections are replaced by one
+    line listing their headings. The whole document is used instead when it
+    is shorter than `min_chars`, when the request is about the whole
+    document, when nothing matches, or when the excerpt would be more than
+    `max_share` of it. `index` is the stored section index; it is rebuilt
+    when it does not describe `document`.
+    """
+    if len(document) < min_chars:
+        return ContextSelection(document, True, "small")
+    if _WHOLE_DOCUMENT_RE.search(query):
+        return ContextSelection(document, True, "whole_document")
+    if not index or sum(entry["chars"] for entry in index) != len(document):
+        index = section_index(document)
+
+    offsets = [0]
+    for entry in index:
+        offsets.append(offsets[-1] + entry["chars"])
+    chunks = [document[offsets[i]:offsets[i + 1]] for i in range(len(index))]
+    chosen: Set[int] = set()
+
+    def _take(i: int, *, whole: bool = True):
+        chosen.update(range(i, i + (index[i]["span"] if whole else 1)))
+
+    references = _references(query)
+    wanted = _normalize(query)
+    named = []
+    for i, entry in enumerate(index):
+        title = _normalize(re.sub(r"^\s*(?:section|article|clause|§)?\s*\d+(?:\.\d+)*\.?", "", entry["heading"]))
+        if (entry["number"] and entry["number"] in references) or (len(title) >= 4 and title in wanted):
+            named.append(i)
+    for i in named:
+        _take(i)
+
+    for i, entry in enumerate(index):
+        if entry["level"] == 0 or _TOC_RE.search(entry["heading"]) or _TERMS_RE.search(entry["heading"]):
+            _take(i)
+
+    # Relevance: the request's words, weighted by how rare they are across sections
+    terms = _words(query)
+    scores: List[float] = []
+    if terms:
+        chunk_words = [_words(chunk) for chunk in chunks]
+        weight = {t: math.log((1 + len(chunks)) / (1 + sum(1 for words in chunk_words if t in words))) for t in terms}
+        scores = [sum(weight[t] for t in terms if t in words) for words in chunk_words]
+    relevant = [i for i in sorted(range(len(scores)), key=lambda i: -scores[i]) if scores[i] > 0 and index[i]["level"] > 0]
+    if relevant:
+        best = scores[relevant[0]]
+        relevant = [i for i in relevant if scores[i] >= 0.5 * best]
+    if not named and not relevant:
+        return ContextSelection(document, True, "no_match")
+    used = sum(len(chunks[i]) for i in chosen)
+    for i in relevant:
+        size = sum(len(chunks[j]) for j in range(i, i + index[i]["span"]) if j not in chosen)
+        if used + size > budget_chars:
+            continue
+        _take(i)
+        used += size
+
+    if used > max_share * len(document):
+        return ContextSelection(document, True, "most_of_document")
+
+    parts: List[str] = []
+    omitted: List[str] = []
+    for i, chunk in enumerate(chunks):
+        if i in chosen:
+            if omitted:
+                parts.append("[Omitted sections, unchanged: " + "; ".join(omitted) + "]\n\n")
+                omitted = []
+            parts.append(chunk)
+        elif index[i]["level"]:
+            omitted.append(_label(index[i]))
+    if omitted:
+        parts.append("\n\n[Omitted sections, unchanged: " + "; ".join(omitted) + "]\n")
+    return ContextSelection(
+        "".join(parts),
+        False,
+        "named" if named else "relevant",
+        sections=[_label(index[i]) for i in sorted(chosen) if index[i]["level"]],
+    )
@@ -0,0 +1,158 @@
+import hashlib
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+try:
+    import zstandard  # type: ignore
+except Exception:  # pragma: no cover
+    zstandard = None  # type: ignore
+
+from ..config import Settings, get_settings
+from .sections import Section, parse_sections
+
+
+# One-byte codec tag in front of every stored chunk, so the codec can change without rewriting old chunks
+_ZLIB = b"z"
+_ZSTD = b"s"
+
+
+def _split(text: str) -> List[Tuple[str, Optional[Section]]]:
+    lines = text.splitlines(keepends=True)
+    sections = {section.start: section for section in parse_sections(text)}
+    cuts = sorted({0, len(lines), *sections})
+    pieces = [("".join(lines[start:end]), sections.get(start)) for start, end in zip(cuts, cuts[1:])]
+    return [piece for piece in pieces if piece[0]] or [(text, None)]
+
+
+def split_chunks(text: str) -> List[str]:
+    """Cut a document at every heading; the chunks concatenate back to exactly `text`.
+
+    Sections are the unit that successive versions of a contract share, so
+    an edit to one section stores one new chunk.
+    """
+    return [chunk for chunk, _ in _split(text)]
+
+
+def _index(pieces: List[Tuple[str, Optional[Section]]]) -> List[Dict[str, Any]]:
+    entries: List[Dict[str, Any]] = []
+    for i, (chunk, section) in enumerate(pieces):
+        level = section.level if section is not None else 0
+        span = 1
+        # A section spans its subsections: the following chunks with deeper headings
+        if section is not None:
+            while i + span < len(pieces) and (pieces[i + span][1] is None or pieces[i + span][1].level > level):
+                span += 1
+        entries.append({
+            "heading": section.heading if section is not None else "",
+            "level": level,
+            "number": section.number if section is not None else None,
+            "chars": len(chunk),
+            "span": span,
+        })
+    return entries
+
+
+def section_index(text: str) -> List[Dict[str, Any]]:
+    """One entry per chunk, in order: heading, level (0 for text before the first heading), number, length in characters and span in chunks."""
+    return _index(_split(text))
+
+
+def chunk_digest(chunk: str) -> str:
+    return hashlib.sha256(chunk.encode("utf-8")).hexdigest()[:32]
+
+
+def compress(chunk: str, codec: str = "zstd") -> bytes:
+    raw = chunk.encode("utf-8")
+    if codec == "zstd" and zstandard is not None:
+        return _ZSTD + zstandard.ZstdCompressor(level=9).compress(raw)
+    return _ZLIB + zlib.compress(raw, 9)
+
+
+def decompress(blob: bytes) -> str:
+    tag, body = blob[:1], blob[1:]
+    if tag == _ZSTD:
+        if zstandard is None:
+            raise RuntimeError("document chunk needs the zstandard package")
+        return zstandard.ZstdDecompressor().decompress(body).decode("utf-8")
+    return zlib.decompress(body).decode("utf-8")
+
+
+def encode_document(text: str, codec: str = "zstd") -> Tuple[List[str], Dict[str, bytes], List[Dict[str, Any]]]:
+    """The document's manifest (chunk digests in order), its compressed chunks by digest and its section index.
+
+    Chunking and the index come from the same Markdown parse.
+    """
+    pieces = _split(text)
+    manifest: List[str] = []
+    chunks: Dict[str, bytes] = {}
+    for chunk, _ in pieces:
+        digest = chunk_digest(chunk)
+        manifest.append(digest)
+        if digest not in chunks:
+            chunks[digest] = compress(chunk, codec)
+    return manifest, chunks, _index(pieces)
+
+
+class ChunkCache:
+    """Decompressed chunks by digest, LRU-bounded by characters.
+
+    Chunks are immutable and shared between versions and sessions, so one
+    cached chunk serves every document that contains it.
+    """
+
+    def __init__(self, max_chars: int):
+        self.max_chars = max_chars
+        self._items: "OrderedDict[str, str]" = OrderedDict()
+        self._chars = 0
+        self._lock = threading.Lock()
+
+    def get(self, digest: str) -> Optional[str]:
+        with self._lock:
+            text = self._items.get(digest)
+            if text is not None:
+                self._items.move_to_end(digest)
+            return text
+
+    def put(self, digest: str, text: str):
+        if len(text) > self.max_chars:
+            return
+        with self._lock:
+            if digest in self._items:
+                return
+            self._items[digest] = text
+            self._chars += len(text)
+            while self._chars > self.max_chars:
+                _, dropped = self._items.popitem(last=False)
+                self._chars -= len(dropped)
+
+
+_CACHE: Optional[ChunkCache] = None
+
+
+def _chunk_cache(settings: Settings) -> ChunkCache:
+    global _CACHE
+    max_chars = settings.document_cache_mb * 1024 * 1024
+    if _CACHE is None or _CACHE.max_chars != max_chars:
+        _CACHE = ChunkCache(max_chars)
+    return _CACHE
+
+
+def assemble(store, manifest: Sequence[str]) -> str:
+    """Rebuild a document from its manifest, decompressing only chunks that are not cached."""
+    cache = _chunk_cache(get_settings())
+    texts: Dict[str, str] = {}
+    for digest in manifest:
+        cached = cache.get(digest)
+        if cached is not None:
+            texts[digest] = cached
+    missing = [digest for digest in dict.fromkeys(manifest) if digest not in texts]
+    if missing:
+        blobs = store.get_chunks(missing)
+        for digest in missing:
+            if digest not in blobs:
+                raise RuntimeError(f"document chunk {digest} is missing")
+            texts[digest] = decompress(blobs[digest])
+            cache.put(digest, texts[digest])
+    return "".join(texts[digest] for digest in manifest)
@@ -1,18 +1,22 @@
-import os
+import re
+import asyncio
 import inspect
-from typing import AsyncGenerator, Optional
+from dataclasses import dataclass
+from typing import AsyncGenerator, AsyncIterator, Dict, List, Optional, Tuple
 
-from openai import OpenAI, AsyncOpenAI
-
-from ..config import load_settings, DEFAULT_SYSTEM_PROMPT
-from ..utils import retry_async, retry_sync, async_sleep_yield
+from ..config import get_settings
+from ..clients import get_clients
+from ..metrics import instrument_stream, record_usage, span
+from ..routing import route_messages
+from ..utils import async_sleep_yield
+from .cache import contract_cache_key, get_response_cache, replay
+from .streams import TokenBroadcast, start_resumable
 
 
 def build_user_prompt(*, prompt: str, company_name: Optional[str], jurisdiction: Optional[str], tone: Optional[str]) -> str:
+    # Fixed requirements first and the user's context last, so the shared part of the prompt is a cacheable prefix
     parts = [
-        "Context provided by the user describing business and needs:",
-        prompt.strip(),
-        "\nOutput requirements:",
+        "Output requirements:",
         "- Return ONLY GitHub-Flavored Markdown (no code fences, no backticks).",
         "- Use #, ##, ### headings with consistent numbering; include a table of contents.",
         "- Ensure consistent defined terms and cross-references.",
@@ -23,6 +27,8 @@ def build_user_prompt(*, prompt: str, company_name: Optional[str], jurisdiction:
         "- Use a footer to include a copyright notice and contact information.",
         "- Use a header to include the document title and version number.",
         "- Include placeholders where user specifics are unknown (e.g., Company Name, Address).",
+        "\nContext provided by the user describing business and needs:",
+        prompt.strip(),
     ]
     if company_name:
         parts.append(f"- Company Name: {company_name}")
@@ -33,60 +39,301 @@ def build_user_prompt(*, prompt: str, company_name: Optional[str], jurisdiction:
     return "\n".join(parts)
 
 
-async def stream_contract_md(*, data) -> AsyncGenerator[str, None]:
-    settings = load_settings()
-    api_key = settings.openai_api_key
-    if not api_key:
-        raise RuntimeError("OPENAI_API_KEY not configured")
+def _user_context(data) -> str:
+    return build_user_prompt(
+        prompt=data.prompt,
+        company_name=data.company_name,
+        jurisdiction=data.jurisdiction,
+        tone=data.tone,
+    )
+
+
+async def _aclose(stream):
+    closer = getattr(stream, "aclose", None) or getattr(stream, "close", None)
+    if closer is not None:
+        result = closer()
+        if inspect.isawaitable(result):
+            await result
+
 
-    async_client = AsyncOpenAI(api_key=api_key)
+def _stream_completion(
+    messages: List[dict],
+    *,
+    max_tokens: int,
+    stage: str = "generate",
+    expected_tokens: Optional[int] = None,
+    finish: Optional[List[Optional[str]]] = None,
+) -> AsyncIterator[str]:
+    """Stream one completion on the model routed for `stage`; `max_tokens` is the ceiling, `expected_tokens` the likely reply size.
 
-    prompts = settings.prompts or {}
-    sys_prompt = (
-        prompts.get("system", {}).get("contract_generation")
-        or DEFAULT_SYSTEM_PROMPT
+    When the stream runs to its end, its finish reason ("stop", "length", or
+    None if upstream sent none) is appended to `finish`.
+    """
+    settings = get_settings()
+    clients = get_clients()
+    async_client = clients.openai()
+    # Without an estimate (a whole contract or section has no predictable length) the ceiling is sent as is
+    route = route_messages(
+        stage, messages, output_tokens=expected_tokens or max_tokens, ceiling=max_tokens, settings=settings, sized=expected_tokens is not None
     )
-    generation_template = prompts.get("user", {}).get("generation_requirements")
 
-    system_message = {"role": "system", "content": sys_prompt}
-    user_message = {
-        "role": "user",
-        "content": (
-            generation_template.format(context=build_user_prompt(
-                prompt=data.prompt,
-                company_name=data.company_name,
-                jurisdiction=data.jurisdiction,
-                tone=data.tone,
-            )) if generation_template else build_user_prompt(
-                prompt=data.prompt,
-                company_name=data.company_name,
-                jurisdiction=data.jurisdiction,
-                tone=data.tone,
-            )
-        ),
-    }
+    options = {"stream_options": {"include_usage": True}} if settings.openai_stream_usage else {}
 
     async def _create_stream():
         result = async_client.chat.completions.create(
-            model=settings.openai_model,
-            messages=[system_message, user_message],
+            model=route.model,
+            messages=messages,
             temperature=0.2,
-            max_tokens=settings.openai_max_tokens,
+            max_tokens=route.max_tokens,
             stream=True,
+            **options,
         )
         if inspect.isawaitable(result):
             return await result
         return result
 
-    stream = await retry_async(_create_stream)
-
-    async for chunk in stream:  # type: ignore
+    async def _deltas() -> AsyncGenerator[str, None]:
+        with span("llm.request", stage=stage, model=route.model, tier=route.tier, max_tokens=route.max_tokens):
+            stream = await clients.retry(_create_stream)
+        reason: Optional[str] = None
         try:
-            delta = chunk.choices[0].delta.content or ""
-        except Exception:
-            delta = ""
-        if delta:
+            async for chunk in stream:  # type: ignore
+                # With include_usage the last chunk has no choices, only usage
+                record_usage(getattr(chunk, "usage", None), stage=stage)
+                try:
+                    choice = chunk.choices[0]
+                    reason = getattr(choice, "finish_reason", None) or reason
+                    delta = choice.delta.content or ""
+                except Exception:
+                    delta = ""
+                if delta:
+                    yield delta
+                    await async_sleep_yield()
+            if finish is not None:
+                finish.append(reason)
+        finally:
+            # Release the upstream connection as soon as the consumer stops reading
+            await _aclose(stream)
+
+    # Timed from before the request so TTFT includes connecting and any retries
+    return instrument_stream(_deltas(), stage=stage)
+
+
+async def stream_contract_md(*, data, finish: Optional[List[Optional[str]]] = None) -> AsyncGenerator[str, None]:
+    """The generated contract as Markdown deltas; each upstream completion's finish reason goes to `finish`."""
+    settings = get_settings()
+    api_key = settings.openai_api_key
+    if not api_key:
+        raise RuntimeError("OPENAI_API_KEY not configured")
+
+    if getattr(data, "mode", None) == "parallel":
+        async for delta in stream_contract_parallel(data=data, finish=finish):
             yield delta
-            await async_sleep_yield()
+        return
+
+    async for delta in _stream_completion(_generation_messages(data, settings), max_tokens=settings.openai_max_tokens, finish=finish):
+        yield delta
+
+
+def _generation_messages(data, settings) -> List[dict]:
+    templates = settings.templates
+    context = _user_context(data)
+    system_message = {"role": "system", "content": templates.contract_generation}
+    user_message = {
+        "role": "user",
+        "content": (
+            templates.generation_requirements.render(context=context)
+            if templates.generation_requirements
+            else context
+        ),
+    }
+    return [system_message, user_message]
+
+
+def generation_model(data, settings) -> str:
+    """The model a generation request is routed to, which is part of its cache key."""
+    route = route_messages(
+        "generate",
+        _generation_messages(data, settings),
+        output_tokens=settings.openai_max_tokens,
+        ceiling=settings.openai_max_tokens,
+        settings=settings,
+        record=False,
+    )
+    return route.model
+
+
+_BLOCK_RE = re.compile(r"<<<(\w+)>>>\n?(.*?)\n?<<<END>>>", re.DOTALL)
+_OUTLINE_LINE_RE = re.compile(r"^\s*(\d+)\.?\s+(.+?)\s*(?:\|\s*(.*))?$")
+
+
+@dataclass(frozen=True)
+class OutlineSection:
+    number: str
+    title: str
+    scope: str
+
+
+@dataclass(frozen=True)
+class Outline:
+    preamble: str
+    sections: List[OutlineSection]
+    outline_text: str
+    terms: str
+    footer: str
+
+
+def parse_outline(text: str) -> Outline:
+    blocks = {name.upper(): body.strip() for name, body in _BLOCK_RE.findall(text)}
+    marker = text.find("<<<")
+    preamble = (text if marker < 0 else text[:marker]).strip()
+    sections = []
+    for line in blocks.get("OUTLINE", "").splitlines():
+        match = _OUTLINE_LINE_RE.match(line)
+        if match:
+            sections.append(OutlineSection(number=match.group(1), title=match.group(2).strip(), scope=(match.group(3) or "").strip()))
+    return Outline(
+        preamble=preamble,
+        sections=sections,
+        outline_text=blocks.get("OUTLINE", ""),
+        terms=blocks.get("TERMS", ""),
+        footer=blocks.get("FOOTER", ""),
+    )
+
+
+async def stream_contract_parallel(*, data, finish: Optional[List[Optional[str]]] = None) -> AsyncGenerator[str, None]:
+    """Outline first, then draft the top-level sections concurrently.
+
+    Sections are streamed in document order: the earliest unfinished section
+    streams live while later ones buffer, and each buffered section is flushed
+    as soon as everything before it is done. The outline, defined terms and
+    the user context form a shared preamble for every section prompt so that
+    terminology and cross-references stay consistent.
+    """
+    settings = get_settings()
+    templates = settings.templates
+    context = _user_context(data)
+    system_message = {"role": "system", "content": templates.contract_generation}
+
+    outline_prompt = templates.outline_instruction.render(context=context)
+    outline_text = "".join([
+        delta async for delta in _stream_completion(
+            [system_message, {"role": "user", "content": outline_prompt}], max_tokens=2000, stage="outline", expected_tokens=1200, finish=finish
+        )
+    ])
+    outline = parse_outline(outline_text)
+    if not outline.sections:
+        # The model ignored the outline format; fall back to one sequential pass
+        templates_user = templates.generation_requirements.render(context=context) if templates.generation_requirements else context
+        async for delta in _stream_completion(
+            [system_message, {"role": "user", "content": templates_user}], max_tokens=settings.openai_max_tokens, finish=finish
+        ):
+            yield delta
+        return
+
+    semaphore = asyncio.Semaphore(settings.generate_parallelism)
+    queues: List["asyncio.Queue[object]"] = [asyncio.Queue() for _ in outline.sections]
+
+    async def _draft(section: OutlineSection, queue: "asyncio.Queue[object]"):
+        prompt = templates.section_instruction.render(
+            context=context,
+            outline=outline.outline_text,
+            terms=outline.terms or "(none)",
+            number=section.number,
+            title=section.title,
+            scope=section.scope or "as described in the outline",
+        )
+        try:
+            async with semaphore:
+                async for delta in _stream_completion(
+                    [system_message, {"role": "user", "content": prompt}],
+                    max_tokens=settings.generate_section_max_tokens,
+                    stage="section",
+                    finish=finish,
+                ):
+                    queue.put_nowait(delta)
+        except Exception as exc:
+            queue.put_nowait(exc)
+        else:
+            queue.put_nowait(None)
+
+    tasks = [asyncio.create_task(_draft(section, queue)) for section, queue in zip(outline.sections, queues)]
+    try:
+        if outline.preamble:
+            yield outline.preamble + "\n\n"
+        for queue in queues:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item  # type: ignore[misc]
+            yield "\n\n"
+        if outline.footer:
+            yield "---\n\n" + outline.footer + "\n"
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+# Generations currently streaming from upstream, by cache key (single-flight)
+_IN_FLIGHT: Dict[str, TokenBroadcast] = {}
+
+
+@dataclass
+class GenerationStream:
+    status: str
+    stream: AsyncIterator[str]
+    # Set when the stream runs detached and can be resumed from the stream registry
+    stream_id: Optional[str] = None
+    # The upstream run this call started (MISS/BYPASS); its slot is held until the run ends
+    run: Optional[TokenBroadcast] = None
+
+
+async def open_contract_stream(*, data) -> GenerationStream:
+    """Serve a generation from the response cache, an identical in-flight run, or a new resumable upstream run.
+
+    The status is HIT, SHARED, MISS or BYPASS (cache disabled).
+    """
+    settings = get_settings()
+    cache = get_response_cache()
+    key: Optional[str] = None
+    if cache is not None:
+        key = contract_cache_key(data, settings, model=generation_model(data, settings))
+        text = await cache.get(key)
+        if text is not None:
+            return GenerationStream("HIT", replay(text))
+        flight = _IN_FLIGHT.get(key)
+        if flight is not None and not flight.done:
+            return GenerationStream("SHARED", flight.subscribe(), flight.id)
+
+    if not settings.openai_api_key:
+        raise RuntimeError("OPENAI_API_KEY not configured")
+
+    finish: List[Optional[str]] = []
+
+    async def _store(full_text: str):
+        # A reply cut off at max_tokens would otherwise be served, truncated, until the TTL
+        if full_text and cache is not None and key is not None and finish and all(reason == "stop" for reason in finish):
+            await cache.put(key, full_text)
+
+    async def _source():
+        try:
+            async for delta in stream_contract_md(data=data, finish=finish):
+                yield delta
+        finally:
+            if key is not None:
+                _IN_FLIGHT.pop(key, None)
+
+    flight = start_resumable(_source(), on_complete=_store, name=f"generate:{(key or 'nocache')[:12]}")
+    if key is not None:
+        _IN_FLIGHT[key] = flight
+    return GenerationStream("MISS" if cache is not None else "BYPASS", flight.subscribe(), flight.id, flight)
 
 
+async def stream_contract_cached(*, data) -> Tuple[str, AsyncIterator[str]]:
+    """Like `open_contract_stream`, returning only the cache status and the token stream."""
+    opened = await open_contract_stream(data=data)
+    return opened.status, opened.stream
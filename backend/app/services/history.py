@@ -0,0 +1,177 @@
+import asyncio
+from dataclasses import dataclass, field
+from typing import Optional, Set
+
+from ..config import Settings
+from ..clients import get_clients
+from ..metrics import record_usage
+from ..routing import route_messages
+from ..tokens import count_message_tokens, count_tokens
+from ..utils import spawn_background
+from .prompts import session_cache_stats
+from .session import get_document
+from .store import get_store
+
+
+# Each replayed message is clipped to this many characters when folded into the summary
+_SUMMARY_CLIP_CHARS = 2000
+
+_IN_FLIGHT: Set[str] = set()
+
+
+@dataclass
+class HistoryWindow:
+    """The slice of a session's history replayed on the next turn.
+
+    `messages` holds the rolling summary (as a system message, when there is
+    one) followed by the most recent turns that fit the token budget.
+    """
+
+    messages: list
+    total_messages: int
+    history_tokens: int
+    window_tokens: int
+    summary_tokens: int
+    summarized_upto: int
+    window_start: int
+    overflow: list = field(default_factory=list)
+
+    def stats(self) -> dict:
+        return {
+            "messages": self.total_messages,
+            "history_tokens": self.history_tokens,
+            "window_tokens": self.window_tokens,
+            "summary_tokens": self.summary_tokens,
+            "summarized_upto": self.summarized_upto,
+            "window_start": self.window_start,
+        }
+
+
+def select_window(messages: list, *, budget: int, summary: Optional[str] = None, summarized_upto: int = 0, model: str = "gpt-4o") -> HistoryWindow:
+    """Keep the newest messages that fit `budget` tokens.
+
+    Messages before `summarized_upto` are already covered by `summary`. Anything
+    between that point and the start of the window is returned as `overflow`,
+    the input for the next summary.
+    """
+    costs = [count_message_tokens([m], model) for m in messages]
+    floor = min(max(summarized_upto, 0), len(messages))
+    start, used = len(messages), 0
+    while start > floor and used + costs[start - 1] <= budget:
+        start -= 1
+        used += costs[start]
+    # Never open the window on a reply whose question fell outside it
+    while start < len(messages) and getattr(messages[start], "type", "") == "ai":
+        used -= costs[start]
+        start += 1
+
+    prompt_messages = list(messages[start:])
+    summary_tokens = 0
+    if summary and floor > 0:
+        from langchain_core.messages import SystemMessage  # type: ignore
+
+        summary_tokens = count_tokens(summary, model)
+        prompt_messages.insert(0, SystemMessage(content="Summary of the earlier conversation:\n" + summary))
+    return HistoryWindow(
+        messages=prompt_messages,
+        total_messages=len(messages),
+        history_tokens=sum(costs),
+        window_tokens=used,
+        summary_tokens=summary_tokens,
+        summarized_upto=floor,
+        window_start=start,
+        overflow=list(messages[floor:start]),
+    )
+
+
+async def prepare_history(session_id: str, messages: list, settings: Settings) -> HistoryWindow:
+    """Window the history for the next turn and fold any overflow into the summary in the background."""
+    meta = await asyncio.to_thread(get_store().get_meta, session_id) or {}
+    window = select_window(
+        messages,
+        budget=settings.history_token_budget,
+        summary=meta.get("history_summary"),
+        summarized_upto=int(meta.get("history_summarized_upto") or 0),
+        model=settings.openai_model,
+    )
+    if window.overflow and settings.openai_api_key and session_id not in _IN_FLIGHT:
+        _IN_FLIGHT.add(session_id)
+        spawn_background(
+            _summarize(session_id, meta.get("history_summary"), window.overflow, window.summarized_upto, window.window_start, settings),
+            name=f"summarize:{session_id}",
+        )
+    return window
+
+
+def _clip(text: str) -> str:
+    return text if len(text) <= _SUMMARY_CLIP_CHARS else text[:_SUMMARY_CLIP_CHARS] + " […]"
+
+
+async def _summarize(session_id: str, previous: Optional[str], overflow: list, start: int, upto: int, settings: Settings):
+    try:
+        transcript = "\n\n".join(f"{m.type.upper()}: {_clip(str(m.content))}" for m in overflow)
+        content = (f"Existing summary:\n{previous}\n\n" if previous else "") + "Conversation to fold in:\n" + transcript
+        messages = [
+            {"role": "system", "content": settings.templates.summary_instruction},
+            {"role": "user", "content": content},
+        ]
+        route = route_messages(
+            "summary",
+            messages,
+            output_tokens=settings.history_summary_max_tokens,
+            ceiling=settings.history_summary_max_tokens,
+            settings=settings,
+        )
+        clients = get_clients()
+        client = clients.openai()
+
+        async def _create():
+            return await client.chat.completions.create(
+                model=route.model,
+                messages=messages,
+                temperature=0,
+                max_tokens=route.max_tokens,
+            )
+
+        resp = await clients.retry(_create)
+        record_usage(getattr(resp, "usage", None), stage="summary")
+        text = (resp.choices[0].message.content or "").strip()
+        if text:
+            await asyncio.to_thread(_save_summary, session_id, text, start, upto)
+    except Exception:
+        # The window alone still bounds the prompt; the next turn retries the summary
+        pass
+    finally:
+        _IN_FLIGHT.discard(session_id)
+
+
+def _save_summary(session_id: str, text: str, start: int, upto: int):
+    store = get_store()
+    meta = store.get_meta(session_id)
+    # Skip the write if the history was cleared or re-summarized meanwhile, here or on another worker
+    if meta is not None and int(meta.get("history_summarized_upto") or 0) == start and len(store.get_messages(session_id)) >= upto:
+        store.update_meta_if(
+            session_id,
+            {"history_summarized_upto": meta.get("history_summarized_upto")},
+            history_summary=text,
+            history_summarized_upto=upto,
+        )
+
+
+def session_token_stats(session_id: str, settings: Settings) -> dict:
+    store = get_store()
+    meta = store.get_meta(session_id)
+    if meta is None:
+        raise KeyError("session not found")
+    window = select_window(
+        store.get_messages(session_id),
+        budget=settings.history_token_budget,
+        summary=meta.get("history_summary"),
+        summarized_upto=int(meta.get("history_summarized_upto") or 0),
+        model=settings.openai_model,
+    )
+    stats = window.stats()
+    stats["budget"] = settings.history_token_budget
+    stats["document_tokens"] = count_tokens(get_document(session_id, meta=meta) or "", settings.openai_model)
+    stats["prompt_cache"] = session_cache_stats(meta)
+    return stats
@@ -0,0 +1,207 @@
+import hashlib
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from ..config import Settings
+from ..metrics import CHAT_CONTEXT, CHAT_CONTEXT_CHARS, PROMPT_PREFIXES
+from .context import select_context
+from .sections import parse_sections
+from .session import get_document
+from .store import get_store
+
+
+def prefix_hash(*parts: str) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()[:16]
+
+
+def _blocks(markdown: str) -> List[Tuple[str, str]]:
+    """The document cut at every heading, as (heading key, text) pairs; text before the first heading is keyed ""."""
+    lines = markdown.splitlines()
+    keys: Dict[int, str] = {}
+    seen: Dict[str, int] = {}
+    for section in parse_sections(markdown):
+        key = section.number or section.heading.strip().lower()
+        seen[key] = seen.get(key, 0) + 1
+        keys[section.start] = key if seen[key] == 1 else f"{key}#{seen[key]}"
+    bounds = sorted({0, len(lines), *keys})
+    blocks = []
+    for start, end in zip(bounds, bounds[1:]):
+        text = "\n".join(lines[start:end]).strip()
+        if text or start in keys:
+            blocks.append((keys.get(start, ""), text))
+    return blocks
+
+
+def document_updates(snapshot: str, current: str, *, max_drift: float) -> Optional[str]:
+    """What changed from `snapshot` to `current`, as the current text of each changed section.
+
+    Returns "" when nothing changed, and None when the changes are more than
+    `max_drift` of the document (the caller should send the whole document
+    again instead).
+    """
+    if snapshot == current:
+        return ""
+    if max_drift <= 0:
+        return None
+    old = dict(_blocks(snapshot))
+    new = _blocks(current)
+    changed = [text for key, text in new if old.get(key) != text]
+    removed = [key for key in old if key not in {k for k, _ in new}]
+    size = sum(len(text) for text in changed)
+    if size > max_drift * max(len(current), 1):
+        return None
+    parts = ["The document has changed since the copy above. Current text of the changed sections (everything else is as above):"]
+    parts.extend(changed)
+    if removed:
+        parts.append("Removed sections: " + ", ".join(k or "(preamble)" for k in removed))
+    return "\n\n".join(parts)
+
+
+@dataclass
+class ChatPrompt:
+    """One chat turn's prompt, ordered from stable to volatile.
+
+    `system` (instructions) and `document` (an anchored snapshot of the
+    document) form the cacheable prefix and are followed by the history, so
+    they must not change between turns unless they really have to. Edits
+    made since the snapshot travel in `input`, after the history. When only
+    selected sections are sent, that excerpt is in `input` too and there
+    is no `document`.
+    """
+
+    system: str
+    document: Optional[str]
+    input: str
+    prefix_hash: str
+    context: str = "none"
+
+
+def _snapshot(session_id: str, meta: Dict[str, Any], base_doc: str) -> Optional[str]:
+    """The document text the session's cached prefix was built from, if it is still available."""
+    version = meta.get("prompt_snapshot_version")
+    if version is None:
+        # Unversioned snapshots are kept as a digest only, so the text is known just when it is unchanged
+        digest = meta.get("prompt_snapshot_digest")
+        return base_doc if digest and digest == prefix_hash(base_doc) else None
+    try:
+        return get_document(session_id, version=int(version))
+    except KeyError:
+        # That version has been pruned from the document history
+        return None
+
+
+def build_chat_prompt(
+    *,
+    session_id: str,
+    system_text: str,
+    base_doc: Optional[str],
+    input_text: str,
+    settings: Settings,
+    base_version: Optional[int] = None,
+    selective: bool = False,
+) -> ChatPrompt:
+    """Lay out one chat turn, reusing the session's document snapshot while it is close enough to `base_doc`.
+
+    The snapshot is recorded as a stored document version (`base_version`)
+    rather than a copy of the text; for a document without a version only
+    its digest is kept, so any edit to it re-anchors.
+    With `selective` (targeted edits), a large document is cut down to the
+    sections the request needs; the full-document layout is the fallback.
+    """
+    store = get_store()
+    meta = store.get_meta(session_id) or {}
+    document = None
+    updates = ""
+    excerpt = None
+    context = "none"
+    fields: Dict[str, Any] = {}
+    if base_doc and selective and settings.chat_context_selection:
+        selection = select_context(
+            base_doc,
+            input_text,
+            index=meta.get("document_index"),
+            budget_chars=settings.chat_context_budget_chars,
+            min_chars=settings.chat_context_min_chars,
+        )
+        CHAT_CONTEXT.inc(outcome=selection.reason)
+        CHAT_CONTEXT_CHARS.inc(len(base_doc), part="document")
+        CHAT_CONTEXT_CHARS.inc(len(selection.text), part="sent")
+        if not selection.full:
+            excerpt = selection.text
+            context = "excerpt"
+    if base_doc and excerpt is None:
+        context = "full"
+        snapshot = _snapshot(session_id, meta, base_doc)
+        delta = document_updates(snapshot, base_doc, max_drift=settings.prompt_snapshot_max_drift) if snapshot else None
+        if delta is None:
+            # Re-anchor: the whole current document becomes the new cached snapshot
+            snapshot, delta = base_doc, ""
+            if base_version:
+                fields.update(prompt_snapshot_version=base_version, prompt_snapshot_digest=None)
+            else:
+                fields.update(prompt_snapshot_digest=prefix_hash(snapshot), prompt_snapshot_version=None)
+            if meta.get("prompt_snapshot") is not None:
+                # Sessions from before snapshots were kept by reference carry a full copy
+                fields["prompt_snapshot"] = None
+        document = "<BASE_DOCUMENT>\n" + snapshot + "\n</BASE_DOCUMENT>"
+        updates = delta
+    digest = prefix_hash(system_text, document or "")
+    previous = meta.get("prompt_prefix_hash")
+    PROMPT_PREFIXES.inc(outcome="new" if previous is None else "reused" if previous == digest else "changed")
+    if previous != digest:
+        fields["prompt_prefix_hash"] = digest
+    if fields and meta:
+        try:
+            store.update_meta(session_id, **fields)
+        except KeyError:
+            pass
+    text = f"<DOCUMENT_UPDATES>\n{updates}\n</DOCUMENT_UPDATES>\n\n{input_text}" if updates else input_text
+    if excerpt is not None:
+        text = (
+            "<DOCUMENT_EXCERPT>\nOnly the sections this request needs are shown. Bracketed lines stand for omitted "
+            "sections: leave them unchanged and never target a section whose subsections are not all shown.\n\n"
+            f"{excerpt}\n</DOCUMENT_EXCERPT>\n\n{input_text}"
+        )
+    return ChatPrompt(system=system_text, document=document, input=text, prefix_hash=digest, context=context)
+
+
+def record_session_usage(session_id: str, prompt_tokens: int, cached_tokens: int, *, attempts: int = 5):
+    """Add one turn's upstream prompt usage to the session's running totals.
+
+    The totals are compared and set in one store call, re-read when another
+    turn of the same session wrote first, so concurrent turns do not lose
+    each other's counts.
+    """
+    if not prompt_tokens:
+        return
+    store = get_store()
+    for _ in range(attempts):
+        meta = store.get_meta(session_id)
+        if meta is None:
+            return
+        seen = {key: meta.get(key) for key in ("prompt_tokens_total", "prompt_cached_tokens_total")}
+        try:
+            if store.update_meta_if(
+                session_id,
+                seen,
+                prompt_tokens_total=int(seen["prompt_tokens_total"] or 0) + prompt_tokens,
+                prompt_cached_tokens_total=int(seen["prompt_cached_tokens_total"] or 0) + cached_tokens,
+            ):
+                return
+        except KeyError:
+            return
+
+
+def session_cache_stats(meta: Dict[str, Any]) -> Dict[str, Any]:
+    prompt = int(meta.get("prompt_tokens_total") or 0)
+    cached = int(meta.get("prompt_cached_tokens_total") or 0)
+    return {
+        "prefix_hash": meta.get("prompt_prefix_hash"),
+        "prompt_tokens": prompt,
+        "cached_tokens": cached,
+        "hit_ratio": round(cached / prompt, 4) if prompt else None,
+    }
@@ -0,0 +1,150 @@
+import re
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Tuple
+
+try:
+    from markdown_it import MarkdownIt  # type: ignore
+except Exception:  # pragma: no cover
+    MarkdownIt = None  # type: ignore
+
+
+_NUMBER_RE = re.compile(r"^\s*(?:section|article|clause|§)?\s*(\d+(?:\.\d+)*)\.?(?=\s|$)", re.IGNORECASE)
+_PATCH_RE = re.compile(r"<<<PATCH([^>]*)>>>\n?(.*?)\n?<<<END>>>", re.DOTALL)
+_ATTR_RE = re.compile(r'(\w+)="([^"]*)"')
+
+PATCH_OPS = ("replace", "insert_after", "insert_before", "delete", "append")
+
+
+@dataclass(frozen=True)
+class Section:
+    """A heading and everything under it up to the next heading of the same or higher level.
+
+    `start` and `end` are 0-based line offsets into the document (`end` exclusive).
+    """
+
+    heading: str
+    level: int
+    number: Optional[str]
+    start: int
+    end: int
+
+
+@dataclass(frozen=True)
+class Patch:
+    op: str
+    target: Optional[str]
+    content: str
+
+    def to_dict(self) -> Dict[str, Optional[str]]:
+        return {"op": self.op, "target": self.target, "content": self.content}
+
+
+_PARSER = None
+
+
+def _parser():
+    global _PARSER
+    if _PARSER is None:
+        if MarkdownIt is None:
+            raise RuntimeError("markdown-it-py not available on server")
+        _PARSER = MarkdownIt("commonmark").enable("table")
+    return _PARSER
+
+
+def section_number(heading: str) -> Optional[str]:
+    match = _NUMBER_RE.match(heading)
+    return match.group(1) if match else None
+
+
+def parse_sections(markdown: str) -> List[Section]:
+    tokens = _parser().parse(markdown)
+    total = len(markdown.splitlines())
+    headings: List[Tuple[int, int, str]] = []
+    for i, token in enumerate(tokens):
+        if token.type == "heading_open" and token.map:
+            text = tokens[i + 1].content.strip() if i + 1 < len(tokens) else ""
+            headings.append((token.map[0], int(token.tag[1:]), text))
+
+    sections = []
+    for i, (start, level, text) in enumerate(headings):
+        end = total
+        for next_start, next_level, _ in headings[i + 1:]:
+            if next_level <= level:
+                end = next_start
+                break
+        sections.append(Section(heading=text, level=level, number=section_number(text), start=start, end=end))
+    return sections
+
+
+def _normalize(text: str) -> str:
+    return re.sub(r"\s+", " ", text.strip().strip("#").strip()).lower()
+
+
+def find_section(sections: List[Section], target: str) -> Optional[Section]:
+    """Resolve a section by number ("3.2", "Section 3.2") or heading text."""
+    number = section_number(target)
+    if number:
+        for section in sections:
+            if section.number == number:
+                return section
+    wanted = _normalize(target)
+    for section in sections:
+        if _normalize(section.heading) == wanted:
+            return section
+    for section in sections:
+        if wanted and wanted in _normalize(section.heading):
+            return section
+    return None
+
+
+def apply_patch(markdown: str, patch: Patch) -> str:
+    """Apply one patch; raises KeyError when its target section does not exist."""
+    lines = markdown.splitlines()
+    content = patch.content.strip("\n").splitlines()
+    if patch.op == "append" or (patch.op == "insert_after" and not patch.target):
+        return "\n".join(lines + [""] + content) + "\n"
+    section = find_section(parse_sections(markdown), patch.target or "")
+    if section is None:
+        raise KeyError(f"section not found: {patch.target}")
+    if patch.op == "replace":
+        lines[section.start:section.end] = content + [""]
+    elif patch.op == "delete":
+        del lines[section.start:section.end]
+    elif patch.op == "insert_after":
+        lines[section.end:section.end] = content + [""]
+    elif patch.op == "insert_before":
+        lines[section.start:section.start] = content + [""]
+    else:
+        raise ValueError(f"unknown patch op: {patch.op}")
+    return "\n".join(lines).rstrip("\n") + "\n"
+
+
+def apply_patches(markdown: str, patches: List[Patch]) -> Tuple[str, List[Patch]]:
+    """Apply patches in order; returns the new document and the patches that could not be applied."""
+    failed = []
+    for patch in patches:
+        try:
+            markdown = apply_patch(markdown, patch)
+        except (KeyError, ValueError):
+            failed.append(patch)
+    return markdown, failed
+
+
+class PatchStreamParser:
+    """Incrementally extracts `<<<PATCH ...>>> ... <<<END>>>` blocks from a token stream."""
+
+    def __init__(self):
+        self._buf = ""
+
+    def feed(self, text: str) -> Iterator[Patch]:
+        self._buf += text
+        while "<<<END>>>" in self._buf:
+            match = _PATCH_RE.search(self._buf)
+            if match is None:
+                return
+            self._buf = self._buf[match.end():]
+            attrs = dict(_ATTR_RE.findall(match.group(1)))
+            op = attrs.get("op", "replace").strip().lower()
+            if op not in PATCH_OPS:
+                continue
+            yield Patch(op=op, target=attrs.get("target") or None, content=match.group(2))
@@ -1,69 +1,162 @@
 import uuid
-from datetime import datetime, timezone
-from typing import Dict, Any, Optional
-from copy import deepcopy
+from typing import Dict, Any, List, Optional, Sequence, Tuple
 
-try:
-    from langchain_community.chat_message_histories import ChatMessageHistory  # type: ignore
-except Exception:  # pragma: no cover
-    ChatMessageHistory = None  # type: ignore
+from ..config import DEFAULT_SYSTEM_PROMPT, get_settings
+from .documents import assemble, encode_document
+from .sections import apply_patches
+from ..utils import module_available
+from .store import DEFAULT_LIST_FIELDS, DocumentVersion, get_store, store_history, utcnow_iso
 
 
-SESSION_HISTORY: Dict[str, "ChatMessageHistory"] = {}
-SESSION_META: Dict[str, Dict[str, Any]] = {}
+class DocumentConflict(Exception):
+    """The stored document moved past the version the caller based its write on."""
+
+    def __init__(self, current_version: int):
+        super().__init__(f"document is at version {current_version}")
+        self.current_version = current_version
 
 
 def ensure_langchain_available():
-    if ChatMessageHistory is None:
+    if not module_available("langchain_core"):
         raise RuntimeError("LangChain not available on server")
 
 
-from ..config import DEFAULT_SYSTEM_PROMPT
-
-
 def start_session(*, system_prompt: Optional[str] = None, metadata: Optional[Dict[str, Any]] = None) -> str:
     ensure_langchain_available()
     session_id = str(uuid.uuid4())
-    SESSION_META[session_id] = {
-        "created_at": datetime.now(timezone.utc).isoformat(),
-        "system_prompt": system_prompt or DEFAULT_SYSTEM_PROMPT,
-        "metadata": metadata or {},
-    }
-    SESSION_HISTORY[session_id] = ChatMessageHistory()
+    now = utcnow_iso()
+    get_store().create(
+        session_id,
+        {
+            "created_at": now,
+            "updated_at": now,
+            "system_prompt": system_prompt or DEFAULT_SYSTEM_PROMPT,
+            "metadata": metadata or {},
+        },
+    )
     return session_id
 
 
+def get_meta(session_id: str) -> Optional[Dict[str, Any]]:
+    return get_store().get_meta(session_id)
+
+
 def get_history(session_id: str):
     ensure_langchain_available()
-    history = SESSION_HISTORY.get(session_id)
-    if history is None:
+    store = get_store()
+    if store.get_meta(session_id) is None:
         raise KeyError("session not found")
-    return history
+    return store_history(store, session_id)
 
 
 def clear_history(session_id: str):
     ensure_langchain_available()
-    SESSION_HISTORY[session_id] = ChatMessageHistory()
+    store = get_store()
+    store.clear_messages(session_id)
+    store.update_meta(session_id, history_summary=None, history_summarized_upto=0)
 
 
-def list_sessions():
+def list_sessions(
+    *, limit: int = 50, cursor: Optional[str] = None, fields: Optional[Sequence[str]] = None
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
     ensure_langchain_available()
-    # Return a deep-copied view to avoid accidental client-side mutation affecting server state
-    items = []
-    for sid, meta in SESSION_META.items():
-        item = {"session_id": sid}
-        item.update(deepcopy(meta))
-        items.append(item)
-    return items
-
-
-def set_document(session_id: str, html: str, title: Optional[str] = None):
+    # Projected rows are built fresh by the store, so clients cannot mutate server state
+    projection = list(DEFAULT_LIST_FIELDS if not fields else dict.fromkeys(["session_id", *fields]))
+    if "document_html" not in projection:
+        return get_store().list_page(limit=limit, cursor=cursor, fields=projection)
+    # Documents are stored as chunks; rebuild the text only when the caller asked for it
+    store = get_store()
+    items, next_cursor = store.list_page(limit=limit, cursor=cursor, fields=[*projection, "document_manifest"])
+    for item in items:
+        manifest = item["document_manifest"] if "document_manifest" in projection else item.pop("document_manifest")
+        if manifest is not None:
+            item["document_html"] = assemble(store, manifest)
+    return items, next_cursor
+
+
+def set_document(session_id: str, html: str, title: Optional[str] = None, base_version: Optional[int] = None) -> int:
+    """Store a new document version and return its number (versions start at 1).
+
+    The document is kept as compressed, content-addressed section chunks,
+    so versions that share sections share storage; the session metadata
+    holds only the current version's list of chunk digests. The version
+    check and the write are one atomic step in the store, so concurrent
+    writers on any worker never both succeed against the same
+    `base_version`. Without one the write always lands, on top of whatever
+    version is current.
+    """
     ensure_langchain_available()
-    meta = SESSION_META.get(session_id)
+    settings = get_settings()
+    store = get_store()
+    manifest, chunks, index = encode_document(html, settings.document_compression)
+    while True:
+        meta = store.get_meta(session_id)
+        if meta is None:
+            raise KeyError("session not found")
+        current = int(meta.get("document_version") or 0)
+        if base_version is not None and base_version != current:
+            raise DocumentConflict(current)
+        document = DocumentVersion(version=current + 1, manifest=manifest, size=len(html), created_at=utcnow_iso(), title=title)
+        # document_html is cleared: sessions stored before chunking kept the whole text there
+        fields: Dict[str, Any] = {
+            "document_manifest": manifest,
+            "document_index": index,
+            "document_size": len(html),
+            "document_version": current + 1,
+            "document_html": None,
+        }
+        if title:
+            fields["document_title"] = title
+        expected = {"document_version": meta.get("document_version")}
+        if store.write_document_if(session_id, expected, document, chunks, keep=settings.document_max_versions, **fields):
+            return current + 1
+
+
+def get_document(session_id: str, *, meta: Optional[Dict[str, Any]] = None, version: Optional[int] = None) -> Optional[str]:
+    """The session's current document (or `version` of it), decompressed only now; None when there is none."""
+    store = get_store()
+    if version is not None:
+        for stored in store.document_versions(session_id):
+            if stored.version == version:
+                return assemble(store, stored.manifest)
+        raise KeyError("document version not found")
+    meta = meta if meta is not None else store.get_meta(session_id)
     if meta is None:
         raise KeyError("session not found")
-    meta["document_html"] = html
-    if title:
-        meta["document_title"] = title
-
-
+    manifest = meta.get("document_manifest")
+    if manifest is None:
+        return meta.get("document_html")
+    return assemble(store, manifest)
+
+
+def list_document_versions(session_id: str) -> List[Dict[str, Any]]:
+    return [stored.info() for stored in get_store().document_versions(session_id)]
+
+
+def apply_document_patches(session_id: str, patches, *, attempts: int = 5) -> Tuple[int, list]:
+    """Apply section patches to the latest stored document.
+
+    When another writer stores a version first, the patches are re-applied
+    to that version. Returns the new version and the patches whose target
+    could not be found. A turn that changes nothing (no patches, or none
+    that landed) stores no version and returns the current one.
+    """
+    patches = list(patches)
+    for _ in range(attempts):
+        meta = get_store().get_meta(session_id)
+        if meta is None:
+            raise KeyError("session not found")
+        current = get_document(session_id, meta=meta) or ""
+        updated, failed = apply_patches(current, patches) if patches else (current, [])
+        if updated == current:
+            return int(meta.get("document_version") or 0), failed
+        try:
+            version = set_document(session_id, updated, base_version=int(meta.get("document_version") or 0))
+        except DocumentConflict:
+            continue
+        return version, failed
+    raise DocumentConflict(int((get_store().get_meta(session_id) or {}).get("document_version") or 0))
+
+
+def set_title(session_id: str, title: str):
+    get_store().update_meta(session_id, document_title=title)
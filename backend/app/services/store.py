@@ -0,0 +1,834 @@
+import base64
+import bisect
+import json
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from ..config import Settings, get_settings
+
+
+DEFAULT_LIST_FIELDS = ("session_id", "document_title", "created_at", "updated_at")
+
+
+def utcnow_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def encode_cursor(updated_at: str, session_id: str) -> str:
+    raw = f"{updated_at}|{session_id}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[str, str]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+        updated_at, session_id = raw.rsplit("|", 1)
+    except Exception:
+        raise ValueError("invalid cursor")
+    return updated_at, session_id
+
+
+@dataclass
+class DocumentVersion:
+    """One stored version of a session document: its chunk digests in order."""
+
+    version: int
+    manifest: List[str]
+    size: int
+    created_at: str
+    title: Optional[str] = None
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "version": self.version,
+            "created_at": self.created_at,
+            "size": self.size,
+            "chunks": len(self.manifest),
+            "title": self.title,
+        }
+
+
+@dataclass
+class SessionRecord:
+    """Everything stored for one session, as moved by bulk export and import."""
+
+    session_id: str
+    meta: Dict[str, Any]
+    messages: list
+    versions: List[DocumentVersion]
+    chunks: Dict[str, bytes]
+
+
+class SessionStore(ABC):
+    """Storage for session metadata and chat history.
+
+    Metadata is a flat dict (`created_at`, `updated_at`, `system_prompt`,
+    `metadata`, `document_html`, `document_title`, ...). Every method that
+    addresses a session raises KeyError when it does not exist.
+    """
+
+    @abstractmethod
+    def create(self, session_id: str, meta: Dict[str, Any]) -> None: ...
+
+    @abstractmethod
+    def get_meta(self, session_id: str) -> Optional[Dict[str, Any]]: ...
+
+    @abstractmethod
+    def update_meta(self, session_id: str, **fields: Any) -> None: ...
+
+    @abstractmethod
+    def update_meta_if(self, session_id: str, expected: Dict[str, Any], **fields: Any) -> bool:
+        """Apply `fields` only if each key in `expected` still holds that value (absent reads as None).
+
+        Returns False, changing nothing, when another writer got there first;
+        check and write are atomic across every process sharing the store.
+        """
+
+    @abstractmethod
+    def write_document_if(
+        self,
+        session_id: str,
+        expected: Dict[str, Any],
+        document: DocumentVersion,
+        chunks: Dict[str, bytes],
+        *,
+        keep: int = 0,
+        **fields: Any,
+    ) -> bool:
+        """Record `document` as a new version and apply `fields`, under the same check as `update_meta_if`.
+
+        `chunks` holds compressed chunk payloads by digest; chunks already
+        stored (by any session) are shared, not stored again. Versions beyond
+        the newest `keep` (0 keeps all) are dropped, along with chunks no
+        version uses any more.
+        """
+
+    @abstractmethod
+    def get_chunks(self, digests: Sequence[str]) -> Dict[str, bytes]: ...
+
+    @abstractmethod
+    def document_versions(self, session_id: str) -> List[DocumentVersion]:
+        """The session's stored document versions, oldest first."""
+
+    @abstractmethod
+    def get_messages(self, session_id: str) -> list: ...
+
+    @abstractmethod
+    def append_messages(self, session_id: str, messages: Iterable) -> None: ...
+
+    @abstractmethod
+    def clear_messages(self, session_id: str) -> None: ...
+
+    @abstractmethod
+    def list_page(
+        self, *, limit: int, cursor: Optional[str] = None, fields: Sequence[str] = DEFAULT_LIST_FIELDS
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """Return sessions most recently updated first, projected to `fields`.
+
+        `cursor` is the opaque `next_cursor` from the previous page; the second
+        element of the result is None on the last page.
+        """
+
+    @abstractmethod
+    def import_sessions(self, records: Sequence[SessionRecord], *, replace: bool = False) -> List[str]:
+        """Write `records` in one transaction, timestamps and version numbers unchanged; returns the ids written.
+
+        A session that already exists is left alone, or overwritten with
+        `replace`. Each record's `chunks` must hold every chunk its versions use.
+        """
+
+    @abstractmethod
+    def delete(self, session_id: str) -> None: ...
+
+    @abstractmethod
+    def size(self) -> int: ...
+
+    def close(self) -> None:
+        pass
+
+
+@lru_cache(maxsize=None)
+def _history_class() -> type:
+    # Built on first use so importing the store does not pull in langchain_core
+    from langchain_core.chat_history import BaseChatMessageHistory  # type: ignore
+
+    class StoreChatMessageHistory(BaseChatMessageHistory):
+        """LangChain history view that reads and writes through a SessionStore."""
+
+        def __init__(self, store: SessionStore, session_id: str):
+            self.store = store
+            self.session_id = session_id
+
+        @property
+        def messages(self):  # type: ignore[override]
+            return self.store.get_messages(self.session_id)
+
+        def add_messages(self, messages) -> None:
+            self.store.append_messages(self.session_id, messages)
+
+        def clear(self) -> None:
+            self.store.clear_messages(self.session_id)
+
+    return StoreChatMessageHistory
+
+
+def store_history(store: SessionStore, session_id: str):
+    """A LangChain chat history for `session_id` backed by `store`."""
+    return _history_class()(store, session_id)
+
+
+class _Entry:
+    __slots__ = ("meta", "messages", "versions", "touched", "nbytes")
+
+    def __init__(self, meta: Dict[str, Any]):
+        self.meta = meta
+        self.messages: list = []
+        self.versions: List[DocumentVersion] = []
+        self.touched = time.monotonic()
+        self.nbytes = 0
+
+
+def _approx_bytes(entry: _Entry) -> int:
+    total = 256
+    for value in entry.meta.values():
+        if isinstance(value, str):
+            total += len(value)
+    for message in entry.messages:
+        content = getattr(message, "content", "")
+        total += 64 + (len(content) if isinstance(content, str) else 0)
+    # Chunk payloads are shared between sessions and counted once by the store
+    for version in entry.versions:
+        total += 128 + 40 * len(version.manifest)
+    return total
+
+
+class MemorySessionStore(SessionStore):
+    """In-process store with LRU eviction, idle TTL and an approximate byte budget.
+
+    Document chunks are reference-counted across every session's versions
+    and freed with the last version that uses them.
+    """
+
+    def __init__(self, *, max_sessions: int = 10000, ttl_seconds: float = 0, max_bytes: int = 0):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        # (updated_at, session_id) kept sorted so listing never scans every session
+        self._recency: List[Tuple[str, str]] = []
+        self._bytes = 0
+        self._chunks: Dict[str, bytes] = {}
+        self._chunk_refs: Dict[str, int] = {}
+        self._lock = threading.RLock()
+
+    def _touch(self, session_id: str) -> _Entry:
+        entry = self._entries.get(session_id)
+        if entry is None:
+            raise KeyError("session not found")
+        now = time.monotonic()
+        if self.ttl_seconds and now - entry.touched > self.ttl_seconds:
+            self._drop(session_id)
+            raise KeyError("session not found")
+        entry.touched = now
+        self._entries.move_to_end(session_id)
+        return entry
+
+    def _drop(self, session_id: str):
+        entry = self._entries.pop(session_id, None)
+        if entry is not None:
+            self._bytes -= entry.nbytes
+            self._unindex(session_id, entry)
+            for version in entry.versions:
+                self._unref(version.manifest)
+
+    def _ref(self, manifest: Sequence[str], chunks: Dict[str, bytes]):
+        for digest in manifest:
+            if digest not in self._chunk_refs:
+                self._chunks[digest] = chunks[digest]
+                self._bytes += len(chunks[digest])
+            self._chunk_refs[digest] = self._chunk_refs.get(digest, 0) + 1
+
+    def _unref(self, manifest: Sequence[str]):
+        for digest in manifest:
+            remaining = self._chunk_refs[digest] - 1
+            if remaining:
+                self._chunk_refs[digest] = remaining
+            else:
+                del self._chunk_refs[digest]
+                self._bytes -= len(self._chunks.pop(digest))
+
+    def _index(self, session_id: str, entry: _Entry):
+        bisect.insort(self._recency, (entry.meta.get("updated_at") or "", session_id))
+
+    def _unindex(self, session_id: str, entry: _Entry):
+        key = (entry.meta.get("updated_at") or "", session_id)
+        pos = bisect.bisect_left(self._recency, key)
+        if pos < len(self._recency) and self._recency[pos] == key:
+            del self._recency[pos]
+
+    def _set_updated(self, session_id: str, entry: _Entry):
+        self._unindex(session_id, entry)
+        entry.meta["updated_at"] = utcnow_iso()
+        self._index(session_id, entry)
+
+    def _resize(self, entry: _Entry):
+        nbytes = _approx_bytes(entry)
+        self._bytes += nbytes - entry.nbytes
+        entry.nbytes = nbytes
+
+    def _evict(self, keep: Optional[str] = None):
+        now = time.monotonic()
+        # Least recently used entries sit at the front
+        while self._entries:
+            sid, entry = next(iter(self._entries.items()))
+            if sid == keep:
+                break
+            expired = self.ttl_seconds and now - entry.touched > self.ttl_seconds
+            over_count = len(self._entries) > self.max_sessions
+            over_bytes = self.max_bytes and self._bytes > self.max_bytes
+            if not (expired or over_count or over_bytes):
+                break
+            self._drop(sid)
+
+    def create(self, session_id: str, meta: Dict[str, Any]) -> None:
+        with self._lock:
+            if session_id in self._entries:
+                self._drop(session_id)
+            entry = _Entry(dict(meta))
+            self._entries[session_id] = entry
+            self._index(session_id, entry)
+            self._resize(entry)
+            self._evict(keep=session_id)
+
+    def get_meta(self, session_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            try:
+                return dict(self._touch(session_id).meta)
+            except KeyError:
+                return None
+
+    def update_meta(self, session_id: str, **fields: Any) -> None:
+        with self._lock:
+            entry = self._touch(session_id)
+            self._unindex(session_id, entry)
+            entry.meta.update(fields)
+            entry.meta["updated_at"] = utcnow_iso()
+            self._index(session_id, entry)
+            self._resize(entry)
+            self._evict(keep=session_id)
+
+    def update_meta_if(self, session_id: str, expected: Dict[str, Any], **fields: Any) -> bool:
+        with self._lock:
+            entry = self._touch(session_id)
+            if any(entry.meta.get(key) != value for key, value in expected.items()):
+                return False
+            self.update_meta(session_id, **fields)
+            return True
+
+    def write_document_if(
+        self,
+        session_id: str,
+        expected: Dict[str, Any],
+        document: DocumentVersion,
+        chunks: Dict[str, bytes],
+        *,
+        keep: int = 0,
+        **fields: Any,
+    ) -> bool:
+        with self._lock:
+            entry = self._touch(session_id)
+            if any(entry.meta.get(key) != value for key, value in expected.items()):
+                return False
+            self._ref(document.manifest, chunks)
+            entry.versions.append(document)
+            while keep and len(entry.versions) > keep:
+                self._unref(entry.versions.pop(0).manifest)
+            self.update_meta(session_id, **fields)
+            return True
+
+    def get_chunks(self, digests: Sequence[str]) -> Dict[str, bytes]:
+        with self._lock:
+            return {digest: self._chunks[digest] for digest in digests if digest in self._chunks}
+
+    def document_versions(self, session_id: str) -> List[DocumentVersion]:
+        with self._lock:
+            return list(self._touch(session_id).versions)
+
+    def get_messages(self, session_id: str) -> list:
+        with self._lock:
+            return list(self._touch(session_id).messages)
+
+    def append_messages(self, session_id: str, messages: Iterable) -> None:
+        with self._lock:
+            entry = self._touch(session_id)
+            entry.messages.extend(messages)
+            self._set_updated(session_id, entry)
+            self._resize(entry)
+            self._evict(keep=session_id)
+
+    def clear_messages(self, session_id: str) -> None:
+        with self._lock:
+            entry = self._touch(session_id)
+            entry.messages = []
+            self._resize(entry)
+
+    def list_page(
+        self, *, limit: int, cursor: Optional[str] = None, fields: Sequence[str] = DEFAULT_LIST_FIELDS
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        with self._lock:
+            self._evict()
+            end = bisect.bisect_left(self._recency, decode_cursor(cursor)) if cursor else len(self._recency)
+            start = max(0, end - limit)
+            keys = self._recency[start:end][::-1]
+            items = []
+            for _, sid in keys:
+                meta = self._entries[sid].meta
+                items.append({f: sid if f == "session_id" else meta.get(f) for f in fields})
+            next_cursor = encode_cursor(*keys[-1]) if start > 0 and keys else None
+            return items, next_cursor
+
+    def import_sessions(self, records: Sequence[SessionRecord], *, replace: bool = False) -> List[str]:
+        written: List[str] = []
+        with self._lock:
+            for record in records:
+                if record.session_id in self._entries:
+                    if not replace:
+                        continue
+                    self._drop(record.session_id)
+                entry = _Entry(dict(record.meta))
+                entry.messages = list(record.messages)
+                for version in record.versions:
+                    self._ref(version.manifest, record.chunks)
+                    entry.versions.append(version)
+                self._entries[record.session_id] = entry
+                self._index(record.session_id, entry)
+                self._resize(entry)
+                written.append(record.session_id)
+            self._evict()
+        return written
+
+    def delete(self, session_id: str) -> None:
+        with self._lock:
+            if session_id not in self._entries:
+                raise KeyError("session not found")
+            self._drop(session_id)
+
+    def size(self) -> int:
+        return len(self._entries)
+
+    @property
+    def nbytes(self) -> int:
+        return self._bytes
+
+
+# Metadata keys that live in their own columns in the SQL backend
+_SQL_COLUMNS = ("created_at", "updated_at", "document_title", "document_html")
+
+
+class SqlSessionStore(SessionStore):
+    """SQLAlchemy-backed store; SQLite files are opened in WAL mode.
+
+    State lives outside the process, so several uvicorn workers can share it.
+    Document chunks are rows keyed by digest; `document_refs` records which
+    versions use each one, so a chunk is deleted with its last user.
+    """
+
+    def __init__(self, url: str):
+        from sqlalchemy import Column, Integer, LargeBinary, MetaData, String, Table, Text, create_engine, event
+
+        self._sqlite = url.startswith("sqlite")
+        connect_args = {"check_same_thread": False} if self._sqlite else {}
+        self.engine = create_engine(url, connect_args=connect_args)
+        if self._sqlite:
+            @event.listens_for(self.engine, "connect")
+            def _sqlite_pragmas(dbapi_conn, _record):  # pragma: no cover - driver hook
+                cur = dbapi_conn.cursor()
+                cur.execute("PRAGMA journal_mode=WAL")
+                cur.execute("PRAGMA synchronous=NORMAL")
+                cur.execute("PRAGMA busy_timeout=5000")
+                cur.close()
+
+        md = MetaData()
+        self.sessions = Table(
+            "sessions",
+            md,
+            Column("session_id", String(64), primary_key=True),
+            Column("created_at", String(40), nullable=False),
+            Column("updated_at", String(40), nullable=False, index=True),
+            Column("document_title", Text),
+            Column("document_html", Text),
+            Column("meta", Text, nullable=False),
+        )
+        self.messages = Table(
+            "session_messages",
+            md,
+            Column("id", Integer, primary_key=True, autoincrement=True),
+            Column("session_id", String(64), nullable=False, index=True),
+            Column("payload", Text, nullable=False),
+        )
+        self.chunks = Table(
+            "document_chunks",
+            md,
+            Column("digest", String(64), primary_key=True),
+            Column("data", LargeBinary, nullable=False),
+        )
+        self.versions = Table(
+            "document_versions",
+            md,
+            Column("session_id", String(64), primary_key=True),
+            Column("version", Integer, primary_key=True),
+            Column("created_at", String(40), nullable=False),
+            Column("size", Integer, nullable=False),
+            Column("title", Text),
+            Column("manifest", Text, nullable=False),
+        )
+        self.refs = Table(
+            "document_refs",
+            md,
+            Column("id", Integer, primary_key=True, autoincrement=True),
+            Column("session_id", String(64), nullable=False, index=True),
+            Column("version", Integer, nullable=False),
+            Column("digest", String(64), nullable=False, index=True),
+        )
+        md.create_all(self.engine)
+
+    @staticmethod
+    def _split(meta: Dict[str, Any]):
+        columns = {k: meta.get(k) for k in _SQL_COLUMNS if k in meta}
+        rest = {k: v for k, v in meta.items() if k not in _SQL_COLUMNS and k != "session_id"}
+        return columns, rest
+
+    @staticmethod
+    def _row_to_meta(row) -> Dict[str, Any]:
+        meta = json.loads(row.meta)
+        for key in _SQL_COLUMNS:
+            value = getattr(row, key)
+            if value is not None:
+                meta[key] = value
+        return meta
+
+    def _exists(self, conn, session_id: str) -> None:
+        from sqlalchemy import select
+
+        found = conn.execute(select(self.sessions.c.session_id).where(self.sessions.c.session_id == session_id)).first()
+        if found is None:
+            raise KeyError("session not found")
+
+    def create(self, session_id: str, meta: Dict[str, Any]) -> None:
+        columns, rest = self._split(meta)
+        columns.setdefault("created_at", utcnow_iso())
+        columns.setdefault("updated_at", columns["created_at"])
+        with self.engine.begin() as conn:
+            conn.execute(self.sessions.insert().values(session_id=session_id, meta=json.dumps(rest), **columns))
+
+    def get_meta(self, session_id: str) -> Optional[Dict[str, Any]]:
+        from sqlalchemy import select
+
+        with self.engine.connect() as conn:
+            row = conn.execute(select(self.sessions).where(self.sessions.c.session_id == session_id)).first()
+        return self._row_to_meta(row) if row is not None else None
+
+    @contextmanager
+    def _write(self):
+        """A transaction that holds the write lock from its first statement.
+
+        A deferred SQLite transaction only takes the write lock when it first
+        writes, so two workers could both read a row and then both write it;
+        BEGIN IMMEDIATE serializes them. Other databases lock the row with
+        SELECT ... FOR UPDATE instead.
+        """
+        with self.engine.connect() as conn:
+            if self._sqlite:
+                conn.exec_driver_sql("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+
+    def _update(
+        self,
+        session_id: str,
+        expected: Optional[Dict[str, Any]],
+        fields: Dict[str, Any],
+        then: Optional[Callable[[Any], None]] = None,
+    ) -> bool:
+        """Update the session row; `then(conn)` runs in the same transaction once the check has passed."""
+        from sqlalchemy import select
+
+        columns, rest = self._split(fields)
+        columns["updated_at"] = utcnow_iso()
+        with self._write() as conn:
+            values: Dict[str, Any] = dict(columns)
+            if rest or expected:
+                row = conn.execute(
+                    select(self.sessions).where(self.sessions.c.session_id == session_id).with_for_update()
+                ).first()
+                if row is None:
+                    raise KeyError("session not found")
+                if expected:
+                    current = self._row_to_meta(row)
+                    if any(current.get(key) != value for key, value in expected.items()):
+                        return False
+                if rest:
+                    merged = json.loads(row.meta)
+                    merged.update(rest)
+                    values["meta"] = json.dumps(merged)
+            result = conn.execute(self.sessions.update().where(self.sessions.c.session_id == session_id).values(**values))
+            if result.rowcount == 0:
+                raise KeyError("session not found")
+            if then is not None:
+                then(conn)
+        return True
+
+    def update_meta(self, session_id: str, **fields: Any) -> None:
+        self._update(session_id, None, fields)
+
+    def update_meta_if(self, session_id: str, expected: Dict[str, Any], **fields: Any) -> bool:
+        return self._update(session_id, expected, fields)
+
+    def _insert_missing(self, table):
+        """INSERT that skips rows whose key exists, for chunks another writer may add concurrently."""
+        name = self.engine.dialect.name
+        if name == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert
+
+            return insert(table).on_conflict_do_nothing()
+        if name == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert  # type: ignore
+
+            return insert(table).on_conflict_do_nothing()
+        if name in {"mysql", "mariadb"}:
+            return table.insert().prefix_with("IGNORE")
+        return table.insert()
+
+    def _drop_versions(self, conn, session_id: str, versions: Optional[List[int]] = None):
+        from sqlalchemy import and_, exists, select
+
+        refs, chunks = self.refs.c, self.chunks.c
+        where = refs.session_id == session_id
+        owned = self.versions.c.session_id == session_id
+        if versions is not None:
+            where = and_(where, refs.version.in_(versions))
+            owned = and_(owned, self.versions.c.version.in_(versions))
+        digests = [row.digest for row in conn.execute(select(refs.digest).where(where).distinct())]
+        conn.execute(self.refs.delete().where(where))
+        conn.execute(self.versions.delete().where(owned))
+        if digests:
+            still_used = exists().where(refs.digest == chunks.digest)
+            conn.execute(self.chunks.delete().where(and_(chunks.digest.in_(digests), ~still_used)))
+
+    def _insert_version(self, conn, session_id: str, document: DocumentVersion, chunks: Dict[str, bytes]):
+        from sqlalchemy import select
+
+        digests = list(dict.fromkeys(document.manifest))
+        # Reference first, so a concurrent prune never sees these chunks as unused
+        conn.execute(self.refs.insert(), [{"session_id": session_id, "version": document.version, "digest": d} for d in digests])
+        present = {row.digest for row in conn.execute(select(self.chunks.c.digest).where(self.chunks.c.digest.in_(digests)))}
+        missing = [{"digest": d, "data": chunks[d]} for d in digests if d not in present]
+        if missing:
+            conn.execute(self._insert_missing(self.chunks), missing)
+        conn.execute(
+            self.versions.insert().values(
+                session_id=session_id,
+                version=document.version,
+                created_at=document.created_at,
+                size=document.size,
+                title=document.title,
+                manifest=json.dumps(document.manifest),
+            )
+        )
+
+    def write_document_if(
+        self,
+        session_id: str,
+        expected: Dict[str, Any],
+        document: DocumentVersion,
+        chunks: Dict[str, bytes],
+        *,
+        keep: int = 0,
+        **fields: Any,
+    ) -> bool:
+        from sqlalchemy import select
+
+        def _record(conn):
+            self._insert_version(conn, session_id, document, chunks)
+            if keep:
+                old = conn.execute(
+                    select(self.versions.c.version)
+                    .where(self.versions.c.session_id == session_id)
+                    .order_by(self.versions.c.version.desc())
+                    .offset(keep)
+                ).scalars().all()
+                if old:
+                    self._drop_versions(conn, session_id, list(old))
+
+        return self._update(session_id, expected, fields, then=_record)
+
+    def get_chunks(self, digests: Sequence[str]) -> Dict[str, bytes]:
+        from sqlalchemy import select
+
+        if not digests:
+            return {}
+        with self.engine.connect() as conn:
+            rows = conn.execute(select(self.chunks).where(self.chunks.c.digest.in_(list(digests)))).all()
+        return {row.digest: bytes(row.data) for row in rows}
+
+    def document_versions(self, session_id: str) -> List[DocumentVersion]:
+        from sqlalchemy import select
+
+        c = self.versions.c
+        with self.engine.connect() as conn:
+            self._exists(conn, session_id)
+            rows = conn.execute(select(self.versions).where(c.session_id == session_id).order_by(c.version)).all()
+        return [
+            DocumentVersion(version=row.version, manifest=json.loads(row.manifest), size=row.size, created_at=row.created_at, title=row.title)
+            for row in rows
+        ]
+
+    def get_messages(self, session_id: str) -> list:
+        from langchain_core.messages import messages_from_dict  # type: ignore
+        from sqlalchemy import select
+
+        with self.engine.connect() as conn:
+            self._exists(conn, session_id)
+            rows = conn.execute(
+                select(self.messages.c.payload).where(self.messages.c.session_id == session_id).order_by(self.messages.c.id)
+            ).all()
+        return messages_from_dict([json.loads(r.payload) for r in rows])
+
+    def append_messages(self, session_id: str, messages: Iterable) -> None:
+        from langchain_core.messages import message_to_dict  # type: ignore
+
+        payloads = [{"session_id": session_id, "payload": json.dumps(message_to_dict(m))} for m in messages]
+        with self.engine.begin() as conn:
+            result = conn.execute(
+                self.sessions.update().where(self.sessions.c.session_id == session_id).values(updated_at=utcnow_iso())
+            )
+            if result.rowcount == 0:
+                raise KeyError("session not found")
+            if payloads:
+                conn.execute(self.messages.insert(), payloads)
+
+    def clear_messages(self, session_id: str) -> None:
+        with self.engine.begin() as conn:
+            self._exists(conn, session_id)
+            conn.execute(self.messages.delete().where(self.messages.c.session_id == session_id))
+
+    def list_page(
+        self, *, limit: int, cursor: Optional[str] = None, fields: Sequence[str] = DEFAULT_LIST_FIELDS
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        from sqlalchemy import and_, or_, select
+
+        c = self.sessions.c
+        columns = [c.session_id, c.updated_at]
+        columns += [getattr(c, f) for f in fields if f in _SQL_COLUMNS and f != "updated_at"]
+        needs_json = any(f not in _SQL_COLUMNS and f != "session_id" for f in fields)
+        if needs_json:
+            columns.append(c.meta)
+        query = select(*columns).order_by(c.updated_at.desc(), c.session_id.desc()).limit(limit + 1)
+        if cursor:
+            updated_at, session_id = decode_cursor(cursor)
+            query = query.where(or_(c.updated_at < updated_at, and_(c.updated_at == updated_at, c.session_id < session_id)))
+        with self.engine.connect() as conn:
+            rows = conn.execute(query).all()
+
+        items = []
+        for row in rows[:limit]:
+            extra = json.loads(row.meta) if needs_json else {}
+            mapping = row._mapping
+            items.append({f: mapping[f] if f in mapping else extra.get(f) for f in fields})
+        next_cursor = encode_cursor(rows[limit - 1].updated_at, rows[limit - 1].session_id) if len(rows) > limit else None
+        return items, next_cursor
+
+    def import_sessions(self, records: Sequence[SessionRecord], *, replace: bool = False) -> List[str]:
+        from langchain_core.messages import message_to_dict  # type: ignore
+        from sqlalchemy import select
+
+        c = self.sessions.c
+        written: List[str] = []
+        with self._write() as conn:
+            for record in records:
+                sid = record.session_id
+                if conn.execute(select(c.session_id).where(c.session_id == sid)).first() is not None:
+                    if not replace:
+                        continue
+                    conn.execute(self.messages.delete().where(self.messages.c.session_id == sid))
+                    self._drop_versions(conn, sid)
+                    conn.execute(self.sessions.delete().where(c.session_id == sid))
+                columns, rest = self._split(record.meta)
+                columns.setdefault("created_at", utcnow_iso())
+                columns.setdefault("updated_at", columns["created_at"])
+                conn.execute(self.sessions.insert().values(session_id=sid, meta=json.dumps(rest), **columns))
+                if record.messages:
+                    conn.execute(
+                        self.messages.insert(),
+                        [{"session_id": sid, "payload": json.dumps(message_to_dict(m))} for m in record.messages],
+                    )
+                for version in record.versions:
+                    self._insert_version(conn, sid, version, record.chunks)
+                written.append(sid)
+        return written
+
+    def delete(self, session_id: str) -> None:
+        with self.engine.begin() as conn:
+            conn.execute(self.messages.delete().where(self.messages.c.session_id == session_id))
+            self._drop_versions(conn, session_id)
+            result = conn.execute(self.sessions.delete().where(self.sessions.c.session_id == session_id))
+            if result.rowcount == 0:
+                raise KeyError("session not found")
+
+    def size(self) -> int:
+        from sqlalchemy import func, select
+
+        with self.engine.connect() as conn:
+            return int(conn.execute(select(func.count()).select_from(self.sessions)).scalar() or 0)
+
+    def close(self) -> None:
+        self.engine.dispose()
+
+
+def create_store(settings: Settings) -> SessionStore:
+    backend = settings.session_store
+    if backend == "memory":
+        return MemorySessionStore(
+            max_sessions=settings.session_max_sessions,
+            ttl_seconds=settings.session_ttl_seconds,
+            max_bytes=settings.session_memory_budget_mb * 1024 * 1024,
+        )
+    if backend in {"sqlite", "sql"}:
+        return SqlSessionStore(settings.session_db_url)
+    raise RuntimeError(f"Unknown SESSION_STORE backend: {backend}")
+
+
+_STORE: Optional[SessionStore] = None
+
+
+def get_store() -> SessionStore:
+    global _STORE
+    if _STORE is None:
+        _STORE = create_store(get_settings())
+    return _STORE
+
+
+def init_store(settings: Settings) -> SessionStore:
+    global _STORE
+    if _STORE is not None:
+        _STORE.close()
+    _STORE = create_store(settings)
+    return _STORE
+
+
+def close_store() -> None:
+    global _STORE
+    store, _STORE = _STORE, None
+    if store is not None:
+        store.close()
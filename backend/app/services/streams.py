@@ -0,0 +1,357 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from typing import Any, AsyncGenerator, AsyncIterator, Callable, Deque, List, Optional, Tuple
+
+from ..config import Settings, get_settings
+from ..encoders import coalesce, dumps
+from ..utils import spawn_background
+
+
+class StreamBuffer:
+    """Append-only log of stream items with a bounded in-memory tail.
+
+    Once the tail exceeds `max_memory_bytes` its oldest items spill to an
+    anonymous temp file (one JSON document per item), so a late reader can
+    still replay from offset 0 without the whole stream staying in memory.
+    The lock guards only the in-memory bookkeeping: spilled items are
+    immutable once written and are read back with positional reads, so
+    `spill` and `read` may run in worker threads alongside appends.
+    """
+
+    def __init__(self, max_memory_bytes: int = 256 * 1024):
+        self.max_memory_bytes = max_memory_bytes
+        self._tail: Deque[Tuple[Any, int]] = deque()
+        self._tail_bytes = 0
+        self._spilled = 0
+        self._spill = None
+        self._spill_end = 0
+        # Byte position of each spilled item in the spill file, plus the end of the last one
+        self._positions: List[int] = []
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._spilled + len(self._tail)
+
+    @property
+    def memory_bytes(self) -> int:
+        return self._tail_bytes
+
+    @property
+    def over_budget(self) -> bool:
+        return self._tail_bytes > self.max_memory_bytes and len(self._tail) > 1
+
+    def append(self, item: Any, *, spill: bool = True):
+        """Add `item`; with `spill` false the caller runs `spill()` itself (e.g. off the event loop)."""
+        size = len(item) if isinstance(item, str) else len(dumps(item))
+        with self._lock:
+            self._tail.append((item, size))
+            self._tail_bytes += size
+        if spill:
+            self.spill()
+
+    def spill(self):
+        """Move the oldest tail items to the spill file until the tail fits its budget (file I/O)."""
+        with self._lock:
+            overflow, excess = [], self._tail_bytes - self.max_memory_bytes
+            for item, size in self._tail:
+                if excess <= 0 or len(overflow) == len(self._tail) - 1:
+                    break
+                overflow.append(item)
+                excess -= size
+        if not overflow:
+            return
+        if self._spill is None:
+            self._spill = tempfile.TemporaryFile()
+        positions = []
+        data = bytearray()
+        for item in overflow:
+            positions.append(self._spill_end + len(data))
+            data += dumps(item) + b"\n"
+        os.pwrite(self._spill.fileno(), bytes(data), self._spill_end)
+        with self._lock:
+            self._spill_end += len(data)
+            self._positions += positions
+            for _ in overflow:
+                _, size = self._tail.popleft()
+                self._tail_bytes -= size
+            self._spilled += len(overflow)
+
+    def read(self, start: int, end: Optional[int] = None) -> List[Any]:
+        with self._lock:
+            end = len(self) if end is None else min(end, len(self))
+            spilled = self._spilled
+            stop = min(end, spilled)
+            span = (self._positions[start], self._positions[stop] if stop < spilled else self._spill_end) if start < stop else None
+            tail = [self._tail[i][0] for i in range(max(start, spilled) - spilled, end - spilled)]
+        items: List[Any] = []
+        if span is not None and self._spill is not None:
+            raw = os.pread(self._spill.fileno(), span[1] - span[0], span[0])
+            items = [json.loads(line) for line in raw.splitlines()]
+        return items + tail
+
+    def needs_io(self, start: int) -> bool:
+        """Whether reading from `start` touches the spill file."""
+        return start < self._spilled
+
+    def text(self) -> str:
+        return "".join(item for item in self.read(0) if isinstance(item, str))
+
+    def close(self):
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+
+class TokenBroadcast:
+    """Fan one upstream token stream out to any number of subscribers.
+
+    The producer runs as its own task and appends to a shared buffer; each
+    subscriber replays the buffer from its offset and then follows live
+    tokens, so a client that reconnects resumes where it left off. When the
+    last subscriber leaves before the stream has finished, the producer is
+    cancelled after `detach_grace` seconds unless someone subscribes again.
+    """
+
+    def __init__(self, *, max_memory_bytes: int = 256 * 1024, detach_grace: float = 0.0):
+        self.id = uuid.uuid4().hex
+        self.buffer = StreamBuffer(max_memory_bytes)
+        self.detach_grace = detach_grace
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.finished_at: Optional[float] = None
+        self.subscribers = 0
+        self._cond = asyncio.Condition()
+        self._task: Optional["asyncio.Task[None]"] = None
+        self._detach_timer: Optional[asyncio.TimerHandle] = None
+        self._done_callbacks: List[Callable[[], Any]] = []
+        # Set once the producer is past on_complete; with _retired, the buffer is freed when the last reader leaves
+        self._stopped = False
+        self._retired = False
+
+    def start(
+        self,
+        source: AsyncIterator[Any],
+        *,
+        on_complete: Optional[Callable[[str], object]] = None,
+        name: Optional[str] = None,
+        batch_bytes: int = 0,
+        batch_delay: float = 0.0,
+    ):
+        async def _produce():
+            try:
+                # Buffer batches rather than single tokens; every buffered item is one resumable event
+                async for item in coalesce(source, max_bytes=batch_bytes, max_delay=batch_delay):
+                    if item:
+                        await self.publish(item)
+                await self.finish()
+            except asyncio.CancelledError:
+                await self.finish(error=ConnectionAbortedError("stream abandoned"))
+                raise
+            except Exception as exc:
+                await self.finish(error=exc)
+            else:
+                # After finish, so subscribers are not held up by it and a failure here cannot fail the stream
+                if on_complete is not None:
+                    try:
+                        result = on_complete(await self._read_text())
+                        if asyncio.iscoroutine(result):
+                            await result
+                    except Exception:
+                        pass
+            finally:
+                self._stopped = True
+                callbacks, self._done_callbacks = self._done_callbacks, []
+                for callback in callbacks:
+                    callback()
+                self._release_if_retired()
+
+        self._task = spawn_background(_produce(), name=name)
+        return self
+
+    def add_done_callback(self, callback: Callable[[], Any]):
+        """Call `callback` once the producer has stopped, however it ended (now, if it already has).
+
+        Work bounded by the upstream run, such as an admission slot, belongs
+        here rather than with any one subscriber: the run outlives them.
+        """
+        if self._task is None or self._task.done():
+            callback()
+        else:
+            self._done_callbacks.append(callback)
+
+    async def _read(self, start: int) -> List[Any]:
+        if self.buffer.needs_io(start):
+            return await asyncio.to_thread(self.buffer.read, start)
+        return self.buffer.read(start)
+
+    async def locate(self, chars: int) -> Tuple[int, int]:
+        """The item holding text character `chars`, and how far into it that is.
+
+        Plain-text and legacy JSON clients see no event ids, only text, so
+        they resume by how many characters they received; other items (patch
+        events) count as no characters. A ValueError if fewer were produced.
+        """
+        seen = 0
+        for index, item in enumerate(await self._read(0)):
+            size = len(item) if isinstance(item, str) else 0
+            if seen + size > chars:
+                return index, chars - seen
+            seen += size
+        if seen < chars:
+            raise ValueError("offset is beyond the end of the stream")
+        return len(self.buffer), 0
+
+    async def _read_text(self) -> str:
+        if self.buffer.needs_io(0):
+            return await asyncio.to_thread(self.buffer.text)
+        return self.buffer.text()
+
+    async def publish(self, item: Any):
+        async with self._cond:
+            self.buffer.append(item, spill=False)
+            self._cond.notify_all()
+        if self.buffer.over_budget:
+            # Temp-file writes happen in a thread, outside the condition
+            await asyncio.to_thread(self.buffer.spill)
+
+    async def finish(self, error: Optional[BaseException] = None):
+        async with self._cond:
+            self.done = True
+            self.error = error
+            self.finished_at = time.monotonic()
+            self._cond.notify_all()
+
+    def _detach(self):
+        if self.done or self._task is None:
+            return
+        if self.detach_grace <= 0:
+            self._task.cancel()
+            return
+        self._detach_timer = asyncio.get_running_loop().call_later(self.detach_grace, self._cancel_if_unwatched)
+
+    def _cancel_if_unwatched(self):
+        self._detach_timer = None
+        if self.subscribers == 0 and not self.done and self._task is not None:
+            self._task.cancel()
+
+    async def subscribe(self, offset: int = 0, *, skip_chars: int = 0) -> AsyncGenerator[Any, None]:
+        """Replay from item `offset`, leaving out the first `skip_chars` characters of that item, then follow live."""
+        self.subscribers += 1
+        if self._detach_timer is not None:
+            self._detach_timer.cancel()
+            self._detach_timer = None
+        index = max(0, offset)
+        try:
+            while True:
+                async with self._cond:
+                    while index >= len(self.buffer) and not self.done:
+                        await self._cond.wait()
+                    done = self.done
+                batch = await self._read(index)
+                index += len(batch)
+                finished = done and index >= len(self.buffer)
+                for item in batch:
+                    if skip_chars and isinstance(item, str):
+                        item, skip_chars = item[skip_chars:], 0
+                    yield item
+                if finished:
+                    if self.error is not None:
+                        raise self.error
+                    return
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0:
+                self._detach()
+                self._release_if_retired()
+
+    def retire(self):
+        """Free the buffer once the run has ended and nobody reads it any more (now, if that is already so).
+
+        For a stream that can no longer be resumed but may still be running
+        or being read: unlike `close`, the run is left to finish.
+        """
+        self._retired = True
+        self._release_if_retired()
+
+    def _release_if_retired(self):
+        if self._retired and (self._stopped or self._task is None) and self.subscribers == 0:
+            self._release()
+
+    def _release(self):
+        if self._detach_timer is not None:
+            self._detach_timer.cancel()
+            self._detach_timer = None
+        self.buffer.close()
+
+    def close(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+        self._release()
+
+
+class StreamRegistry:
+    """Resumable streams by id, kept `ttl` seconds after they finish; at most `max_streams`."""
+
+    def __init__(self, *, ttl: float = 300.0, max_streams: int = 1000):
+        self.ttl = ttl
+        self.max_streams = max_streams
+        self._streams: "OrderedDict[str, TokenBroadcast]" = OrderedDict()
+
+    def _prune(self):
+        now = time.monotonic()
+        for stream_id in [sid for sid, b in self._streams.items() if b.finished_at is not None and now - b.finished_at > self.ttl]:
+            self._streams.pop(stream_id).close()
+        while len(self._streams) > self.max_streams:
+            _, oldest = self._streams.popitem(last=False)
+            # A stream still running (or read) keeps going; it just can no longer be resumed
+            oldest.retire()
+
+    def register(self, broadcast: TokenBroadcast) -> str:
+        self._streams[broadcast.id] = broadcast
+        self._prune()
+        return broadcast.id
+
+    def get(self, stream_id: str) -> Optional[TokenBroadcast]:
+        self._prune()
+        return self._streams.get(stream_id)
+
+    def __len__(self) -> int:
+        return len(self._streams)
+
+
+_REGISTRY: Optional[StreamRegistry] = None
+
+
+def init_streams(settings: Settings) -> StreamRegistry:
+    global _REGISTRY
+    _REGISTRY = StreamRegistry(ttl=settings.stream_resume_ttl, max_streams=settings.stream_max_resumable)
+    return _REGISTRY
+
+
+def get_stream_registry() -> StreamRegistry:
+    if _REGISTRY is None:
+        return init_streams(get_settings())
+    return _REGISTRY
+
+
+def start_resumable(source: AsyncIterator[Any], *, name: str, on_complete: Optional[Callable[[str], object]] = None) -> TokenBroadcast:
+    """Run `source` detached from any one connection and register it for resumption."""
+    settings = get_settings()
+    broadcast = TokenBroadcast(
+        max_memory_bytes=settings.stream_buffer_memory_kb * 1024,
+        detach_grace=settings.stream_detach_grace,
+    ).start(
+        source,
+        on_complete=on_complete,
+        name=name,
+        batch_bytes=settings.stream_batch_bytes,
+        batch_delay=settings.stream_batch_ms / 1000.0,
+    )
+    get_stream_registry().register(broadcast)
+    return broadcast
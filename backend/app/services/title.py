@@ -1,46 +1,96 @@
-from typing import Optional
+import asyncio
+import time
+from typing import Optional, Set
 
-from openai import AsyncOpenAI
+from ..config import get_settings
+from ..clients import get_clients
+from ..metrics import TITLE_DURATION, record_usage, span
+from ..routing import route_messages
+from ..utils import hedged, spawn_background
+from .store import get_store
 
-from ..config import load_settings
-from ..utils import retry_async
+_IN_FLIGHT: Set[str] = set()
 
 
 async def generate_session_title(*, user_input: str, base_doc_markdown: Optional[str] = None) -> str:
-    settings = load_settings()
+    settings = get_settings()
     if not settings.openai_api_key:
         # Fallback: simple heuristic from input
         return _fallback_title(user_input)
 
-    async_client = AsyncOpenAI(api_key=settings.openai_api_key)
+    clients = get_clients()
+    async_client = clients.openai()
 
-    prompts = settings.prompts or {}
-    instruction = prompts.get("title", {}).get("instruction") or (
-        "You are naming a legal document editing session. Generate a concise, professional 3-7 word title based on the user's request and, if provided, the current Markdown document. Prefer specific nouns (e.g., company name, jurisdiction) and keep it neutral. Return ONLY the title text without quotes."
-    )
+    instruction = settings.templates.title_instruction
     content = f"User request:\n{user_input.strip()}\n"
     if base_doc_markdown:
         content += "\nDocument excerpt (may be truncated):\n" + base_doc_markdown[:4000]
+    messages = [
+        {"role": "system", "content": instruction},
+        {"role": "user", "content": content},
+    ]
+    route = route_messages("title", messages, output_tokens=16, ceiling=32, settings=settings)
+    # An explicit TITLE_MODEL still wins over the routed tier
+    model = settings.title_model or route.model
 
     async def _create():
         return await async_client.chat.completions.create(
-            model=settings.openai_model,
-            messages=[
-                {"role": "system", "content": instruction},
-                {"role": "user", "content": content},
-            ],
+            model=model,
+            messages=messages,
             temperature=0.2,
-            max_tokens=32,
+            max_tokens=route.max_tokens,
         )
 
+    started = time.perf_counter()
     try:
-        resp = await retry_async(_create)
+        with span("llm.title", model=model, tier=route.tier):
+            # Titles are tiny; a second copy after `title_hedge_delay` cuts the latency tail.
+            # Retries stop at TITLE_TIMEOUT, when the caller falls back to a derived title anyway
+            resp = await clients.retry(lambda: hedged(_create, delay=settings.title_hedge_delay), deadline=settings.title_timeout)
+        record_usage(getattr(resp, "usage", None), stage="title")
         text = (resp.choices[0].message.content or "").strip()
+        TITLE_DURATION.observe(time.perf_counter() - started, outcome="ok" if text else "fallback")
         return text or _fallback_title(user_input)
     except Exception:
+        TITLE_DURATION.observe(time.perf_counter() - started, outcome="error")
         return _fallback_title(user_input)
 
 
+def schedule_session_title(*, session_id: str, user_input: str, base_doc_markdown: Optional[str] = None):
+    """Name the session in the background so the chat stream does not wait on it."""
+    if session_id in _IN_FLIGHT:
+        return
+    _IN_FLIGHT.add(session_id)
+    spawn_background(_title_session(session_id, user_input, base_doc_markdown), name=f"title:{session_id}")
+
+
+async def _title_session(session_id: str, user_input: str, base_doc_markdown: Optional[str]):
+    started = time.perf_counter()
+    try:
+        try:
+            title = await asyncio.wait_for(
+                generate_session_title(user_input=user_input, base_doc_markdown=base_doc_markdown),
+                timeout=get_settings().title_timeout,
+            )
+        except asyncio.TimeoutError:
+            TITLE_DURATION.observe(time.perf_counter() - started, outcome="timeout")
+            title = _fallback_title(user_input)
+        if title:
+            await asyncio.to_thread(_save_title, session_id, title)
+    except Exception:
+        pass
+    finally:
+        _IN_FLIGHT.discard(session_id)
+
+
+def _save_title(session_id: str, title: str):
+    store = get_store()
+    meta = store.get_meta(session_id)
+    # Keep a title the user set while this one was being generated
+    if meta is not None and not meta.get("document_title"):
+        store.update_meta_if(session_id, {"document_title": meta.get("document_title")}, document_title=title)
+
+
 def _fallback_title(user_input: str) -> str:
     s = user_input.strip()
     if len(s) > 60:
@@ -0,0 +1,220 @@
+import asyncio
+import base64
+import json
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+from ..config import Settings, get_settings
+from ..encoders import dumps
+from .documents import chunk_digest, decompress
+from .session import ensure_langchain_available
+from .store import DocumentVersion, SessionRecord, SessionStore, encode_cursor, get_store, utcnow_iso
+
+
+# Bumped when a record changes shape; import refuses streams it does not know
+EXPORT_FORMAT = 1
+
+
+class ImportFailed(ValueError):
+    """A line of an import stream could not be used; `summary` counts what was written before it."""
+
+    def __init__(self, message: str, summary: Dict[str, Any]):
+        super().__init__(message)
+        self.summary = summary
+
+
+def parse_timestamp(value: Optional[str]) -> Optional[str]:
+    """An ISO 8601 time as the stores write it (UTC, `isoformat`), so it compares as a string; naive times are UTC."""
+    if not value:
+        return None
+    try:
+        moment = datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+    except ValueError:
+        raise ValueError(f"invalid timestamp: {value}")
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.astimezone(timezone.utc).isoformat()
+
+
+def _in_range(updated_at: Optional[str], since: Optional[str], until: Optional[str]) -> bool:
+    stamp = updated_at or ""
+    return (since is None or stamp >= since) and (until is None or stamp < until)
+
+
+def _session_line(store: SessionStore, session_id: str) -> Optional[Dict[str, Any]]:
+    from langchain_core.messages import messages_to_dict  # type: ignore
+
+    meta = store.get_meta(session_id)
+    if meta is None:
+        return None
+    try:
+        messages = store.get_messages(session_id)
+        versions = store.document_versions(session_id)
+    except KeyError:
+        # Deleted while the export was running
+        return None
+    chunks = store.get_chunks(list(dict.fromkeys(d for version in versions for d in version.manifest)))
+    return {
+        "type": "session",
+        "session_id": session_id,
+        "meta": meta,
+        "messages": messages_to_dict(messages),
+        "versions": [
+            {
+                "version": version.version,
+                "created_at": version.created_at,
+                "size": version.size,
+                "title": version.title,
+                "manifest": version.manifest,
+            }
+            for version in versions
+        ],
+        # Stored (compressed) payloads, so export neither inflates nor recompresses them
+        "chunks": {digest: base64.b64encode(blob).decode("ascii") for digest, blob in chunks.items()},
+    }
+
+
+def export_sessions(*, since: Optional[str] = None, until: Optional[str] = None, settings: Optional[Settings] = None) -> Iterator[bytes]:
+    """Every session last updated in [since, until) as NDJSON lines, most recently updated first.
+
+    The stream is a `header` line, one self-contained `session` line per
+    session (metadata, history, document versions and the chunks they use)
+    and an `end` line with the count, so an importer can tell a complete
+    stream from a cut one. Sessions are read a page at a time through the
+    store's keyset listing, which starts at `until` and stops at `since`:
+    memory holds one page of ids and one session, however large the store.
+    """
+    ensure_langchain_available()
+    return _export(get_store(), since, until, settings or get_settings())
+
+
+def _export(store: SessionStore, since: Optional[str], until: Optional[str], settings: Settings) -> Iterator[bytes]:
+    yield dumps({"type": "header", "format": EXPORT_FORMAT, "exported_at": utcnow_iso(), "since": since, "until": until}) + b"\n"
+    # The cursor excludes (until, "") and everything after it: updated_at < until
+    cursor = encode_cursor(until, "") if until else None
+    count = 0
+    while True:
+        page, cursor = store.list_page(limit=settings.session_export_page_size, cursor=cursor, fields=("session_id", "updated_at"))
+        for item in page:
+            if since is not None and (item["updated_at"] or "") < since:
+                cursor = None
+                break
+            line = _session_line(store, item["session_id"])
+            if line is not None:
+                count += 1
+                yield dumps(line) + b"\n"
+        if cursor is None:
+            break
+    yield dumps({"type": "end", "sessions": count}) + b"\n"
+
+
+def _record(data: Dict[str, Any]) -> SessionRecord:
+    from langchain_core.messages import messages_from_dict  # type: ignore
+
+    session_id = data["session_id"]
+    if not isinstance(session_id, str) or not session_id or len(session_id) > 64:
+        raise ValueError("invalid session_id")
+    meta = data["meta"]
+    if not isinstance(meta, dict):
+        raise ValueError("meta must be an object")
+    chunks = {digest: base64.b64decode(blob) for digest, blob in (data.get("chunks") or {}).items()}
+    for digest, blob in chunks.items():
+        if chunk_digest(decompress(blob)) != digest:
+            raise ValueError(f"chunk {digest} does not match its digest")
+    versions = [
+        DocumentVersion(
+            version=int(v["version"]),
+            manifest=[str(d) for d in v["manifest"]],
+            size=int(v["size"]),
+            created_at=str(v["created_at"]),
+            title=v.get("title"),
+        )
+        for v in data.get("versions") or []
+    ]
+    manifest = meta.get("document_manifest")
+    if manifest is not None and not isinstance(manifest, list):
+        raise ValueError("document_manifest must be a list")
+    # The current document is read through meta's manifest, not the versions
+    missing = {d for version in versions for d in version.manifest}.union(manifest or ()) - chunks.keys()
+    if missing:
+        raise ValueError(f"missing chunk {sorted(missing)[0]}")
+    return SessionRecord(session_id, meta, messages_from_dict(data.get("messages") or []), versions, chunks)
+
+
+async def _lines(body: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    # Pieces of the unfinished line, joined once it ends, so a long line is not re-copied per chunk
+    pending: List[bytes] = []
+    async for chunk in body:
+        parts = chunk.split(b"\n")
+        if len(parts) == 1:
+            pending.append(chunk)
+            continue
+        yield b"".join(pending) + parts[0]
+        for line in parts[1:-1]:
+            yield line
+        pending = [parts[-1]]
+    if any(pending):
+        yield b"".join(pending)
+
+
+async def import_sessions(
+    body: AsyncIterator[bytes],
+    *,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    replace: bool = False,
+    settings: Optional[Settings] = None,
+) -> Dict[str, Any]:
+    """Ingest an `export_sessions` stream, writing SESSION_IMPORT_BATCH_SIZE sessions per store transaction.
+
+    Only one batch is held in memory. Sessions outside [since, until) are
+    counted as `filtered`; sessions that already exist are `skipped` unless
+    `replace`. A malformed line raises ImportFailed naming it; batches
+    written before it stay written. `complete` is false when the stream
+    had no `end` line or its count did not match, e.g. an export cut short.
+    """
+    ensure_langchain_available()
+    settings = settings or get_settings()
+    store = get_store()
+    batch: List[SessionRecord] = []
+    summary: Dict[str, Any] = {"imported": 0, "skipped": 0, "filtered": 0, "batches": 0, "complete": False}
+    seen = 0
+    expected: Optional[int] = None
+
+    async def _flush():
+        written = await asyncio.to_thread(store.import_sessions, list(batch), replace=replace)
+        summary["imported"] += len(written)
+        summary["skipped"] += len(batch) - len(written)
+        summary["batches"] += 1
+        batch.clear()
+
+    number = 0
+    async for line in _lines(body):
+        number += 1
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line)
+            kind = data["type"]
+            if kind == "header":
+                if data.get("format") != EXPORT_FORMAT:
+                    raise ValueError(f"unsupported export format {data.get('format')}")
+            elif kind == "end":
+                expected = int(data["sessions"])
+            elif kind == "session":
+                seen += 1
+                if not _in_range(data["meta"].get("updated_at"), since, until):
+                    summary["filtered"] += 1
+                    continue
+                # Decoding and checking every chunk is CPU-bound; keep it off the loop
+                batch.append(await asyncio.to_thread(_record, data))
+            else:
+                raise ValueError(f"unknown record type {kind}")
+        except (ValueError, KeyError, TypeError, AttributeError) as exc:
+            raise ImportFailed(f"line {number}: {str(exc).strip(chr(39)) or type(exc).__name__}", summary)
+        if len(batch) >= settings.session_import_batch_size:
+            await _flush()
+    if batch:
+        await _flush()
+    summary["complete"] = expected is not None and expected == seen
+    return summary
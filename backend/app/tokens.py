@@ -0,0 +1,69 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, Tuple
+
+try:
+    import tiktoken  # type: ignore
+except Exception:  # pragma: no cover
+    tiktoken = None  # type: ignore
+
+
+# Per-message framing overhead in the chat format (role markers, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Counts of recent texts keyed by digest, so cached documents do not keep their text alive
+COUNT_CACHE_SIZE = 1024
+
+_ENCODINGS: Dict[str, object] = {}
+_COUNTS: "OrderedDict[Tuple[bytes, str], int]" = OrderedDict()
+_COUNTS_LOCK = threading.Lock()
+
+
+def _encoding(model: str):
+    if model in _ENCODINGS:
+        return _ENCODINGS[model]
+    encoding = None
+    if tiktoken is not None:
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            try:
+                encoding = tiktoken.get_encoding("o200k_base")
+            except Exception:
+                encoding = None
+        except Exception:
+            # Encoding files are fetched on first use; remember the failure instead of retrying per call
+            encoding = None
+    _ENCODINGS[model] = encoding
+    return encoding
+
+
+def count_tokens(text: str, model: str = "gpt-4o") -> int:
+    """Token count for `text`; falls back to ~4 characters per token without tiktoken data."""
+    if not text:
+        return 0
+    key = (hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest(), model)
+    with _COUNTS_LOCK:
+        if key in _COUNTS:
+            _COUNTS.move_to_end(key)
+            return _COUNTS[key]
+    encoding = _encoding(model)
+    if encoding is None:
+        count = (len(text) + 3) // 4
+    else:
+        count = len(encoding.encode(text, disallowed_special=()))  # type: ignore[attr-defined]
+    with _COUNTS_LOCK:
+        _COUNTS[key] = count
+        while len(_COUNTS) > COUNT_CACHE_SIZE:
+            _COUNTS.popitem(last=False)
+    return count
+
+
+def count_message_tokens(messages: Iterable, model: str = "gpt-4o") -> int:
+    total = 0
+    for message in messages:
+        content = getattr(message, "content", message if isinstance(message, str) else "")
+        total += MESSAGE_OVERHEAD_TOKENS + count_tokens(content if isinstance(content, str) else "", model)
+    return total
+
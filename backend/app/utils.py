@@ -1,6 +1,22 @@
 import asyncio
+import importlib.util
+import random
 import time
-from typing import Any, AsyncGenerator, Optional
+from functools import lru_cache
+from typing import Any, Awaitable, Optional, Set
+
+import httpx
+
+from .metrics import UPSTREAM_ERRORS, UPSTREAM_RETRIES, error_class
+
+
+@lru_cache(maxsize=None)
+def module_available(name: str) -> bool:
+    """Whether top-level module `name` is installed, checked without importing it."""
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
 
 
 async def async_sleep_yield():
@@ -8,50 +24,239 @@ async def async_sleep_yield():
     await asyncio.sleep(0)
 
 
-def retry_sync(fn, *, attempts: int = 3, base_delay: float = 0.5):
-    last_exc: Optional[Exception] = None
+_BACKGROUND_TASKS: Set["asyncio.Task[Any]"] = set()
+
+
+def spawn_background(coro: Awaitable[Any], *, name: Optional[str] = None) -> "asyncio.Task[Any]":
+    """Run `coro` as a tracked task so it is neither garbage-collected nor leaked at shutdown."""
+    task = asyncio.ensure_future(coro)
+    if name:
+        task.set_name(name)
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_BACKGROUND_TASKS.discard)
+    return task
+
+
+async def drain_background(timeout: float = 5.0):
+    """Give tracked tasks `timeout` seconds to finish, then cancel the rest."""
+    loop = asyncio.get_running_loop()
+    pending = [t for t in _BACKGROUND_TASKS if not t.done() and t.get_loop() is loop]
+    if not pending:
+        return
+    _done, still_pending = await asyncio.wait(pending, timeout=timeout)
+    for task in still_pending:
+        task.cancel()
+    if still_pending:
+        await asyncio.gather(*still_pending, return_exceptions=True)
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised without calling upstream while its circuit breaker is open."""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"{name} temporarily unavailable")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Fails fast after `threshold` consecutive retryable failures.
+
+    After `reset_timeout` seconds one probe call is let through (half-open);
+    its success closes the breaker, its failure re-opens it. A probe that
+    ends without either (e.g. it was cancelled) must call `end_probe`, or
+    no further probe would ever be let through.
+    """
+
+    def __init__(self, name: str, *, threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def retry_after(self) -> float:
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def before_call(self) -> bool:
+        """Raise CircuitOpenError, or admit the call; True when it is the half-open probe."""
+        state = self.state
+        if state == "open" or (state == "half_open" and self._probing):
+            raise CircuitOpenError(self.name, self.retry_after() or 1.0)
+        if state == "half_open":
+            self._probing = True
+            return True
+        return False
+
+    def end_probe(self):
+        self._probing = False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.threshold and (self.failures >= self.threshold or self.opened_at is not None):
+            self.opened_at = time.monotonic()
+
+
+_RETRYABLE_STATUS = {408, 409, 425, 429, 500, 502, 503, 504}
+
+
+def _status_code(exc: BaseException) -> Optional[int]:
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def retry_after_seconds(exc: BaseException) -> Optional[float]:
+    """The upstream's Retry-After hint (`retry-after-ms` or `retry-after`), if it sent one."""
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000.0
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        return None
+    return None
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """Transient failures only: timeouts, dropped connections, 408/409/429 and 5xx.
+
+    Auth errors, bad requests and exhausted quota fail on the first attempt.
+    """
+    if isinstance(exc, CircuitOpenError):
+        return False
+    status = _status_code(exc)
+    if status is not None:
+        if status == 429 and getattr(exc, "code", None) == "insufficient_quota":
+            return False
+        return status in _RETRYABLE_STATUS
+    if isinstance(exc, (asyncio.TimeoutError, TimeoutError, ConnectionError)):
+        return True
+    # SDK connection/timeout errors carry no status code
+    name = type(exc).__name__
+    return name in {"APIConnectionError", "APITimeoutError"} or isinstance(exc, httpx.TransportError)
+
+
+def backoff_delay(attempt: int, *, base_delay: float, max_delay: float, retry_after: Optional[float] = None) -> float:
+    """Full jitter: uniform in [0, min(max_delay, base * 2^(attempt-1))], never sooner than Retry-After."""
+    delay = random.uniform(0, min(max_delay, base_delay * (2 ** (attempt - 1))))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+def retry_sync(fn, *, attempts: int = 3, base_delay: float = 0.5, max_delay: float = 8.0, deadline: Optional[float] = None):
+    started = time.monotonic()
     for attempt in range(1, attempts + 1):
         try:
             return fn()
-        except Exception as exc:  # pragma: no cover
-            last_exc = exc
-            if attempt == attempts:
-                break
-            time.sleep(base_delay * (2 ** (attempt - 1)))
-    raise last_exc  # type: ignore[misc]
+        except Exception as exc:
+            UPSTREAM_ERRORS.inc(error=error_class(exc))
+            if attempt == attempts or not is_retryable(exc):
+                raise
+            delay = backoff_delay(attempt, base_delay=base_delay, max_delay=max_delay, retry_after=retry_after_seconds(exc))
+            if deadline is not None and time.monotonic() - started + delay > deadline:
+                raise
+            UPSTREAM_RETRIES.inc()
+            time.sleep(delay)
+
 
+async def retry_async(
+    fn,
+    *,
+    attempts: int = 3,
+    base_delay: float = 0.5,
+    max_delay: float = 8.0,
+    deadline: Optional[float] = None,
+    breaker: Optional[CircuitBreaker] = None,
+):
+    """Call `fn` until it succeeds, a non-retryable error occurs, or attempts or the deadline run out.
 
-async def retry_async(fn, *, attempts: int = 3, base_delay: float = 0.5):
-    last_exc: Optional[Exception] = None
+    `deadline` bounds the total time spent including waits: a retry whose
+    backoff would overrun it is not attempted. With a `breaker`, calls fail
+    fast while it is open and retryable failures count towards opening it.
+    """
+    started = time.monotonic()
     for attempt in range(1, attempts + 1):
+        probe = breaker.before_call() if breaker is not None else False
         try:
-            return await fn()
-        except Exception as exc:  # pragma: no cover
-            last_exc = exc
-            if attempt == attempts:
-                break
-            await asyncio.sleep(base_delay * (2 ** (attempt - 1)))
-    raise last_exc  # type: ignore[misc]
-
-
-def json_stream_wrapper(generator: AsyncGenerator[str, None]) -> AsyncGenerator[bytes, None]:
-    async def _wrapped() -> AsyncGenerator[bytes, None]:
-        yield b"{"
-        first = True
-        try:
-            async for part in generator:
-                if part:
-                    if first:
-                        yield b"\"data\":\""
-                        first = False
-                    yield (
-                        part.replace("\\", "\\\\").replace("\"", "\\\"")
-                    ).encode("utf-8")
-        finally:
-            if first:
-                yield b"\"data\":\"\""
-            yield b"\"}"
-
-    return _wrapped()
+            result = await fn()
+        except asyncio.CancelledError:
+            # Neither a success nor a failure; let the next call probe instead
+            if probe:
+                breaker.end_probe()  # type: ignore[union-attr]
+            raise
+        except Exception as exc:
+            UPSTREAM_ERRORS.inc(error=error_class(exc))
+            retryable = is_retryable(exc)
+            if breaker is not None:
+                if retryable:
+                    breaker.record_failure()
+                else:
+                    # Upstream answered; a client-side error says nothing about its health
+                    breaker.record_success()
+            if attempt == attempts or not retryable:
+                raise
+            delay = backoff_delay(attempt, base_delay=base_delay, max_delay=max_delay, retry_after=retry_after_seconds(exc))
+            if deadline is not None and time.monotonic() - started + delay > deadline:
+                raise
+            UPSTREAM_RETRIES.inc()
+            await asyncio.sleep(delay)
+        else:
+            if breaker is not None:
+                breaker.record_success()
+            return result
+
 
+async def hedged(fn, *, delay: float, copies: int = 2):
+    """Start `fn`, and another copy each time `delay` passes without a result; first success wins.
 
+    Meant for short idempotent calls whose tail latency matters more than the
+    occasional duplicate request. A copy that fails early starts the next one
+    immediately. The losers are cancelled.
+    """
+    if delay <= 0 or copies <= 1:
+        return await fn()
+    tasks: Set["asyncio.Task[Any]"] = set()
+    last_exc: Optional[BaseException] = None
+    started = 0
+    try:
+        while True:
+            if started < copies:
+                tasks.add(asyncio.ensure_future(fn()))
+                started += 1
+            if not tasks:
+                raise last_exc  # type: ignore[misc]
+            done, _ = await asyncio.wait(
+                tasks,
+                timeout=delay if started < copies else None,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            for task in done:
+                tasks.discard(task)
+                if task.exception() is None:
+                    return task.result()
+                last_exc = task.exception()
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,45 @@
+import asyncio
+import random
+from typing import Optional
+
+from .clients import get_clients
+from .config import get_settings
+from .tokens import count_tokens
+from .utils import module_available
+
+try:
+    # SnapStart runtime hooks; only present in the Lambda Python runtime
+    from snapshot_restore_py import register_after_restore  # type: ignore
+except Exception:  # pragma: no cover
+    register_after_restore = None  # type: ignore
+
+
+async def _build():
+    settings = get_settings()
+    clients = get_clients()
+    count_tokens("", settings.openai_model)
+    if not settings.openai_api_key:
+        return
+    clients.openai()
+    if module_available("langchain_core"):
+        from .services.chat import _chat_prompt
+        from .services.store import _history_class
+
+        _chat_prompt()
+        _history_class()
+        clients.chat_model(model=settings.openai_model, temperature=0.2)
+
+
+def preload(loop: Optional[asyncio.AbstractEventLoop] = None):
+    """Do at init time what the first LLM request would otherwise do.
+
+    Imports the OpenAI and LangChain stacks and builds the pooled clients,
+    the chat model, the chat prompt and the token encoder on `loop` (the one
+    later invocations run on), so a snapshotted or provisioned instance
+    serves its first request warm. No connection is opened.
+    """
+    loop = loop or asyncio.get_event_loop()
+    loop.run_until_complete(_build())
+    if register_after_restore is not None:
+        # Restored instances share the snapshot's RNG state; reseed so retry jitter differs between them
+        register_after_restore(random.seed)
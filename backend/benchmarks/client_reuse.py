@@ -0,0 +1,109 @@
+"""Connection reuse benchmark: per-request clients vs the shared ClientManager.
+
+Runs `stream_contract_md` against the local stub upstream twice: once building
+a fresh client (and connection pool) per request, the way the services used to,
+and once through the pooled manager. Reports upstream connections opened and
+time-to-first-token percentiles for each mode.
+
+    cd backend
+    python -m benchmarks.client_reuse --requests 50 --concurrency 5 --handshake-ms 30
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+from typing import List
+
+import httpx
+
+from .stats import percentile
+from .stub_openai import StubServer, StubState
+
+
+async def _run_mode(mode: str, *, base_url: str, requests: int, concurrency: int) -> dict:
+    from app.config import get_settings
+    from app.clients import ClientManager, init_clients, close_clients
+    from app.schemas import GenerateRequest
+    import app.services.generation as generation
+
+    stats_url = base_url.rsplit("/v1", 1)[0]
+    async with httpx.AsyncClient() as admin:
+        await admin.post(stats_url + "/reset")
+
+    original = generation.get_clients
+    fresh: List[ClientManager] = []
+    if mode == "per-request":
+        def _fresh_manager():
+            manager = ClientManager(get_settings())
+            fresh.append(manager)
+            return manager
+        generation.get_clients = _fresh_manager
+    else:
+        init_clients(get_settings())
+
+    sem = asyncio.Semaphore(concurrency)
+    ttfts: List[float] = []
+
+    async def _one(i: int):
+        async with sem:
+            started = time.perf_counter()
+            first = None
+            async for _ in generation.stream_contract_md(data=GenerateRequest(prompt=f"bench {i}")):
+                if first is None:
+                    first = time.perf_counter() - started
+            ttfts.append((first or 0.0) * 1000)
+
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(_one(i) for i in range(requests)))
+    finally:
+        generation.get_clients = original
+        for manager in fresh:
+            await manager.aclose()
+        await close_clients()
+    elapsed = time.perf_counter() - started
+
+    async with httpx.AsyncClient() as admin:
+        upstream = (await admin.get(stats_url + "/stats")).json()
+    return {
+        "mode": mode,
+        "requests": upstream["requests"],
+        "connections": upstream["connections"],
+        "ttft_p50_ms": percentile(ttfts, 50),
+        "ttft_p95_ms": percentile(ttfts, 95),
+        "ttft_mean_ms": statistics.fmean(ttfts) if ttfts else 0.0,
+        "wall_s": elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=5)
+    parser.add_argument("--handshake-ms", type=float, default=30.0, help="simulated connection setup cost")
+    parser.add_argument("--tokens", type=int, default=20)
+    args = parser.parse_args()
+
+    state = StubState(handshake_ms=args.handshake_ms, tokens=args.tokens)
+    with StubServer(state) as base_url:
+        os.environ["OPENAI_API_KEY"] = "stub"
+        os.environ["OPENAI_BASE_URL"] = base_url
+        from app.config import reload_settings
+
+        reload_settings()
+        results = [
+            asyncio.run(_run_mode(mode, base_url=base_url, requests=args.requests, concurrency=args.concurrency))
+            for mode in ("per-request", "pooled")
+        ]
+
+    print(f"{'mode':<12} {'requests':>8} {'conns':>6} {'ttft p50':>9} {'ttft p95':>9} {'wall':>7}")
+    for r in results:
+        print(
+            f"{r['mode']:<12} {r['requests']:>8} {r['connections']:>6} "
+            f"{r['ttft_p50_ms']:>7.1f}ms {r['ttft_p95_ms']:>7.1f}ms {r['wall_s']:>6.2f}s"
+        )
+
+
+if __name__ == "__main__":
+    main()
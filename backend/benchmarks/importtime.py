@@ -0,0 +1,86 @@
+"""Cold-start report: import cost of the Lambda entry point, from `-X importtime`.
+
+Imports the target module in a fresh interpreter, then prints the total import
+time, the slowest modules by cumulative time and the cost per top-level
+package. `--budget-ms` exits non-zero when the total goes over budget, so the
+report can guard against an eager import creeping back in.
+
+    cd backend
+    python -m benchmarks.importtime --module lambda_function --top 20
+    LAMBDA_SNAPSHOT=true python -m benchmarks.importtime --budget-ms 4000
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+# (module, self µs, cumulative µs, nesting depth)
+Row = Tuple[str, int, int, int]
+
+
+def parse_importtime(stderr: str) -> List[Row]:
+    rows: List[Row] = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        try:
+            self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+            depth = (len(name) - len(name.lstrip(" "))) // 2
+            rows.append((name.strip(), int(self_us), int(cumulative_us), depth))
+        except ValueError:
+            continue
+    return rows
+
+
+def measure(module: str, env: Optional[Dict[str, str]] = None) -> Tuple[List[Row], float]:
+    """Import `module` in a fresh interpreter; returns the importtime rows and wall-clock seconds."""
+    started = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        env={**os.environ, "DOTENV_DISABLED": "1", **(env or {})},
+    )
+    wall = time.perf_counter() - started
+    if proc.returncode != 0:
+        raise SystemExit(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f"import {module} failed")
+    return parse_importtime(proc.stderr), wall
+
+
+def by_package(rows: List[Row]) -> Dict[str, int]:
+    totals: Dict[str, int] = defaultdict(int)
+    for name, self_us, _, _ in rows:
+        totals[name.split(".", 1)[0]] += self_us
+    return dict(totals)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--module", default="lambda_function")
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--budget-ms", type=float, default=0.0, help="fail when the total import time exceeds this")
+    args = parser.parse_args(argv)
+
+    rows, wall = measure(args.module)
+    total_us = sum(r[1] for r in rows)
+    print(f"import {args.module}: {total_us / 1000:.0f} ms in imports, {wall * 1000:.0f} ms process wall-clock\n")
+
+    print(f"{'cumulative':>11} {'self':>9}  module")
+    for name, self_us, cumulative_us, depth in sorted(rows, key=lambda r: r[2], reverse=True)[: args.top]:
+        print(f"{cumulative_us / 1000:>9.1f}ms {self_us / 1000:>7.1f}ms  {'  ' * depth}{name}")
+
+    print(f"\n{'self':>9}  package")
+    for package, self_us in sorted(by_package(rows).items(), key=lambda kv: kv[1], reverse=True)[: args.top]:
+        print(f"{self_us / 1000:>7.1f}ms  {package}")
+
+    if args.budget_ms and total_us / 1000 > args.budget_ms:
+        print(f"\nOVER BUDGET: {total_us / 1000:.0f} ms > {args.budget_ms:.0f} ms")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,191 @@
+"""Local emulator of the Lambda Runtime API, for running `lambda_runtime` off AWS.
+
+Hands out queued events on `/invocation/next` and records each response as it
+arrives, chunk by chunk with arrival times, so tests and benchmarks can check
+that a streamed response really is incremental. Streaming responses are split
+into their JSON prelude and body, the way Function URLs do it.
+
+    with RuntimeEmulator() as emulator:
+        # run lambda_runtime.LambdaRuntime(app, emulator.address) elsewhere
+        result = emulator.invoke(function_url_event("POST", "/api/generate", {"prompt": "..."}))
+        result.first_chunk_ms, result.body
+"""
+import asyncio
+import base64
+import json
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+PRELUDE_SEPARATOR = b"\x00" * 8
+
+
+@dataclass
+class Invocation:
+    request_id: str
+    event: Dict[str, Any]
+    sent_at: float = 0.0
+    mode: str = "buffered"
+    # (milliseconds since the event was handed out, bytes)
+    chunks: List[Tuple[float, bytes]] = field(default_factory=list)
+    error: Optional[Dict[str, Any]] = None
+    done: threading.Event = field(default_factory=threading.Event)
+
+    @property
+    def raw(self) -> bytes:
+        return b"".join(chunk for _, chunk in self.chunks)
+
+    @property
+    def prelude(self) -> Dict[str, Any]:
+        """Status, headers and cookies: the streaming prelude, or the buffered result without its body."""
+        if self.mode == "streaming":
+            return json.loads(self.raw.split(PRELUDE_SEPARATOR, 1)[0])
+        return {k: v for k, v in json.loads(self.raw).items() if k != "body"}
+
+    @property
+    def body(self) -> bytes:
+        if self.mode == "streaming":
+            return self.raw.split(PRELUDE_SEPARATOR, 1)[1]
+        result = json.loads(self.raw)
+        body = result.get("body", "")
+        return base64.b64decode(body) if result.get("isBase64Encoded") else body.encode("utf-8")
+
+    @property
+    def first_chunk_ms(self) -> float:
+        """Arrival of the first body byte (after the prelude, when streaming)."""
+        seen = 0
+        head = len(self.raw.split(PRELUDE_SEPARATOR, 1)[0]) + len(PRELUDE_SEPARATOR) if self.mode == "streaming" else 0
+        for at, chunk in self.chunks:
+            seen += len(chunk)
+            if seen > head:
+                return at
+        return self.chunks[-1][0] if self.chunks else 0.0
+
+
+def function_url_event(
+    method: str,
+    path: str,
+    body: Optional[Any] = None,
+    headers: Optional[Dict[str, str]] = None,
+    domain: str = "emulated.lambda-url.local.on.aws",
+) -> Dict[str, Any]:
+    """A Function URL (payload v2) event; with an API Gateway `domain` it is an HTTP API event, which cannot be streamed."""
+    raw = "" if body is None else body if isinstance(body, str) else json.dumps(body)
+    return {
+        "version": "2.0",
+        "routeKey": "$default",
+        "rawPath": path,
+        "rawQueryString": "",
+        "headers": {"host": "localhost", "content-type": "application/json", **(headers or {})},
+        "requestContext": {
+            "domainName": domain,
+            "http": {"method": method, "path": path, "protocol": "HTTP/1.1", "sourceIp": "127.0.0.1"},
+        },
+        "body": raw,
+        "isBase64Encoded": False,
+    }
+
+
+def rest_api_event(method: str, path: str, body: Optional[Any] = None) -> Dict[str, Any]:
+    """An API Gateway REST (payload v1) event, which cannot be streamed."""
+    raw = "" if body is None else body if isinstance(body, str) else json.dumps(body)
+    return {
+        "resource": path,
+        "path": path,
+        "httpMethod": method,
+        "headers": {"host": "localhost", "content-type": "application/json"},
+        "multiValueHeaders": {},
+        "queryStringParameters": None,
+        "multiValueQueryStringParameters": None,
+        "requestContext": {"identity": {"sourceIp": "127.0.0.1"}},
+        "body": raw,
+        "isBase64Encoded": False,
+    }
+
+
+class RuntimeEmulator:
+    """Serves the Runtime API on a background thread: `with RuntimeEmulator() as emulator: ...`."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, timeout_ms: int = 900_000):
+        self.timeout_ms = timeout_ms
+        self.invocations: Dict[str, Invocation] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._pending: "Optional[asyncio.Queue[Invocation]]" = None
+        config = uvicorn.Config(self._create_app(), host=host, port=port, log_level="warning", lifespan="off")
+        self._server = uvicorn.Server(config)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _create_app(self) -> Starlette:
+        async def next_invocation(request: Request):
+            invocation = await self._pending.get()
+            invocation.sent_at = time.perf_counter()
+            return JSONResponse(
+                invocation.event,
+                headers={
+                    "Lambda-Runtime-Aws-Request-Id": invocation.request_id,
+                    "Lambda-Runtime-Deadline-Ms": str(int(time.time() * 1000) + self.timeout_ms),
+                    "Lambda-Runtime-Invoked-Function-Arn": "arn:aws:lambda:local:000000000000:function:emulated",
+                },
+            )
+
+        async def response(request: Request):
+            invocation = self.invocations[request.path_params["request_id"]]
+            if request.headers.get("lambda-runtime-function-response-mode") == "streaming":
+                invocation.mode = "streaming"
+            async for chunk in request.stream():
+                if chunk:
+                    invocation.chunks.append(((time.perf_counter() - invocation.sent_at) * 1000, chunk))
+            invocation.done.set()
+            return Response(status_code=202)
+
+        async def error(request: Request):
+            invocation = self.invocations[request.path_params["request_id"]]
+            invocation.error = await request.json()
+            invocation.done.set()
+            return Response(status_code=202)
+
+        prefix = "/2018-06-01/runtime"
+        return Starlette(routes=[
+            Route(f"{prefix}/invocation/next", next_invocation, methods=["GET"]),
+            Route(f"{prefix}/invocation/{{request_id}}/response", response, methods=["POST"]),
+            Route(f"{prefix}/invocation/{{request_id}}/error", error, methods=["POST"]),
+        ])
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._pending = asyncio.Queue()
+        self._loop.run_until_complete(self._server.serve())
+
+    @property
+    def address(self) -> str:
+        """Value for AWS_LAMBDA_RUNTIME_API."""
+        host, port = self._server.servers[0].sockets[0].getsockname()[:2]
+        return f"{host}:{port}"
+
+    def invoke(self, event: Dict[str, Any], timeout: float = 30.0) -> Invocation:
+        """Queue `event` and wait until the runtime has answered it."""
+        invocation = Invocation(request_id=uuid.uuid4().hex, event=event)
+        self.invocations[invocation.request_id] = invocation
+        self._loop.call_soon_threadsafe(self._pending.put_nowait, invocation)
+        if not invocation.done.wait(timeout):
+            raise TimeoutError(f"no response to invocation {invocation.request_id}")
+        return invocation
+
+    def __enter__(self) -> "RuntimeEmulator":
+        self._thread.start()
+        while not self._server.started:
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc):
+        self._server.should_exit = True
+        self._thread.join(timeout=5)
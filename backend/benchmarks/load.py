@@ -0,0 +1,294 @@
+"""Load test: drive the real app over HTTP against the stub upstream.
+
+Starts the stub upstream and the API (uvicorn, on its own thread and event
+loop), then runs N concurrent virtual clients through one scenario for a
+fixed number of iterations each:
+
+- `generate`: POST /api/generate (unique prompts, so the cache never hits);
+- `chat`: start a session, store a document, POST /api/chat;
+- `sessions`: start, store a document, list and read history.
+
+Reports throughput, time-to-first-byte and total latency percentiles, status
+counts, event-loop lag of the server loop and RSS growth of the process.
+`--save-baseline` writes the results as JSON; `--baseline` compares against
+such a file and exits non-zero when any scenario regressed by more than
+`--tolerance`.
+
+    cd backend
+    python -m benchmarks.load --scenario generate chat --concurrency 20 --iterations 5 \\
+        --ttft-ms 200 --tokens-per-sec 80 --rate-limit-rate 0.05 --save-baseline bench.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from typing import Dict, List, Optional
+
+import httpx
+import uvicorn
+
+from .stats import percentile
+from .stub_openai import StubServer, StubState
+
+SCENARIOS = ("generate", "chat", "sessions")
+
+# Metrics compared against a baseline: name -> whether higher is better
+COMPARED = {
+    "throughput_rps": True,
+    "ttfb_p95_ms": False,
+    "latency_p95_ms": False,
+    "error_rate": False,
+    "loop_lag_p99_ms": False,
+}
+
+
+def rss_mb() -> float:
+    """Current resident set size; falls back to the peak where /proc is unavailable."""
+    try:
+        with open("/proc/self/status") as fh:
+            for line in fh:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+class AppServer:
+    """Runs the API on a dedicated thread and loop so lag can be probed on that loop."""
+
+    def __init__(self, host: str = "127.0.0.1"):
+        from app.app import create_app
+
+        config = uvicorn.Config(create_app(), host=host, port=0, log_level="warning")
+        self._server = uvicorn.Server(config)
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self._server.serve())
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.servers[0].sockets[0].getsockname()[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self) -> "AppServer":
+        self._thread.start()
+        while not self._server.started:
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc):
+        self._server.should_exit = True
+        self._thread.join(timeout=10)
+
+
+class LagProbe:
+    """Samples how late a periodic timer fires on the server loop."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, interval: float = 0.01):
+        self.loop = loop
+        self.interval = interval
+        self.samples: List[float] = []
+        self._running = False
+
+    async def _probe(self):
+        while self._running:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.perf_counter() - started - self.interval) * 1000)
+
+    def __enter__(self) -> "LagProbe":
+        self._running = True
+        self._future = asyncio.run_coroutine_threadsafe(self._probe(), self.loop)
+        return self
+
+    def __exit__(self, *exc):
+        self._running = False
+        try:
+            self._future.result(timeout=2)
+        except Exception:
+            self._future.cancel()
+
+
+async def _timed_stream(client: httpx.AsyncClient, method: str, url: str, **kwargs) -> Dict[str, float]:
+    started = time.perf_counter()
+    first: Optional[float] = None
+    async with client.stream(method, url, **kwargs) as resp:
+        async for chunk in resp.aiter_raw():
+            if chunk and first is None:
+                first = time.perf_counter()
+        status = resp.status_code
+    end = time.perf_counter()
+    return {"status": status, "ttfb": ((first or end) - started) * 1000, "latency": (end - started) * 1000}
+
+
+async def _generate(client: httpx.AsyncClient, worker: int, i: int) -> List[Dict[str, float]]:
+    body = {"prompt": f"Terms of service for bench worker {worker} run {i} {uuid.uuid4().hex[:8]}"}
+    return [await _timed_stream(client, "POST", "/api/generate", json=body)]
+
+
+async def _chat(client: httpx.AsyncClient, worker: int, i: int) -> List[Dict[str, float]]:
+    sid = (await client.post("/api/session/start", json={})).json()["session_id"]
+    await client.post(f"/api/session/{sid}/document", json={"html": "# Terms\n\n## 1. Scope\n\nText.\n"})
+    body = {"session_id": sid, "message": {"role": "user", "content": f"Tighten section 1 ({worker}/{i})"}}
+    return [await _timed_stream(client, "POST", "/api/chat", json=body)]
+
+
+async def _sessions(client: httpx.AsyncClient, worker: int, i: int) -> List[Dict[str, float]]:
+    results = []
+    started = time.perf_counter()
+    resp = await client.post("/api/session/start", json={})
+    sid = resp.json()["session_id"]
+    calls = [
+        ("POST", f"/api/session/{sid}/document", {"json": {"html": f"# Doc {worker}-{i}\n"}}),
+        ("GET", "/api/session/list?limit=50", {}),
+        ("GET", f"/api/session/{sid}/history", {}),
+    ]
+    results.append({"status": resp.status_code, "ttfb": (time.perf_counter() - started) * 1000, "latency": (time.perf_counter() - started) * 1000})
+    for method, url, kwargs in calls:
+        results.append(await _timed_stream(client, method, url, **kwargs))
+    return results
+
+
+RUNNERS = {"generate": _generate, "chat": _chat, "sessions": _sessions}
+
+
+async def run_scenario(name: str, *, base_url: str, concurrency: int, iterations: int) -> dict:
+    runner = RUNNERS[name]
+    samples: List[Dict[str, float]] = []
+    failures: Counter = Counter()
+
+    async def _worker(worker: int):
+        # Distinct client ids so per-client admission limits apply per virtual user, not per test host
+        headers = {"X-Client-Id": f"bench-{worker}"}
+        async with httpx.AsyncClient(base_url=base_url, headers=headers, timeout=httpx.Timeout(300.0)) as client:
+            for i in range(iterations):
+                try:
+                    samples.extend(await runner(client, worker, i))
+                except Exception as exc:
+                    failures[type(exc).__name__] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(_worker(w) for w in range(concurrency)))
+    wall = time.perf_counter() - started
+
+    statuses = Counter(str(int(s["status"])) for s in samples)
+    ok = [s for s in samples if s["status"] < 400]
+    total = len(samples) + sum(failures.values())
+    return {
+        "requests": total,
+        "wall_s": round(wall, 3),
+        "throughput_rps": round(len(ok) / wall, 2) if wall else 0.0,
+        "ttfb_p50_ms": round(percentile([s["ttfb"] for s in ok], 50), 1),
+        "ttfb_p95_ms": round(percentile([s["ttfb"] for s in ok], 95), 1),
+        "ttfb_p99_ms": round(percentile([s["ttfb"] for s in ok], 99), 1),
+        "latency_p50_ms": round(percentile([s["latency"] for s in ok], 50), 1),
+        "latency_p95_ms": round(percentile([s["latency"] for s in ok], 95), 1),
+        "error_rate": round((total - len(ok)) / total, 4) if total else 0.0,
+        "statuses": dict(statuses),
+        "client_errors": dict(failures),
+    }
+
+
+def compare(current: Dict[str, dict], baseline: Dict[str, dict], tolerance: float) -> List[str]:
+    """Human-readable regressions of `current` against `baseline`, beyond `tolerance` (a fraction)."""
+    regressions = []
+    for scenario, result in current.items():
+        base = baseline.get(scenario)
+        if not base:
+            continue
+        for metric, higher_is_better in COMPARED.items():
+            if metric not in result or metric not in base:
+                continue
+            new, old = float(result[metric]), float(base[metric])
+            if metric == "error_rate":
+                # Rates near zero make relative change meaningless; compare absolute points
+                worse = new - old > tolerance / 10
+            elif higher_is_better:
+                worse = old > 0 and new < old * (1 - tolerance)
+            else:
+                worse = old > 0 and new > old * (1 + tolerance)
+            if worse:
+                regressions.append(f"{scenario}.{metric}: {old:g} -> {new:g}")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenario", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--iterations", type=int, default=5, help="runs of the scenario per virtual client")
+    parser.add_argument("--tokens", type=int, default=200)
+    parser.add_argument("--ttft-ms", type=float, default=150.0)
+    parser.add_argument("--tokens-per-sec", type=float, default=0.0, help="0 streams as fast as possible")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after-ms", type=float, default=50.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save-baseline", help="write results to this JSON file")
+    parser.add_argument("--baseline", help="compare against this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed relative regression")
+    args = parser.parse_args(argv)
+
+    state = StubState(
+        tokens=args.tokens,
+        ttft_ms=args.ttft_ms,
+        tokens_per_sec=args.tokens_per_sec,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        retry_after_ms=args.retry_after_ms,
+        seed=args.seed,
+    )
+    results: Dict[str, dict] = {}
+    with StubServer(state) as upstream_url:
+        os.environ.update({
+            "OPENAI_API_KEY": "stub",
+            "OPENAI_BASE_URL": upstream_url,
+            "DOTENV_DISABLED": "1",
+            "GENERATE_CACHE_ENABLED": "false",
+            "SESSION_STORE": "memory",
+        })
+        with AppServer() as app:
+            for name in args.scenario:
+                state.reset()
+                rss_before = rss_mb()
+                with LagProbe(app.loop) as lag:
+                    result = asyncio.run(run_scenario(name, base_url=app.base_url, concurrency=args.concurrency, iterations=args.iterations))
+                result["loop_lag_p50_ms"] = round(percentile(lag.samples, 50), 2)
+                result["loop_lag_p99_ms"] = round(percentile(lag.samples, 99), 2)
+                result["loop_lag_max_ms"] = round(max(lag.samples, default=0.0), 2)
+                result["rss_growth_mb"] = round(rss_mb() - rss_before, 1)
+                result["upstream"] = {"requests": state.requests, "errors": state.errors, "rate_limited": state.rate_limited}
+                results[name] = result
+
+    print(f"{'scenario':<10} {'reqs':>6} {'rps':>8} {'ttfb p50':>9} {'ttfb p95':>9} {'lat p95':>9} {'err':>6} {'lag p99':>8} {'rss +':>7}")
+    for name, r in results.items():
+        print(
+            f"{name:<10} {r['requests']:>6} {r['throughput_rps']:>8.1f} {r['ttfb_p50_ms']:>7.1f}ms {r['ttfb_p95_ms']:>7.1f}ms "
+            f"{r['latency_p95_ms']:>7.1f}ms {r['error_rate']:>6.1%} {r['loop_lag_p99_ms']:>6.1f}ms {r['rss_growth_mb']:>5.1f}MB"
+        )
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as fh:
+            json.dump(results, fh, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as fh:
+            regressions = compare(results, json.load(fh), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,161 @@
+"""Local OpenAI-compatible stub server for benchmarks.
+
+Serves `POST /v1/chat/completions` (streaming and non-streaming) and
+`GET /stats`, which reports how many requests arrived, over how many
+distinct TCP connections, and how many were failed on purpose.
+
+Knobs on `StubState`:
+- `handshake_ms` delays the first request on every new connection, standing
+  in for the DNS + TCP + TLS setup a real upstream costs;
+- `ttft_ms` delays the first streamed token;
+- `tokens_per_sec` (or `token_delay_ms`) paces the tokens after it;
+- `error_rate` and `rate_limit_rate` answer that fraction of requests with a
+  500 or a 429 carrying `retry-after-ms: retry_after_ms`.
+"""
+import asyncio
+import json
+import random
+import threading
+import time
+from typing import Optional, Set, Tuple
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+
+class StubState:
+    def __init__(
+        self,
+        *,
+        handshake_ms: float = 0.0,
+        tokens: int = 20,
+        token_delay_ms: float = 0.0,
+        ttft_ms: float = 0.0,
+        tokens_per_sec: float = 0.0,
+        error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        retry_after_ms: float = 50.0,
+        seed: Optional[int] = None,
+    ):
+        self.handshake_ms = handshake_ms
+        self.tokens = tokens
+        self.token_delay_ms = 1000.0 / tokens_per_sec if tokens_per_sec > 0 else token_delay_ms
+        self.ttft_ms = ttft_ms
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after_ms = retry_after_ms
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self.connections: Set[Tuple[str, int]] = set()
+
+    def reset(self):
+        self.requests = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self.connections.clear()
+
+
+def _chunk(content: Optional[str], finish: Optional[str] = None) -> bytes:
+    payload = {
+        "id": "chatcmpl-stub",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": "stub",
+        "choices": [{"index": 0, "delta": {"content": content} if content is not None else {}, "finish_reason": finish}],
+    }
+    return b"data: " + json.dumps(payload).encode("utf-8") + b"\n\n"
+
+
+def create_stub_app(state: StubState) -> Starlette:
+    async def completions(request: Request):
+        body = await request.json()
+        state.requests += 1
+        client = request.scope.get("client") or ("?", 0)
+        peer = (client[0], client[1])
+        if peer not in state.connections:
+            state.connections.add(peer)
+            if state.handshake_ms:
+                await asyncio.sleep(state.handshake_ms / 1000)
+
+        roll = state.random.random()
+        if roll < state.rate_limit_rate:
+            state.rate_limited += 1
+            return JSONResponse(
+                {"error": {"message": "Rate limit reached (stub)", "type": "rate_limit_error", "code": "rate_limit_exceeded"}},
+                status_code=429,
+                headers={"retry-after-ms": str(int(state.retry_after_ms))},
+            )
+        if roll < state.rate_limit_rate + state.error_rate:
+            state.errors += 1
+            return JSONResponse({"error": {"message": "Injected failure (stub)", "type": "server_error"}}, status_code=500)
+
+        if not body.get("stream"):
+            return JSONResponse({
+                "id": "chatcmpl-stub",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": "stub",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "Stub Title"}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 1, "completion_tokens": 2, "total_tokens": 3},
+            })
+
+        async def _events():
+            if state.ttft_ms:
+                await asyncio.sleep(state.ttft_ms / 1000)
+            for i in range(state.tokens):
+                if state.token_delay_ms and i:
+                    await asyncio.sleep(state.token_delay_ms / 1000)
+                yield _chunk(f"tok{i} ")
+            yield _chunk(None, "stop")
+            yield b"data: [DONE]\n\n"
+
+        return StreamingResponse(_events(), media_type="text/event-stream")
+
+    async def stats(request: Request):
+        return JSONResponse({
+            "requests": state.requests,
+            "connections": len(state.connections),
+            "errors": state.errors,
+            "rate_limited": state.rate_limited,
+        })
+
+    async def reset(request: Request):
+        state.reset()
+        return JSONResponse({"ok": True})
+
+    return Starlette(routes=[
+        Route("/v1/chat/completions", completions, methods=["POST"]),
+        Route("/stats", stats, methods=["GET"]),
+        Route("/reset", reset, methods=["POST"]),
+    ])
+
+
+class StubServer:
+    """Runs the stub on a background thread: `with StubServer(state) as base_url: ...`."""
+
+    def __init__(self, state: StubState, host: str = "127.0.0.1", port: int = 0):
+        self.state = state
+        config = uvicorn.Config(create_stub_app(state), host=host, port=port, log_level="warning", lifespan="off")
+        self._server = uvicorn.Server(config)
+        self._thread = threading.Thread(target=self._server.run, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        sock = self._server.servers[0].sockets[0]
+        host, port = sock.getsockname()[:2]
+        return f"http://{host}:{port}/v1"
+
+    def __enter__(self) -> str:
+        self._thread.start()
+        while not self._server.started:
+            time.sleep(0.01)
+        return self.base_url
+
+    def __exit__(self, *exc):
+        self._server.should_exit = True
+        self._thread.join(timeout=5)
@@ -1,10 +1,16 @@
 from mangum import Mangum
 from main import app
+from app.config import get_settings
 
-# Create a reusable ASGI handler
-_asgi_handler = Mangum(app)
+if get_settings().lambda_snapshot:
+    from app.warmup import preload
 
-def lambda_handler(event, context):
-    return _asgi_handler(event, context)
+    preload()
 
+# Create a reusable ASGI handler. The lifespan would run around every
+# invocation and tear down the pooled clients and the session store, so
+# those live for the whole execution environment instead.
+_asgi_handler = Mangum(app, lifespan="off")
 
+def lambda_handler(event, context):
+    return _asgi_handler(event, context)
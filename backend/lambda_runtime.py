@@ -0,0 +1,190 @@
+"""Lambda custom runtime loop with response streaming.
+
+`lambda_function.lambda_handler` goes through Mangum, which buffers the whole
+response before returning it, so generation and chat arrive in one piece
+after the full generation time. This loop talks to the Lambda Runtime API
+directly instead: for Function URL events it posts the response in
+streaming mode (a JSON prelude with status, headers and cookies, eight NUL
+bytes, then body chunks as the app produces them). Other events (API
+Gateway HTTP APIs use payload v2 too, but cannot stream), and every event
+when `LAMBDA_RESPONSE_STREAMING=false`, get a buffered Mangum-shaped
+response.
+
+Run as the function's entry point (custom runtime or container image):
+
+    python -m lambda_runtime
+"""
+import asyncio
+import json
+import os
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import httpx
+from mangum import Mangum
+from mangum.handlers import HTTPGateway
+
+from app.config import get_settings
+
+STREAMING_CONTENT_TYPE = "application/vnd.awslambda.http-integration-response"
+PRELUDE_SEPARATOR = b"\x00" * 8
+
+
+class RuntimeContext:
+    """The `context` argument a managed runtime would pass, built from the invocation headers."""
+
+    def __init__(self, headers: httpx.Headers):
+        self.aws_request_id = headers.get("lambda-runtime-aws-request-id", "")
+        self.invoked_function_arn = headers.get("lambda-runtime-invoked-function-arn", "")
+        self.deadline_ms = int(headers.get("lambda-runtime-deadline-ms") or 0)
+        self.function_name = os.getenv("AWS_LAMBDA_FUNCTION_NAME", "")
+        self.function_version = os.getenv("AWS_LAMBDA_FUNCTION_VERSION", "$LATEST")
+        self.memory_limit_in_mb = int(os.getenv("AWS_LAMBDA_FUNCTION_MEMORY_SIZE") or 0)
+        self.log_group_name = os.getenv("AWS_LAMBDA_LOG_GROUP_NAME", "")
+        self.log_stream_name = os.getenv("AWS_LAMBDA_LOG_STREAM_NAME", "")
+        self.identity = None
+        self.client_context = None
+
+    def get_remaining_time_in_millis(self) -> int:
+        return max(0, self.deadline_ms - int(time.time() * 1000))
+
+
+def _prelude(status: int, raw_headers: List[Tuple[bytes, bytes]]) -> bytes:
+    headers: Dict[str, str] = {}
+    cookies: List[str] = []
+    for key, value in raw_headers:
+        name, text = key.decode("latin-1").lower(), value.decode("latin-1")
+        if name == "set-cookie":
+            cookies.append(text)
+        else:
+            headers[name] = f"{headers[name]}, {text}" if name in headers else text
+    return json.dumps({"statusCode": status, "headers": headers, "cookies": cookies}).encode("utf-8") + PRELUDE_SEPARATOR
+
+
+async def run_http(app, scope: Dict[str, Any], body: bytes) -> Tuple[int, List[Tuple[bytes, bytes]], AsyncIterator[bytes]]:
+    """Start the ASGI app on one request; returns its status, headers and a live body iterator.
+
+    The app keeps running while the body is consumed. Closing the iterator
+    early reports a client disconnect, which stops streaming responses.
+    """
+    messages: "asyncio.Queue[Optional[Dict[str, Any]]]" = asyncio.Queue()
+    disconnected = asyncio.Event()
+    request_sent = False
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        # Streaming responses listen for a disconnect; it only comes if the reader goes away
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        await messages.put(message)
+
+    async def _run():
+        try:
+            await app(scope, receive, send)
+        finally:
+            await messages.put(None)
+
+    task = asyncio.ensure_future(_run())
+    start = await messages.get()
+    if start is None or start["type"] != "http.response.start":
+        await task
+        raise RuntimeError("application returned no response")
+
+    async def _body() -> AsyncIterator[bytes]:
+        try:
+            while True:
+                message = await messages.get()
+                if message is None:
+                    break
+                if message["type"] != "http.response.body":
+                    continue
+                if message.get("body"):
+                    yield message["body"]
+                if not message.get("more_body", False):
+                    break
+        finally:
+            disconnected.set()
+            await task
+
+    return start["status"], [(bytes(k), bytes(v)) for k, v in start.get("headers", [])], _body()
+
+
+def is_function_url(event: Dict[str, Any]) -> bool:
+    """Whether `event` came from a Lambda Function URL (its domain is `<id>.lambda-url.<region>.on.aws`)."""
+    context = event.get("requestContext") or {}
+    return event.get("version") == "2.0" and ".lambda-url." in (context.get("domainName") or "")
+
+
+class LambdaRuntime:
+    """Polls the Runtime API at `runtime_api` and serves each invocation with `app`."""
+
+    def __init__(self, app, runtime_api: str, *, streaming: Optional[bool] = None):
+        self.app = app
+        self.streaming = get_settings().lambda_response_streaming if streaming is None else streaming
+        # Only used to map events to ASGI scopes and to shape buffered responses
+        self.adapter = Mangum(app, lifespan="off")
+        self._base = f"http://{runtime_api}/2018-06-01/runtime"
+
+    async def serve(self, max_invocations: Optional[int] = None):
+        handled = 0
+        async with httpx.AsyncClient(base_url=self._base, timeout=httpx.Timeout(None)) as runtime:
+            while max_invocations is None or handled < max_invocations:
+                resp = await runtime.get("/invocation/next")
+                context = RuntimeContext(resp.headers)
+                request_id = context.aws_request_id
+                try:
+                    await self.invoke(runtime, request_id, resp.json(), context)
+                except Exception as exc:
+                    await runtime.post(
+                        f"/invocation/{request_id}/error",
+                        json={"errorMessage": str(exc), "errorType": type(exc).__name__},
+                        headers={"Lambda-Runtime-Function-Error-Type": "Unhandled"},
+                    )
+                handled += 1
+
+    async def invoke(self, runtime: httpx.AsyncClient, request_id: str, event: Dict[str, Any], context: RuntimeContext):
+        handler = self.adapter.infer(event, context)
+        status, headers, body = await run_http(self.app, handler.scope, handler.body)
+
+        # Only Function URLs can be answered with a stream; HTTP APIs send the same payload v2 but would
+        # pass the prelude and its NUL separator through to the client as body bytes
+        if self.streaming and isinstance(handler, HTTPGateway) and is_function_url(event):
+
+            async def _content() -> AsyncIterator[bytes]:
+                yield _prelude(status, headers)
+                async for chunk in body:
+                    yield chunk
+
+            await runtime.post(
+                f"/invocation/{request_id}/response",
+                content=_content(),
+                headers={
+                    "Lambda-Runtime-Function-Response-Mode": "streaming",
+                    "Content-Type": STREAMING_CONTENT_TYPE,
+                },
+            )
+            return
+
+        chunks = [chunk async for chunk in body]
+        result = handler({"status": status, "headers": [[k, v] for k, v in headers], "body": b"".join(chunks)})
+        await runtime.post(f"/invocation/{request_id}/response", json=result)
+
+
+def main():
+    from main import app
+
+    runtime = LambdaRuntime(app, os.environ["AWS_LAMBDA_RUNTIME_API"])
+    if get_settings().lambda_snapshot:
+        from app.warmup import preload
+
+        preload()
+    asyncio.get_event_loop().run_until_complete(runtime.serve())
+
+
+if __name__ == "__main__":
+    main()
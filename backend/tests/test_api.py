@@ -3,6 +3,9 @@ import sys
 import types
 import pathlib
 import importlib.util
+
+import pytest
+
 BASE_DIR = pathlib.Path(__file__).resolve().parents[1]
 if str(BASE_DIR) not in sys.path:
     sys.path.insert(0, str(BASE_DIR))
@@ -54,7 +57,7 @@ def test_generate_stream_success(monkeypatch):
     app_mod = load_main_module()
 
     import types as _types
-    import app.services.generation as gen
+    import app.clients as clients
 
     async def _dummy_stream():
         class _Choice:
@@ -65,12 +68,12 @@ def test_generate_stream_success(monkeypatch):
         yield _types.SimpleNamespace(choices=[_types.SimpleNamespace(delta=_types.SimpleNamespace(content=" World"))])
 
     class _DummyAsyncOpenAI:
-        def __init__(self, api_key: str):
+        def __init__(self, api_key: str, **kwargs):
             self.chat = _types.SimpleNamespace(
                 completions=_types.SimpleNamespace(create=lambda **kwargs: _dummy_stream())
             )
 
-    monkeypatch.setattr(gen, "AsyncOpenAI", _DummyAsyncOpenAI)
+    monkeypatch.setattr(clients, "AsyncOpenAI", _DummyAsyncOpenAI)
 
     client = TestClient(app_mod.app)
     resp = client.post("/api/generate", json={"prompt": "Draft"})
@@ -105,3 +108,1560 @@ def test_sessions_are_independent(monkeypatch):
     titles = {s["session_id"]: s.get("document_title") for s in sessions}
     assert titles.get(s1) == "A"
     assert titles.get(s2) == "B"
+
+
+def test_settings_registry_caches_and_reloads_on_mtime(monkeypatch, tmp_path):
+    import app.config as config
+
+    prompts = tmp_path / "prompts.yml"
+    prompts.write_text("user:\n  generation_requirements: 'A {context} B'\n", encoding="utf-8")
+    monkeypatch.setattr(config, "PROMPTS_PATH", prompts)
+
+    registry = config.SettingsRegistry(check_interval=0)
+    first = registry.get()
+    assert registry.get() is first
+    assert first.templates.generation_requirements.render(context="x") == "A x B"
+
+    prompts.write_text("title:\n  instruction: 'Name it'\n", encoding="utf-8")
+    bumped = prompts.stat().st_mtime + 5
+    os.utime(prompts, (bumped, bumped))
+    second = registry.get()
+    assert second is not first
+    assert second.templates.title_instruction == "Name it"
+    assert second.templates.generation_requirements is None
+    assert second.templates.digest != first.templates.digest
+
+    # On an event loop the re-parse happens in a thread; callers keep the current Settings meanwhile
+    import asyncio
+
+    prompts.write_text("title:\n  instruction: 'Name it again'\n", encoding="utf-8")
+    os.utime(prompts, (bumped + 5, bumped + 5))
+
+    async def _on_loop():
+        assert registry.get() is second
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if registry.get() is not second:
+                break
+        return registry.get()
+
+    assert asyncio.run(_on_loop()).templates.title_instruction == "Name it again"
+
+
+def test_admin_reload(monkeypatch):
+    monkeypatch.delenv("ADMIN_TOKEN", raising=False)
+    app_mod = load_main_module()
+    client = TestClient(app_mod.app)
+    # No token configured: the admin routes are off, not open
+    assert client.post("/api/admin/reload").status_code == 404
+
+    monkeypatch.setenv("ADMIN_TOKEN", "secret")
+    app_mod = load_main_module()
+    client = TestClient(app_mod.app)
+    assert client.post("/api/admin/reload").status_code == 403
+    assert client.post("/api/admin/reload", headers={"X-Admin-Token": "wrong"}).status_code == 403
+    resp = client.post("/api/admin/reload", headers={"X-Admin-Token": "secret"})
+    assert resp.status_code == 200
+    assert resp.json()["ok"] is True
+
+
+def test_client_manager_shares_pool_and_closes_on_shutdown(monkeypatch):
+    import asyncio
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    app_mod = load_main_module()
+    import app.clients as clients
+
+    async def _check():
+        manager = clients.get_clients()
+        first = manager.openai()
+        assert manager.openai() is first
+        assert first._client is manager.http
+
+    with TestClient(app_mod.app):
+        asyncio.run(_check())
+    assert clients._MANAGER is None
+
+    manager = clients.init_clients(clients.get_settings())
+
+    async def _pool():
+        return manager.http
+
+    async def _replace():
+        fresh = manager.http
+        await asyncio.sleep(0)
+        return fresh
+
+    old = asyncio.run(_pool())
+    # A new loop gets its own pool, and the one left behind is closed rather than leaked
+    assert asyncio.run(_replace()) is not old and old.is_closed
+
+
+def _fake_chat_model(text: str, closed: list):
+    from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+    from langchain_core.messages import AIMessage
+
+    class _FakeChat(GenericFakeChatModel):
+        async def _astream(self, *args, **kwargs):
+            try:
+                async for chunk in super()._astream(*args, **kwargs):
+                    yield chunk
+            finally:
+                closed.append(True)
+
+    return _FakeChat(messages=iter([AIMessage(content=text)]))
+
+
+def _patch_openai(monkeypatch, create):
+    """Make every pooled AsyncOpenAI client answer chat completions with `create`."""
+    import app.clients as clients
+
+    class _DummyAsyncOpenAI:
+        def __init__(self, **kwargs):
+            self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=create))
+
+    monkeypatch.setattr(clients, "AsyncOpenAI", _DummyAsyncOpenAI)
+
+
+def _completion(text: str, **fields):
+    """A non-streaming chat completion whose only choice says `text`."""
+    return types.SimpleNamespace(choices=[types.SimpleNamespace(message=types.SimpleNamespace(content=text))], **fields)
+
+
+def _recording_chat_model(reply: str, seen: list, *, record: str = "messages", usage=None, finish=None):
+    """A fake chat model answering `reply` that appends each call's messages (or, with record="kwargs", its kwargs) to `seen`.
+
+    `usage` is sent as a trailing usage chunk; while the `finish` list holds a
+    value, every chunk reports it as the finish reason.
+    """
+    from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+    from langchain_core.messages import AIMessage, AIMessageChunk
+    from langchain_core.outputs import ChatGenerationChunk
+
+    class _Recording(GenericFakeChatModel):
+        async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+            seen.append(kwargs if record == "kwargs" else messages)
+            async for chunk in super()._astream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                if finish:
+                    chunk.message.response_metadata = {"finish_reason": finish[0]}
+                yield chunk
+            if usage is not None:
+                yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=usage))
+
+    return _Recording(messages=iter([AIMessage(content=reply)]))
+
+
+def test_chat_streams_and_records_turn(monkeypatch):
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+    app_mod = load_main_module()
+    import app.clients as clients
+
+    closed: list = []
+    monkeypatch.setattr(clients.ClientManager, "chat_model", lambda self, **kw: _fake_chat_model("Updated {doc} text", closed))
+
+    client = TestClient(app_mod.app)
+    sid = client.post("/api/session/start", json={}).json()["session_id"]
+    client.post(f"/api/session/{sid}/document", json={"html": "# Base {with braces}"})
+    resp = client.post("/api/chat", json={"session_id": sid, "message": {"role": "user", "content": "Edit it"}})
+    assert resp.status_code == 200
+    assert "Updated {doc} text" in resp.text
+
+    messages = client.get(f"/api/session/{sid}/history").json()["messages"]
+    assert [m["role"] for m in messages] == ["human", "ai"]
+    assert messages[1]["content"] == "Updated {doc} text"
+    assert closed == [True]
+
+
+def test_chat_closing_stream_cancels_upstream_and_skips_history(monkeypatch):
+    import asyncio
+    import app.clients as clients
+    from app.services.chat import stream_chat
+    from langchain_community.chat_message_histories import ChatMessageHistory
+
+    closed: list = []
+    monkeypatch.setattr(clients.ClientManager, "chat_model", lambda self, **kw: _fake_chat_model("one two three four", closed))
+    history = ChatMessageHistory()
+
+    async def _run():
+        stream = stream_chat(session_id="s", input_text="hi", get_history_cb=lambda _: history)
+        first = await stream.__anext__()
+        await stream.aclose()
+        return first
+
+    assert asyncio.run(_run()) == "one"
+    assert closed == [True]
+    assert history.messages == []
+
+
+def test_session_routes_on_sqlite_store(monkeypatch, tmp_path):
+    monkeypatch.setenv("SESSION_STORE", "sqlite")
+    monkeypatch.setenv("SESSION_DB_URL", f"sqlite:///{tmp_path / 'sessions.db'}")
+    app_mod = load_main_module()
+    client = TestClient(app_mod.app)
+
+    sid = client.post("/api/session/start", json={"metadata": {"tenant": "t1"}}).json()["session_id"]
+    assert client.post(f"/api/session/{sid}/document", json={"html": "# Doc", "title": "T"}).json()["ok"]
+    assert client.post(f"/api/session/{sid}/title", json={"title": "Renamed"}).status_code == 200
+
+    from app.services.session import get_history
+    get_history(sid).add_user_message("hello")
+
+    data = client.get(f"/api/session/{sid}/history").json()
+    assert data["messages"] == [{"role": "human", "content": "hello"}]
+    assert data["meta"]["document_html"] == "# Doc"
+    assert data["meta"]["document_title"] == "Renamed"
+    assert data["meta"]["metadata"] == {"tenant": "t1"}
+
+    assert client.post(f"/api/session/{sid}/clear").status_code == 200
+    assert client.get(f"/api/session/{sid}/history").json()["messages"] == []
+    assert client.post("/api/session/missing/clear").status_code == 404
+    assert client.post("/api/session/missing/title", json={"title": "x"}).status_code == 404
+
+
+def test_memory_store_evicts_lru_within_budget():
+    from app.services.store import MemorySessionStore
+
+    store = MemorySessionStore(max_sessions=10, max_bytes=3600)
+    for i in range(3):
+        store.create(f"s{i}", {"created_at": "", "updated_at": ""})
+    store.get_meta("s0")  # s1 is now least recently used
+    store.update_meta("s2", document_html="x" * 3000)
+
+    assert store.get_meta("s1") is None
+    assert store.get_meta("s0") is not None and store.get_meta("s2") is not None
+    assert store.nbytes <= 3600
+
+    capped = MemorySessionStore(max_sessions=2)
+    for i in range(3):
+        capped.create(f"s{i}", {})
+    assert capped.size() == 2 and capped.get_meta("s0") is None
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_session_list_paginates_by_recency_with_projection(monkeypatch, tmp_path, backend):
+    import time
+
+    monkeypatch.setenv("SESSION_STORE", backend)
+    monkeypatch.setenv("SESSION_DB_URL", f"sqlite:///{tmp_path / 'sessions.db'}")
+    app_mod = load_main_module()
+    client = TestClient(app_mod.app)
+
+    sids = [client.post("/api/session/start", json={}).json()["session_id"] for _ in range(5)]
+    for sid in [sids[2], sids[0], sids[4], sids[1], sids[3]]:
+        time.sleep(0.002)
+        client.post(f"/api/session/{sid}/document", json={"html": f"# {sid}", "title": sid[:4]})
+
+    seen, cursor = [], None
+    while True:
+        params = {"limit": 2, **({"cursor": cursor} if cursor else {})}
+        page = client.get("/api/session/list", params=params).json()
+        assert len(page["sessions"]) <= 2
+        seen.extend(page["sessions"])
+        cursor = page["next_cursor"]
+        if not cursor:
+            break
+    assert [s["session_id"] for s in seen] == [sids[3], sids[1], sids[4], sids[0], sids[2]]
+    assert set(seen[0]) == {"session_id", "document_title", "created_at", "updated_at"}
+
+    full = client.get("/api/session/list", params={"fields": "document_html,metadata"}).json()["sessions"]
+    assert full[0] == {"session_id": sids[3], "document_html": f"# {sids[3]}", "metadata": {}}
+    assert client.get("/api/session/list", params={"cursor": "!!"}).status_code == 400
+
+
+CONTRACT_MD = """# Terms of Service
+
+## 1. Definitions
+Terms.
+
+## 2. Fees
+Pay monthly.
+
+### 2.1 Late Fees
+Five percent.
+
+## 3. Termination
+Either party.
+"""
+
+
+def test_apply_patches_by_number_and_heading():
+    from app.services.sections import Patch, apply_patches, parse_sections
+
+    assert [(s.number, s.level) for s in parse_sections(CONTRACT_MD)] == [(None, 1), ("1", 2), ("2", 2), ("2.1", 3), ("3", 2)]
+
+    updated, failed = apply_patches(CONTRACT_MD, [
+        Patch(op="replace", target="2.1", content="### 2.1 Late Fees\nTen percent."),
+        Patch(op="delete", target="Termination", content=""),
+        Patch(op="insert_after", target="Section 1", content="## 1A. Scope\nAll services."),
+        Patch(op="replace", target="9.9", content="nope"),
+    ])
+    assert "Ten percent." in updated and "Five percent." not in updated
+    assert "## 3. Termination" not in updated
+    assert updated.index("## 1A. Scope") < updated.index("## 2. Fees")
+    assert [p.target for p in failed] == ["9.9"]
+
+
+def test_chat_patch_mode_streams_patches_and_versions_document(monkeypatch):
+    import json as _json
+
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+    app_mod = load_main_module()
+    import app.clients as clients
+
+    reply = 'Sure.\n<<<PATCH op="replace" target="2.1">>>\n### 2.1 Late Fees\nTen percent.\n<<<END>>>\n'
+    monkeypatch.setattr(clients.ClientManager, "chat_model", lambda self, **kw: _fake_chat_model(reply, []))
+
+    client = TestClient(app_mod.app)
+    sid = client.post("/api/session/start", json={}).json()["session_id"]
+    assert client.post(f"/api/session/{sid}/document", json={"html": CONTRACT_MD}).json()["version"] == 1
+
+    resp = client.post("/api/chat", json={"session_id": sid, "mode": "patch", "message": {"role": "user", "content": "Raise late fees"}})
+    events = [_json.loads(line) for line in resp.text.splitlines() if line]
+    # Every event carries its resume offset
+    assert [e.pop("id") for e in events] == list(range(1, len(events) + 1))
+    assert events[0] == {"type": "patch", "op": "replace", "target": "2.1", "content": "### 2.1 Late Fees\nTen percent."}
+    assert events[-1] == {"type": "document", "version": 2, "applied": 1, "failed": []}
+
+    meta = client.get(f"/api/session/{sid}/history").json()["meta"]
+    assert "Ten percent." in meta["document_html"] and meta["document_version"] == 2
+
+    stale = client.post(f"/api/session/{sid}/document", json={"html": "# Old", "base_version": 1})
+    assert stale.status_code == 409
+    assert stale.json()["detail"]["version"] == 2
+
+    # A turn without patches stores no new version
+    monkeypatch.setattr(clients.ClientManager, "chat_model", lambda self, **kw: _fake_chat_model("Nothing to change.", []))
+    resp = client.post("/api/chat", json={"session_id": sid, "mode": "patch", "message": {"role": "user", "content": "Looks fine?"}})
+    assert _json.loads(resp.text.splitlines()[-1])["version"] == 2
+    assert len(client.get(f"/api/session/{sid}/document/versions").json()["versions"]) == 2
+
+    # Patches that cannot be stored end the stream with an error event, not a broken stream
+    import app.services.chat as chat_service
+    from app.services.session import DocumentConflict
+
+    def _conflict(*args, **kwargs):
+        raise DocumentConflict(7)
+
+    monkeypatch.setattr(chat_service, "apply_document_patches", _conflict)
+    monkeypatch.setattr(clients.ClientManager, "chat_model", lambda self, **kw: _fake_chat_model(reply, []))
+    resp = client.post("/api/chat", json={"session_id": sid, "mode": "patch", "message": {"role": "user", "content": "Raise late fees"}})
+    last = _json.loads(resp.text.splitlines()[-1])
+    assert (last["type"], last["version"]) == ("error", 7)
+
+
+def test_history_window_respects_budget_and_summarizes_overflow(monkeypatch):
+    import asyncio
+    from langchain_core.messages import AIMessage, HumanMessage
+    import app.clients as clients
+    from app.config import reload_settings
+    from app.services.history import prepare_history, select_window
+    from app.services.session import get_history, start_session
+    from app.services.store import get_store
+    from app.utils import drain_background
+
+    turns = []
+    for i in range(6):
+        turns += [HumanMessage(content=f"instruction {i} " + "x" * 400), AIMessage(content=f"reply {i} " + "y" * 400)]
+
+    window = select_window(turns, budget=350, model="gpt-4o")
+    assert window.messages and window.window_tokens <= 350
+    assert window.messages[0].type == "human"
+    assert window.overflow == turns[:window.window_start]
+
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    monkeypatch.setenv("CHAT_HISTORY_TOKEN_BUDGET", "350")
+    settings = reload_settings()
+    calls = []
+
+    async def _create(**kwargs):
+        calls.append(kwargs)
+        return _completion("User wants x.")
+
+    _patch_openai(monkeypatch, _create)
+    clients.init_clients(settings)
+    sid = start_session()
+    get_history(sid).add_messages(turns)
+
+    async def _run():
+        first = await prepare_history(sid, turns, settings)
+        await drain_background()
+        return first, await prepare_history(sid, turns, settings)
+
+    first, second = asyncio.run(_run())
+    assert len(calls) == 1 and "instruction 0" in calls[0]["messages"][1]["content"]
+    assert get_store().get_meta(sid)["history_summarized_upto"] == first.window_start
+    assert second.messages[0].type == "system" and "User wants x." in second.messages[0].content
+    assert second.overflow == []
+
+
+
+def test_token_counts_are_cached_by_digest_within_a_bound(monkeypatch):
+    from app import tokens
+
+    monkeypatch.setattr(tokens, "COUNT_CACHE_SIZE", 2)
+    monkeypatch.setattr(tokens, "_COUNTS", tokens.OrderedDict())
+    document = "clause " * 5000
+    first = tokens.count_tokens(document, "gpt-4o")
+    assert tokens.count_tokens(document, "gpt-4o") == first
+    # Keys are fixed-size digests, never the text itself
+    assert all(len(digest) == 16 for digest, _ in tokens._COUNTS)
+    tokens.count_tokens("a", "gpt-4o")
+    tokens.count_tokens("b", "gpt-4o")
+    assert len(tokens._COUNTS) == 2
+
+
+def test_session_token_stats_endpoint(monkeypatch):
+    monkeypatch.setenv("CHAT_HISTORY_TOKEN_BUDGET", "100000")
+    app_mod = load_main_module()
+    client = TestClient(app_mod.app)
+    from app.services.session import get_history
+
+    sid = client.post("/api/session/start", json={}).json()["session_id"]
+    client.post(f"/api/session/{sid}/document", json={"html": "# Doc\n" + "word " * 50})
+    get_history(sid).add_user_message("hello there")
+    get_history(sid).add_ai_message("general kenobi")
+
+    stats = client.get(f"/api/session/{sid}/tokens").json()
+    assert stats["messages"] == 2 and stats["budget"] == 100000
+    assert stats["history_tokens"] == stats["window_tokens"] > 0
+    assert stats["document_tokens"] > 0 and stats["summarized_upto"] == 0
+    assert client.get("/api/session/missing/tokens").status_code == 404
+
+
+def _counting_openai(monkeypatch, parts, calls, delay=0.0, finish="stop"):
+    import asyncio
+
+    async def _stream():
+        for n, part in enumerate(parts, 1):
+            await asyncio.sleep(delay)
+            reason = finish if n == len(parts) else None
+            yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=types.SimpleNamespace(content=part), finish_reason=reason)])
+
+    def _create(**kwargs):
+        calls.append(kwargs)
+        return _stream()
+
+    _patch_openai(monkeypatch, _create)
+
+
+def test_generate_cache_hits_memory_and_disk(monkeypatch, tmp_path):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    monkeypatch.setenv("GENERATE_CACHE_DIR", str(tmp_path))
+    app_mod = load_main_module()
+    calls: list = []
+    _counting_openai(monkeypatch, ["# Terms", " of Service"], calls)
+    client = TestClient(app_mod.app)
+
+    first = client.post("/api/generate", json={"prompt": "Draft  ToS", "jurisdiction": "New York"})
+    second = client.post("/api/generate", json={"prompt": "Draft ToS ", "jurisdiction": "new york"})
+    assert (first.headers["X-Cache"], second.headers["X-Cache"]) == ("MISS", "HIT")
+    assert first.text == second.text == "# Terms of Service"
+    assert len(calls) == 1
+
+    from app.config import get_settings
+    from app.schemas import GenerateRequest
+    from app.services.cache import ResponseCache, contract_cache_key
+    import asyncio
+
+    key = contract_cache_key(GenerateRequest(prompt="Draft ToS", jurisdiction="NEW YORK"), get_settings())
+    cold = ResponseCache(max_bytes=1024, directory=str(tmp_path))
+    assert asyncio.run(cold.get(key)) == "# Terms of Service"
+
+    # A reply cut off at max_tokens is streamed but never cached
+    _counting_openai(monkeypatch, ["# Terms", " of"], calls, finish="length")
+    cut = [client.post("/api/generate", json={"prompt": "Draft an NDA"}) for _ in range(2)]
+    assert [r.headers["X-Cache"] for r in cut] == ["MISS", "MISS"] and cut[1].text == "# Terms of"
+
+
+def test_generate_cache_disk_tier_stays_within_its_byte_budget(tmp_path):
+    import asyncio
+    import os
+    import random
+    import string
+    from app.services.cache import ResponseCache
+
+    rng = random.Random(7)
+    # Incompressible text, so each file is about 2 KiB on disk
+    texts = {f"{i:02x}" * 32: "".join(rng.choices(string.ascii_letters, k=2048)) for i in range(8)}
+    cache = ResponseCache(max_bytes=1024, directory=str(tmp_path), max_disk_bytes=8 * 1024)
+
+    async def _fill():
+        for n, (key, text) in enumerate(texts.items()):
+            await cache.put(key, text)
+            os.utime(cache._path(key), (n, n))
+
+    asyncio.run(_fill())
+    files = list(tmp_path.glob("*/*.z"))
+    assert sum(f.stat().st_size for f in files) <= 8 * 1024
+    # The least recently written files went first
+    newest = list(texts)[-1]
+    assert cache._path(newest).exists() and not cache._path(list(texts)[0]).exists()
+    cold = ResponseCache(max_bytes=1024 * 1024, directory=str(tmp_path))
+    assert asyncio.run(cold.get(newest)) == texts[newest]
+
+
+def test_generate_single_flight_shares_one_upstream_stream(monkeypatch, tmp_path):
+    import asyncio
+
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    monkeypatch.setenv("GENERATE_CACHE_DIR", str(tmp_path))
+    load_main_module()
+    calls: list = []
+    _counting_openai(monkeypatch, ["a", "b", "c"], calls, delay=0.01)
+    from app.schemas import GenerateRequest
+    from app.services.generation import stream_contract_cached
+
+    async def _consume(stream):
+        return "".join([t async for t in stream])
+
+    async def _run():
+        data = GenerateRequest(prompt="Same request")
+        s1, first = await stream_contract_cached(data=data)
+        s2, second = await stream_contract_cached(data=data)
+        texts = await asyncio.gather(_consume(first), _consume(second))
+        return (s1, s2), texts
+
+    statuses, texts = asyncio.run(_run())
+    assert statuses == ("MISS", "SHARED")
+    assert texts == ["abc", "abc"]
+    assert len(calls) == 1
+
+
+def test_parallel_generation_streams_sections_in_order(monkeypatch):
+    import asyncio
+    import re
+
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    monkeypatch.setenv("GENERATE_PARALLELISM", "2")
+    load_main_module()
+
+    outline = (
+        "# Terms of Service\nVersion 1.0\n\n## Table of Contents\n1. Definitions\n2. Fees\n3. Termination\n\n"
+        "<<<OUTLINE>>>\n1. Definitions | terms\n2. Fees | payment\n3. Termination | ending\n<<<END>>>\n"
+        "<<<TERMS>>>\n\"Service\" means the platform.\n<<<END>>>\n"
+        "<<<FOOTER>>>\n(c) Acme\n<<<END>>>\n"
+    )
+    delays = {"1": 0.05, "2": 0.0, "3": 0.01}
+    active, peak, prompts = [0], [0], []
+
+    async def _stream(messages):
+        content = messages[-1]["content"]
+        prompts.append(content)
+        if "<<<OUTLINE>>>" in content:
+            chunks = [outline]
+        else:
+            number = re.search(r"Write ONLY section (\d+)\.", content).group(1)
+            chunks = [f"## {number}. Body\n", f"Text {number}."]
+        active[0] += 1
+        peak[0] = max(peak[0], active[0])
+        try:
+            for chunk in chunks:
+                await asyncio.sleep(delays.get(chunks[0][3:4], 0))
+                yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=types.SimpleNamespace(content=chunk))])
+        finally:
+            active[0] -= 1
+
+    _patch_openai(monkeypatch, lambda **kw: _stream(kw["messages"]))
+    from app.schemas import GenerateRequest
+    from app.services.generation import stream_contract_md
+
+    async def _run():
+        return "".join([d async for d in stream_contract_md(data=GenerateRequest(prompt="ToS", mode="parallel"))])
+
+    text = asyncio.run(_run())
+    assert text.startswith("# Terms of Service")
+    assert "<<<" not in text
+    assert text.index("## 1. Body") < text.index("## 2. Body") < text.index("## 3. Body") < text.index("(c) Acme")
+    assert peak[0] == 2
+    assert all('"Service" means the platform.' in p for p in prompts[1:])
+
+
+def test_admission_queues_hands_off_and_rejects():
+    import asyncio
+    from app.admission import AdmissionController, AdmissionRejected
+
+    async def _run():
+        ctl = AdmissionController(max_concurrent=1, per_client=2, queue_size=1, queue_timeout=0.05)
+        first = await ctl.acquire("a")
+        waiting = asyncio.ensure_future(ctl.acquire("b"))
+        await asyncio.sleep(0)
+        assert ctl.queued == 1
+        with pytest.raises(AdmissionRejected) as full:
+            await ctl.acquire("c")
+        assert (full.value.status_code, full.value.reason) == (503, "queue_full")
+
+        first.release()
+        first.release()  # idempotent
+        second = await waiting
+        assert (ctl.active, ctl.queued) == (1, 0)
+
+        with pytest.raises(AdmissionRejected) as timed_out:
+            await ctl.acquire("c")
+        assert timed_out.value.reason == "queue_timeout"
+        second.release()
+        return ctl.stats()
+
+    stats = asyncio.run(_run())
+    assert stats["active"] == 0
+    assert stats["admitted"] == 2
+    assert stats["rejected"] == {"queue_full": 1, "queue_timeout": 1}
+
+
+def test_admission_counts_queued_requests_against_the_client():
+    import asyncio
+    from app.admission import AdmissionController, AdmissionRejected
+
+    async def _run():
+        ctl = AdmissionController(max_concurrent=1, per_client=2, queue_size=10, queue_timeout=0.05)
+        held = await ctl.acquire("other")
+        queued = [asyncio.ensure_future(ctl.acquire("a")) for _ in range(2)]
+        await asyncio.sleep(0)
+        # Two queued requests already use client a's slots; a third is refused up front
+        with pytest.raises(AdmissionRejected) as busy:
+            await ctl.acquire("a")
+        assert busy.value.reason == "client_concurrency"
+        queued[0].cancel()
+        await asyncio.gather(*queued, return_exceptions=True)
+        # Cancelled and timed-out waits give their slots back
+        assert ctl._by_client == {"other": 1}
+        held.release()
+        ticket = await ctl.acquire("a")
+        return ticket.client
+
+    assert asyncio.run(_run()) == "a"
+
+
+def test_generate_rejects_over_token_budget_with_retry_after(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    monkeypatch.setenv("GENERATE_CACHE_ENABLED", "false")
+    monkeypatch.setenv("OPENAI_TPM_LIMIT", "600")
+    app_mod = load_main_module()
+    _counting_openai(monkeypatch, ["ok"], [])
+    client = TestClient(app_mod.app)
+
+    assert client.post("/api/generate", json={"prompt": "one"}).status_code == 200
+    rejected = client.post("/api/generate", json={"prompt": "two"})
+    assert rejected.status_code == 429
+    assert int(rejected.headers["Retry-After"]) >= 1
+
+    stats = client.get("/api/health/admission").json()
+    assert stats["active"] == 0
+    assert stats["rejected"] == {"token_budget": 1}
+
+
+class _StatusError(Exception):
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        self.response = types.SimpleNamespace(status_code=status_code, headers=headers or {})
+
+
+def test_retry_classifies_errors_honours_retry_after_and_trips_breaker(monkeypatch):
+    import asyncio
+    import app.utils as utils
+
+    sleeps: list = []
+
+    async def _sleep(delay):
+        sleeps.append(delay)
+
+    monkeypatch.setattr(utils.asyncio, "sleep", _sleep)
+
+    async def _run():
+        calls = {"n": 0}
+
+        async def _flaky():
+            calls["n"] += 1
+            if calls["n"] == 1:
+                raise _StatusError(429, {"retry-after": "2"})
+            return "ok"
+
+        assert await utils.retry_async(_flaky) == "ok"
+        assert sleeps == [2.0]
+
+        async def _bad_request():
+            calls["n"] += 1
+            raise _StatusError(400)
+
+        calls["n"] = 0
+        with pytest.raises(_StatusError):
+            await utils.retry_async(_bad_request, attempts=5)
+        assert calls["n"] == 1
+
+        breaker = utils.CircuitBreaker("test", threshold=2, reset_timeout=60)
+
+        async def _down():
+            calls["n"] += 1
+            raise _StatusError(503)
+
+        calls["n"] = 0
+        with pytest.raises(utils.CircuitOpenError):
+            await utils.retry_async(_down, attempts=3, breaker=breaker)
+        assert breaker.state == "open"
+        with pytest.raises(utils.CircuitOpenError):
+            await utils.retry_async(_down, breaker=breaker)
+        return calls["n"]
+
+    # The breaker opened after two failures and refused the third attempt and the next call
+    assert asyncio.run(_run()) == 2
+
+
+def test_cancelled_half_open_probe_lets_the_next_call_probe():
+    import asyncio
+    import app.utils as utils
+
+    breaker = utils.CircuitBreaker("test", threshold=1, reset_timeout=0.01)
+    breaker.record_failure()
+
+    async def _run():
+        await asyncio.sleep(0.02)
+        assert breaker.state == "half_open"
+        probe = asyncio.ensure_future(utils.retry_async(lambda: asyncio.sleep(10), breaker=breaker))
+        await asyncio.sleep(0)
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+
+        async def _ok():
+            return "ok"
+
+        return [await utils.retry_async(_ok, breaker=breaker) for _ in range(3)]
+
+    assert asyncio.run(_run()) == ["ok"] * 3
+    assert breaker.state == "closed"
+
+
+def test_hedged_returns_first_success_and_cancels_the_rest():
+    import asyncio
+    from app.utils import hedged
+
+    async def _run():
+        started: list = []
+        cancelled: list = []
+
+        async def _call():
+            index = len(started)
+            started.append(index)
+            try:
+                await asyncio.sleep(1.0 if index == 0 else 0.01)
+            except asyncio.CancelledError:
+                cancelled.append(index)
+                raise
+            return index
+
+        result = await hedged(_call, delay=0.02)
+        await asyncio.sleep(0)
+        return result, started, cancelled
+
+    assert asyncio.run(_run()) == (1, [0, 1], [0])
+
+
+def test_session_title_runs_in_background_with_timeout_fallback(monkeypatch):
+    import asyncio
+    import app.clients as clients
+    from app.config import reload_settings
+    from app.services.session import get_meta, start_session
+    from app.services.title import schedule_session_title
+    from app.utils import drain_background
+
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    monkeypatch.setenv("OPENAI_TITLE_MODEL", "cheap-model")
+    monkeypatch.setenv("TITLE_TIMEOUT", "0.05")
+    monkeypatch.setenv("TITLE_HEDGE_DELAY", "0")
+    settings = reload_settings()
+    calls: list = []
+
+    async def _create(**kwargs):
+        calls.append(kwargs["model"])
+        if "slow" in kwargs["messages"][1]["content"]:
+            await asyncio.sleep(1.0)
+        return _completion("Mutual NDA")
+
+    _patch_openai(monkeypatch, _create)
+    clients.init_clients(settings)
+    fast, slow = start_session(), start_session()
+
+    async def _run():
+        schedule_session_title(session_id=fast, user_input="draft an nda")
+        schedule_session_title(session_id=slow, user_input="slow request")
+        # Scheduling returns immediately; titles land once the tasks finish
+        assert get_meta(fast).get("document_title") is None
+        await drain_background()
+
+    asyncio.run(_run())
+    assert get_meta(fast)["document_title"] == "Mutual NDA"
+    assert get_meta(slow)["document_title"] == "Slow request"
+    assert calls == ["cheap-model", "cheap-model"]
+
+
+def test_stream_encoder_escapes_batches_and_frames():
+    import asyncio
+    import json as _json
+    from app.encoders import encode_stream
+
+    async def _tokens(fail=False):
+        for token in ["# Title\n", "\tTab \"quoted\" ", "back\\slash", "\x01 done"]:
+            yield token
+        if fail:
+            raise RuntimeError("upstream went away")
+
+    async def _collect(fmt, **kwargs):
+        return [chunk async for chunk in encode_stream(_tokens(kwargs.pop("fail", False)), fmt, **kwargs)]
+
+    legacy = asyncio.run(_collect("json"))
+    assert _json.loads(b"".join(legacy)) == {"data": "# Title\n\tTab \"quoted\" back\\slash\x01 done"}
+
+    batched = asyncio.run(_collect("ndjson", max_bytes=16, max_delay=1.0))
+    events = [_json.loads(line) for line in b"".join(batched).splitlines()]
+    assert len(batched) == 2
+    assert "".join(e["data"] for e in events) == "# Title\n\tTab \"quoted\" back\\slash\x01 done"
+
+    failed = asyncio.run(_collect("sse", fail=True))
+    assert failed[-1] == b'event: error\ndata: {"type":"error","error":"upstream went away"}\n\n'
+
+
+def test_chat_streams_ndjson_on_request(monkeypatch):
+    import json as _json
+
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+    app_mod = load_main_module()
+    import app.clients as clients
+
+    monkeypatch.setattr(clients.ClientManager, "chat_model", lambda self, **kw: _fake_chat_model("Line one\nLine two", []))
+    client = TestClient(app_mod.app)
+    sid = client.post("/api/session/start", json={}).json()["session_id"]
+    resp = client.post(
+        "/api/chat",
+        json={"session_id": sid, "message": {"role": "user", "content": "Edit"}},
+        headers={"Accept": "application/x-ndjson"},
+    )
+    assert resp.headers["content-type"].startswith("application/x-ndjson")
+    events = [_json.loads(line) for line in resp.text.splitlines()]
+    assert {e["type"] for e in events} == {"delta"}
+    assert "".join(e["data"] for e in events) == "Line one\nLine two"
+
+
+def test_stream_buffer_spills_and_broadcast_survives_disconnect():
+    import asyncio
+    from app.services.streams import StreamBuffer, TokenBroadcast
+
+    buffer = StreamBuffer(max_memory_bytes=10)
+    for item in ["aaaa", "bbbb", {"type": "patch"}, "cccc"]:
+        buffer.append(item)
+    assert buffer.memory_bytes <= 10 and len(buffer) == 4
+    assert buffer.read(0) == ["aaaa", "bbbb", {"type": "patch"}, "cccc"]
+    assert buffer.read(1, 3) == ["bbbb", {"type": "patch"}]
+    assert buffer.text() == "aaaabbbbcccc"
+    buffer.close()
+
+    runs: list = []
+
+    async def _source():
+        runs.append(1)
+        for token in ["one ", "two ", "three"]:
+            await asyncio.sleep(0.01)
+            yield token
+
+    async def _run():
+        run = TokenBroadcast(detach_grace=5.0).start(_source())
+        first = run.subscribe()
+        received = [await first.__anext__()]
+        await first.aclose()  # the client drops
+        await asyncio.sleep(0.05)
+        received += [t async for t in run.subscribe(len(received))]
+        return received
+
+    assert asyncio.run(_run()) == ["one ", "two ", "three"]
+    assert runs == [1]
+
+    async def _failing_store(text):
+        raise OSError("disk full")
+
+    async def _complete():
+        run = TokenBroadcast().start(_source(), on_complete=_failing_store)
+        text = "".join([t async for t in run.subscribe()])
+        await asyncio.sleep(0)
+        return text, run.error
+
+    # The cache write runs after the stream has finished and cannot fail it
+    assert asyncio.run(_complete()) == ("one two three", None)
+
+
+def test_admission_slot_is_held_until_a_detached_run_ends():
+    import asyncio
+    from app.admission import AdmissionController, AdmissionRejected
+    from app.services.streams import TokenBroadcast
+
+    async def _source():
+        for token in ["one ", "two ", "three"]:
+            await asyncio.sleep(0.02)
+            yield token
+
+    async def _run():
+        ctl = AdmissionController(max_concurrent=4, per_client=1, queue_size=4, queue_timeout=1)
+        ticket = await ctl.acquire("a")
+        # A small memory budget makes the producer spill and the late reader replay from the temp file
+        run = TokenBroadcast(max_memory_bytes=4, detach_grace=5.0).start(_source())
+        run.add_done_callback(ticket.release)
+        first = run.subscribe()
+        await first.__anext__()
+        await first.aclose()  # the client drops; the run keeps going
+        with pytest.raises(AdmissionRejected) as busy:
+            await ctl.acquire("a")
+        assert busy.value.reason == "client_concurrency" and ctl.active == 1
+        replay = [t async for t in run.subscribe(0)]
+        assert run.buffer.needs_io(0)
+        return replay, ctl.active
+
+    assert asyncio.run(_run()) == (["one ", "two ", "three"], 0)
+
+
+def test_generate_stream_can_be_resumed_by_id(monkeypatch):
+    import json as _json
+
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    monkeypatch.setenv("GENERATE_CACHE_ENABLED", "false")
+    monkeypatch.setenv("STREAM_BATCH_MS", "0")
+    monkeypatch.setenv("STREAM_BATCH_BYTES", "0")
+    app_mod = load_main_module()
+    _counting_openai(monkeypatch, ["# Terms", " of", " Service"], [])
+
+    with TestClient(app_mod.app) as client:
+        first = client.post("/api/generate?format=ndjson", json={"prompt": "Draft ToS"})
+        stream_id = first.headers["X-Stream-Id"]
+        assert [_json.loads(line)["id"] for line in first.text.splitlines()] == [1, 2, 3]
+
+        resumed = client.get(f"/api/stream/{stream_id}", headers={"Last-Event-ID": "1"})
+        events = [_json.loads(line) for line in resumed.text.splitlines()]
+        assert [(e["id"], e["data"]) for e in events] == [(2, " of"), (3, " Service")]
+
+        assert client.get("/api/stream/unknown").status_code == 404
+        assert client.get(f"/api/stream/{stream_id}?offset=9").status_code == 400
+
+        # A plain-text client only knows how many characters it got, which may end mid-event
+        text = client.post("/api/generate", json={"prompt": "Draft ToS"})
+        assert text.text == "# Terms of Service"
+        rest = client.get(f"/api/stream/{text.headers['X-Stream-Id']}?chars=9&format=text")
+        assert rest.text == "f Service"
+        assert client.get(f"/api/stream/{text.headers['X-Stream-Id']}?chars=99").status_code == 400
+
+
+def test_stream_registry_frees_evicted_runs_when_they_end():
+    import asyncio
+    from app.services.streams import StreamRegistry, TokenBroadcast
+
+    async def _source(gate):
+        yield "aaaa"
+        await gate.wait()
+        yield "bbbb"
+
+    async def _run():
+        registry = StreamRegistry(max_streams=1)
+        gate = asyncio.Event()
+        running = TokenBroadcast(max_memory_bytes=2).start(_source(gate))
+        registry.register(running)
+        await asyncio.sleep(0)
+        registry.register(TokenBroadcast())
+        # Evicted while running: no longer resumable, but it keeps going and its buffer is kept
+        assert registry.get(running.id) is None and not running.done
+        reader = running.subscribe()
+        assert await reader.__anext__() == "aaaa"
+        gate.set()
+        assert [item async for item in reader] == ["bbbb"]
+        await asyncio.sleep(0)
+        return running.buffer._spill
+
+    # Once it ended and its last reader left, the spill file was closed
+    assert asyncio.run(_run()) is None
+
+
+def test_metrics_endpoint_reports_stream_timings_and_requests(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    monkeypatch.setenv("GENERATE_CACHE_ENABLED", "false")
+    app_mod = load_main_module()
+    _counting_openai(monkeypatch, ["# Terms", " of", " Service"], [])
+    from app.metrics import HTTP_REQUESTS, STREAM_TOKENS, STREAM_TTFT
+
+    ttft_before = STREAM_TTFT.count(stage="generate")
+    tokens_before = STREAM_TOKENS.value(stage="generate")
+    client = TestClient(app_mod.app)
+    client.post("/api/session/start", json={})
+    assert client.post("/api/generate", json={"prompt": "Draft ToS"}).status_code == 200
+
+    assert STREAM_TTFT.count(stage="generate") == ttft_before + 1
+    assert STREAM_TOKENS.value(stage="generate") == tokens_before + 3
+    assert HTTP_REQUESTS.value(method="POST", route="/api/generate", status="200") >= 1
+
+    body = client.get("/api/metrics").text
+    assert 'llm_stream_ttft_seconds_bucket{stage="generate",le="+Inf"}' in body
+    assert 'session_store_size{kind="sessions"} 1' in body
+    assert "admission_queue_depth 0" in body
+    assert 'route="/api/generate"' in body
+
+
+def test_load_benchmark_flags_regressions_and_stub_injects_rate_limits():
+    from starlette.testclient import TestClient as StubClient
+
+    from benchmarks.load import compare
+    from benchmarks.stub_openai import StubState, create_stub_app
+
+    baseline = {"generate": {"throughput_rps": 10.0, "ttfb_p95_ms": 200.0, "error_rate": 0.0}}
+    steady = {"generate": {"throughput_rps": 9.5, "ttfb_p95_ms": 210.0, "error_rate": 0.01}}
+    assert compare(steady, baseline, tolerance=0.15) == []
+    slower = {"generate": {"throughput_rps": 7.0, "ttfb_p95_ms": 300.0, "error_rate": 0.05}, "chat": {"throughput_rps": 1.0}}
+    assert compare(slower, baseline, tolerance=0.15) == [
+        "generate.throughput_rps: 10 -> 7",
+        "generate.ttfb_p95_ms: 200 -> 300",
+        "generate.error_rate: 0 -> 0.05",
+    ]
+
+    state = StubState(rate_limit_rate=1.0, retry_after_ms=120)
+    resp = StubClient(create_stub_app(state)).post("/v1/chat/completions", json={"stream": True, "messages": []})
+    assert resp.status_code == 429
+    assert resp.headers["retry-after-ms"] == "120"
+    assert state.rate_limited == 1
+
+
+def test_cold_import_defers_llm_stacks_and_preload_builds_them(monkeypatch):
+    import asyncio
+    import subprocess
+
+    from benchmarks.importtime import parse_importtime
+
+    probe = "import sys, lambda_function; print(sorted(m for m in ('openai', 'langchain_core', 'langchain_openai') if m in sys.modules))"
+    env = {**os.environ, "DOTENV_DISABLED": "1", "LAMBDA_SNAPSHOT": "false"}
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", probe], cwd=BASE_DIR, env=env, capture_output=True, text=True)
+    assert proc.returncode == 0, proc.stderr
+    assert proc.stdout.strip() == "[]"
+    rows = parse_importtime(proc.stderr)
+    assert any(name == "main" and depth == 1 for name, _, _, depth in rows)
+
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    monkeypatch.setenv("DOTENV_DISABLED", "1")
+    load_main_module()
+    from app import clients, warmup
+
+    loop = asyncio.new_event_loop()
+    try:
+        warmup.preload(loop)
+        manager = clients.get_clients()
+        assert manager._openai and manager._chat_models
+        assert manager._loop is loop
+    finally:
+        loop.run_until_complete(clients.close_clients())
+        loop.close()
+
+
+def test_lambda_runtime_streams_function_url_responses_and_buffers_the_rest(monkeypatch):
+    import asyncio
+    import threading
+
+    from benchmarks.lambda_emulator import RuntimeEmulator, function_url_event, rest_api_event
+
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    monkeypatch.setenv("GENERATE_CACHE_ENABLED", "false")
+    monkeypatch.setenv("STREAM_BATCH_BYTES", "0")
+    monkeypatch.setenv("STREAM_BATCH_MS", "0")
+    app_mod = load_main_module()
+    calls: list = []
+    _counting_openai(monkeypatch, ["# Terms"] + [f" part{i}" for i in range(10)], calls, delay=0.05)
+    from lambda_runtime import LambdaRuntime
+
+    with RuntimeEmulator() as emulator:
+        runtime = LambdaRuntime(app_mod.app, emulator.address, streaming=True)
+        loop = asyncio.new_event_loop()
+        worker = threading.Thread(target=loop.run_until_complete, args=(runtime.serve(max_invocations=3),), daemon=True)
+        worker.start()
+
+        streamed = emulator.invoke(function_url_event("POST", "/api/generate", {"prompt": "ToS"}))
+        assert streamed.mode == "streaming"
+        assert streamed.prelude["statusCode"] == 200
+        assert streamed.prelude["headers"]["x-cache"] == "BYPASS"
+        assert streamed.body.decode() == "# Terms" + "".join(f" part{i}" for i in range(10))
+        # Tokens arrive as they are generated, not all at once at the end
+        assert len(streamed.chunks) > 5
+        assert streamed.first_chunk_ms < streamed.chunks[-1][0] - 250
+
+        buffered = emulator.invoke(rest_api_event("GET", "/api/health"))
+        assert buffered.mode == "buffered"
+        assert buffered.prelude["statusCode"] == 200
+        assert b"ok" in buffered.body
+
+        # HTTP APIs send payload v2 too, but do not support response streaming
+        http_api = emulator.invoke(function_url_event("GET", "/api/health", domain="abc123.execute-api.local.amazonaws.com"))
+        assert http_api.mode == "buffered" and b"ok" in http_api.body
+
+        worker.join(timeout=5)
+    loop.close()
+
+
+def test_shared_sql_store_serializes_document_writes_across_workers(monkeypatch, tmp_path):
+    import threading
+
+    from app.services.store import MemorySessionStore, SqlSessionStore
+
+    url = f"sqlite:///{tmp_path / 'sessions.db'}"
+    # Two stores on one file stand in for two worker processes
+    workers = [SqlSessionStore(url), SqlSessionStore(url)]
+    workers[0].create("s1", {"system_prompt": "x"})
+    wins = []
+    barrier = threading.Barrier(8)
+
+    def _write(i):
+        barrier.wait()
+        if workers[i % 2].update_meta_if("s1", {"document_version": None}, document_version=1, document_html=f"<p>{i}</p>"):
+            wins.append(i)
+
+    threads = [threading.Thread(target=_write, args=(i,)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(wins) == 1
+    meta = workers[1].get_meta("s1")
+    assert meta["document_version"] == 1 and meta["document_html"] == f"<p>{wins[0]}</p>"
+    assert workers[0].update_meta_if("s1", {"document_version": 1}, document_version=2, history_summary="s")
+    assert not workers[1].update_meta_if("s1", {"document_version": 1}, document_version=2)
+    for store in workers:
+        store.close()
+
+    memory = MemorySessionStore()
+    memory.create("m1", {})
+    assert memory.update_meta_if("m1", {"document_title": None}, document_title="A")
+    assert not memory.update_meta_if("m1", {"document_title": None}, document_title="B")
+    assert memory.get_meta("m1")["document_title"] == "A"
+
+    monkeypatch.setenv("WEB_CONCURRENCY", "4")
+    monkeypatch.setenv("SESSION_STORE", "memory")
+    with pytest.raises(RuntimeError, match="SESSION_STORE"):
+        load_main_module()
+
+
+def test_chat_prompt_keeps_a_stable_prefix_and_reports_cache_hits(monkeypatch):
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+    app_mod = load_main_module()
+    import app.clients as clients
+
+    seen: list = []
+    usage = {"input_tokens": 1000, "output_tokens": 2, "total_tokens": 1002, "input_token_details": {"cache_read": 768}}
+    monkeypatch.setattr(clients.ClientManager, "chat_model", lambda self, **kw: _recording_chat_model("ok", seen, usage=usage))
+    client = TestClient(app_mod.app)
+    sid = client.post("/api/session/start", json={}).json()["session_id"]
+    filler = " These terms apply to every user of the service." * 6
+    doc = f"# Terms\n\n## 1. Scope\n\nScope text.{filler}\n\n## 2. Fees\n\nFees text.\n\n## 3. Law\n\nLaw text.{filler}\n"
+    client.post(f"/api/session/{sid}/document", json={"html": doc})
+    client.post("/api/chat", json={"session_id": sid, "message": {"role": "user", "content": "First"}})
+    client.post(f"/api/session/{sid}/document", json={"html": doc.replace("Fees text.", "Fees are waived.")})
+    client.post("/api/chat", json={"session_id": sid, "message": {"role": "user", "content": "Second"}})
+
+    first, second = seen
+    # Instructions, then the document snapshot, unchanged across turns; the edit travels after the history
+    assert [m.type for m in first] == ["system", "system", "human"]
+    assert first[0].content == second[0].content and first[1].content == second[1].content
+    assert "Fees text." in second[1].content
+    assert [m.type for m in second[2:]] == ["human", "ai", "human"]
+    assert "## 2. Fees\n\nFees are waived." in second[-1].content and "Scope text." not in second[-1].content
+    assert second[-1].content.endswith("Second")
+
+    stats = client.get(f"/api/session/{sid}/tokens").json()["prompt_cache"]
+    assert stats["prompt_tokens"] == 2000 and stats["cached_tokens"] == 1536 and stats["hit_ratio"] == 0.768
+    body = client.get("/api/metrics").text
+    assert 'llm_prompt_prefixes_total{outcome="reused"}' in body
+    assert 'llm_prompt_cache_hit_ratio{stage="chat_full"} 0.768' in body
+
+    from app.config import get_settings
+    from app.services.prompts import build_chat_prompt
+    from app.services.store import get_store
+
+    # A document with no stored version is remembered by digest, never copied into meta
+    loose = doc.replace("Law text.", "Other law.")
+    kwargs = {"session_id": sid, "system_text": "sys", "base_doc": loose, "settings": get_settings()}
+    first_loose = build_chat_prompt(input_text="Third", **kwargs)
+    meta = get_store().get_meta(sid)
+    assert meta["prompt_snapshot_version"] is None and len(meta["prompt_snapshot_digest"]) == 16
+    assert all(loose != value for value in meta.values())
+    assert build_chat_prompt(input_text="Fourth", **kwargs).prefix_hash == first_loose.prefix_hash
+    assert not [key for key in client.get(f"/api/session/{sid}/history").json()["meta"] if key.startswith("prompt_snapshot")]
+
+
+def _batch_openai(monkeypatch, calls, failing, active, delay=0.01):
+    import asyncio
+    import re
+
+    async def _stream(prompt):
+        active.append(len([c for c in calls if c is not None]))
+        try:
+            name = re.search(r"Tenant\d+|Alpha|Flaky", prompt).group(0)
+            for part in ["# Terms", " for ", name]:
+                await asyncio.sleep(delay)
+                yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=types.SimpleNamespace(content=part))])
+        finally:
+            calls[calls.index(prompt)] = None
+
+    async def _create(**kwargs):
+        prompt = kwargs["messages"][-1]["content"]
+        if any(word in prompt for word in failing):
+            raise ValueError("model refused")
+        calls.append(prompt)
+        return _stream(prompt)
+
+    _patch_openai(monkeypatch, _create)
+
+
+def test_session_usage_totals_survive_concurrent_turns(monkeypatch, tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+
+    monkeypatch.setenv("SESSION_STORE", "sqlite")
+    monkeypatch.setenv("SESSION_DB_URL", f"sqlite:///{tmp_path / 'sessions.db'}")
+    load_main_module()
+    from app.services.prompts import record_session_usage
+    from app.services.session import start_session
+    from app.services.store import get_store
+
+    sid = start_session()
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        list(pool.map(lambda _: record_session_usage(sid, 100, 40, attempts=50), range(8)))
+    meta = get_store().get_meta(sid)
+    assert (meta["prompt_tokens_total"], meta["prompt_cached_tokens_total"]) == (800, 320)
+
+
+def test_generate_batch_streams_results_in_completion_order_with_bounded_concurrency(monkeypatch, tmp_path):
+    import json as _json
+
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    monkeypatch.setenv("GENERATE_CACHE_DIR", str(tmp_path))
+    monkeypatch.setenv("BATCH_CONCURRENCY", "2")
+    app_mod = load_main_module()
+    calls: list = []
+    active: list = []
+    _batch_openai(monkeypatch, calls, ["Broken"], active)
+    client = TestClient(app_mod.app)
+
+    items = [{"id": f"t{i}", "prompt": f"Tenant{i}"} for i in range(5)] + [{"prompt": "Broken"}, {"id": "done", "prompt": "Old"}]
+    resp = client.post("/api/generate/batch", json={"items": items, "concurrency": 8, "skip_ids": ["done"]})
+    assert resp.status_code == 200 and resp.headers["X-Batch-Concurrency"] == "2"
+    events = [_json.loads(line) for line in resp.text.splitlines()]
+    results = {e["id"]: e for e in events if e["type"] == "result"}
+    assert results["t3"]["status"] == "ok" and results["t3"]["markdown"] == "# Terms for Tenant3"
+    assert results["5"]["status"] == "error" and results["5"]["retryable"] is False
+    assert any(e["type"] == "progress" and e["id"] == "t0" for e in events)
+    summary = events[-1]
+    assert summary["type"] == "summary" and sorted(summary["ok"]) == [f"t{i}" for i in range(5)]
+    assert summary["failed"] == ["5"] and summary["skipped"] == ["done"]
+    # Never more than two upstream streams at once
+    assert max(active) == 2
+
+    dup = client.post("/api/generate/batch", json={"items": [{"id": "x", "prompt": "a"}, {"id": "x", "prompt": "b"}]})
+    assert dup.status_code == 422
+
+
+def test_generate_batch_job_writes_results_to_disk_and_resumes_failed_items(monkeypatch, tmp_path):
+    import json as _json
+    import time
+
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    monkeypatch.setenv("GENERATE_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setenv("BATCH_JOBS_DIR", str(tmp_path / "jobs"))
+    app_mod = load_main_module()
+    calls: list = []
+    failing = ["Flaky"]
+    _batch_openai(monkeypatch, calls, failing, [])
+
+    def _wait(client, job_id):
+        for _ in range(200):
+            status = client.get(f"/api/generate/batch/{job_id}").json()
+            if status["state"] != "running":
+                return status
+            time.sleep(0.02)
+        raise AssertionError("job did not finish")
+
+    with TestClient(app_mod.app) as client:
+        started = client.post("/api/generate/batch", json={"job": True, "items": [{"id": "a", "prompt": "Alpha"}, {"id": "b", "prompt": "Flaky"}]})
+        assert started.status_code == 202
+        job_id = started.json()["job_id"]
+        status = _wait(client, job_id)
+        assert (status["state"], status["ok"], status["failed"]) == ("done", 1, 1)
+        assert status["items"] == {"a": "ok", "b": "error"}
+
+        failing.clear()
+        resumed = client.post(f"/api/generate/batch/{job_id}/resume").json()
+        assert resumed["resumed"] == ["b"]
+        status = _wait(client, job_id)
+        assert status["items"] == {"a": "ok", "b": "ok"}
+
+        lines = [_json.loads(line) for line in client.get(f"/api/generate/batch/{job_id}/results").text.splitlines()]
+        assert [(e["id"], e["status"]) for e in lines] == [("a", "ok"), ("b", "error"), ("b", "ok")] or \
+            [(e["id"], e["status"]) for e in lines] == [("b", "error"), ("a", "ok"), ("b", "ok")]
+        assert client.get("/api/generate/batch/" + "0" * 32).status_code == 404
+        assert client.get("/api/generate/batch/../../etc").status_code == 404
+
+    import os
+    from app.services.batch import get_batch_jobs
+
+    jobs = get_batch_jobs()
+    assert jobs.retention_seconds == 7 * 24 * 3600
+    assert jobs.prune() == []
+    old = time.time() - jobs.retention_seconds - 60
+    for child in [tmp_path / "jobs" / job_id, *(tmp_path / "jobs" / job_id).iterdir()]:
+        os.utime(child, (old, old))
+    # Finished jobs past retention are deleted, and the same registry keeps serving
+    assert jobs.prune() == [job_id] and get_batch_jobs() is jobs
+    with TestClient(app_mod.app) as client:
+        assert client.get(f"/api/generate/batch/{job_id}").status_code == 404
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_document_versions_share_compressed_section_chunks(monkeypatch, tmp_path, backend):
+    monkeypatch.setenv("SESSION_STORE", backend)
+    monkeypatch.setenv("SESSION_DB_URL", f"sqlite:///{tmp_path / 'sessions.db'}")
+    monkeypatch.setenv("DOCUMENT_MAX_VERSIONS", "3")
+    app_mod = load_main_module()
+    client = TestClient(app_mod.app)
+    from app.services.documents import split_chunks
+    from app.services.store import get_store
+
+    body = "The Provider shall deliver the Services with reasonable skill and care. " * 20
+    doc = "# Terms\n\n" + "".join(f"## {i}. Clause {i}\n\n{body}\n\n" for i in range(1, 21)) + "Footer without a trailing newline"
+    assert "".join(split_chunks(doc)) == doc
+
+    sid = client.post("/api/session/start", json={}).json()["session_id"]
+    versions = [doc, doc.replace("## 3. Clause 3\n\nThe", "## 3. Clause 3\n\nEach"), None, None]
+    versions[2] = versions[1].replace("## 7. Clause 7\n\nThe", "## 7. Clause 7\n\nEvery")
+    versions[3] = versions[2] + "\n\n## 21. Notices\n\nBy email."
+    for i, text in enumerate(versions[:3]):
+        assert client.post(f"/api/session/{sid}/document", json={"html": text}).json()["version"] == i + 1
+
+    store = get_store()
+    # Only metadata and chunk digests stay with the session; three versions share one set of chunks
+    assert store.get_meta(sid).get("document_html") is None
+    stored = store.document_versions(sid)
+    digests = {d for v in stored for d in v.manifest}
+    assert len(digests) == len(stored[0].manifest) + 2
+    assert sum(len(b) for b in store.get_chunks(list(digests)).values()) < len(doc) / 10
+
+    listed = client.get(f"/api/session/{sid}/document/versions").json()["versions"]
+    assert [v["version"] for v in listed] == [1, 2, 3] and listed[0]["size"] == len(doc)
+    assert client.get(f"/api/session/{sid}/document", params={"version": 1}).json()["html"] == doc
+    current = client.get(f"/api/session/{sid}/document").json()
+    assert current["version"] == 3 and current["html"] == versions[2]
+    assert client.get(f"/api/session/{sid}/history").json()["meta"]["document_html"] == versions[2]
+
+    # The oldest version is pruned, and so is the chunk only it used
+    client.post(f"/api/session/{sid}/document", json={"html": versions[3]})
+    assert client.get(f"/api/session/{sid}/document", params={"version": 1}).status_code == 404
+    only_v1 = set(stored[0].manifest) - set(stored[1].manifest)
+    assert len(only_v1) == 1 and store.get_chunks(list(only_v1)) == {}
+
+
+def _long_contract(sections: int = 30) -> str:
+    clause = "The Customer shall comply with the acceptable use rules and all applicable laws at all times. " * 8
+    titles = {1: "Definitions", 12: "Fees and Payment", 17: "Limitation of Liability"}
+    toc = "\n".join(f"- {i}. {titles.get(i, f'Clause {i}')}" for i in range(1, sections + 1))
+    body = "".join(
+        f"## {i}. {titles.get(i, f'Clause {i}')}\n\n{clause}Marker{i}.\n\n### {i}.1 Details\n\n{clause}\n\n"
+        for i in range(1, sections + 1)
+    )
+    return f"# Terms of Service\n\nVersion 1.0\n\n## Table of Contents\n\n{toc}\n\n{body}"
+
+
+def test_select_context_picks_named_and_relevant_sections_with_full_fallbacks():
+    from app.services.context import select_context
+    from app.services.documents import section_index
+
+    doc = _long_contract()
+    index = section_index(doc)
+    assert sum(e["chars"] for e in index) == len(doc)
+    assert [e["span"] for e in index if e["number"] == "12"] == [2]
+
+    named = select_context(doc, "Change clause 12 to net 60 days", index=index, budget_chars=6000, min_chars=1000)
+    assert not named.full and named.reason == "named"
+    assert "## 12. Fees and Payment" in named.text and "### 12.1 Details" in named.text
+    assert "## Table of Contents" in named.text and "## 1. Definitions" in named.text and "Marker20." not in named.text
+    assert "[Omitted sections, unchanged: 2. Clause 2;" in named.text
+    assert len(named.text) < len(doc) / 4
+
+    by_heading = select_context(doc, "Cap the limitation of liability at fees paid", index=None, budget_chars=6000, min_chars=1000)
+    assert "## 17. Limitation of Liability" in by_heading.text and not by_heading.full
+
+    assert select_context(doc, "Rewrite the whole contract in plain English", budget_chars=6000, min_chars=1000).reason == "whole_document"
+    assert select_context(doc, "Make it friendlier", budget_chars=6000, min_chars=1000).reason == "no_match"
+    assert select_context(doc, "Change clause 12", budget_chars=6000, min_chars=len(doc) + 1).reason == "small"
+    # A stale index is rebuilt from the text
+    assert select_context(doc + "\n## 31. Notices\n\nBy email.\n", "Update clause 31", index=index, budget_chars=6000, min_chars=1000).sections[-1] == "31. Notices"
+
+
+def test_patch_chat_sends_only_selected_sections_of_a_large_document(monkeypatch):
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+    app_mod = load_main_module()
+    import app.clients as clients
+
+    seen: list = []
+    reply = '<<<PATCH op="replace" target="12">>>\n## 12. Fees and Payment\n\nNet 60.\n<<<END>>>'
+    monkeypatch.setattr(clients.ClientManager, "chat_model", lambda self, **kw: _recording_chat_model(reply, seen))
+    client = TestClient(app_mod.app)
+    sid = client.post("/api/session/start", json={}).json()["session_id"]
+    doc = _long_contract()
+    client.post(f"/api/session/{sid}/document", json={"html": doc, "title": "ToS"})
+    resp = client.post("/api/chat", json={"session_id": sid, "mode": "patch", "message": {"role": "user", "content": "Make section 12 net 60"}})
+    assert resp.status_code == 200
+
+    messages = seen[0]
+    # No document in the cached prefix; the excerpt travels with the request
+    assert [m.type for m in messages] == ["system", "human"]
+    prompt = messages[-1].content
+    assert prompt.startswith("<DOCUMENT_EXCERPT>") and prompt.endswith("Make section 12 net 60")
+    assert "Marker12." in prompt and "Marker20." not in prompt
+    assert len(prompt) < len(doc) / 4
+
+    current = client.get(f"/api/session/{sid}/document").json()
+    assert current["version"] == 2 and "Net 60." in current["html"] and "Marker12." not in current["html"]
+    assert 'chat_context_selections_total{outcome="named"} 1' in client.get("/api/metrics").text
+
+
+def test_calls_are_routed_to_a_model_tier_with_bounded_max_tokens(monkeypatch, tmp_path):
+    import asyncio
+    import json as _json
+
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    monkeypatch.setenv("OPENAI_SMALL_MODEL", "gpt-4o-mini")
+    monkeypatch.setenv("MODEL_ROUTES", "outline=bogus")
+    monkeypatch.setenv("GENERATE_CACHE_DIR", str(tmp_path))
+    app_mod = load_main_module()
+    import app.clients as clients
+    from app.config import get_settings, parse_routes
+
+    assert parse_routes("title=large, chat_full=weird,=small") == {"title": "large"}
+    settings = get_settings()
+    assert settings.model_routes["outline"] == "large" and settings.model_routes["title"] == "small"
+
+    calls: list = []
+    _counting_openai(monkeypatch, ["# Terms"], calls)
+    client = TestClient(app_mod.app)
+    assert client.post("/api/generate", json={"prompt": "Draft ToS"}).status_code == 200
+    assert calls[-1]["model"] == "gpt-4o" and calls[-1]["max_tokens"] == settings.openai_max_tokens
+
+    title_calls: list = []
+
+    async def _title(**kwargs):
+        title_calls.append(kwargs)
+        return _completion("Terms of Service", usage=None)
+
+    _patch_openai(monkeypatch, _title)
+    clients.get_clients()._openai.clear()
+    from app.services.title import generate_session_title
+
+    assert asyncio.run(generate_session_title(user_input="Draft a ToS")) == "Terms of Service"
+    assert title_calls[0]["model"] == "gpt-4o-mini" and title_calls[0]["max_tokens"] <= 32
+
+    seen: list = []
+    finish: list = []
+    models: list = []
+
+    def _chat_model(self, **kw):
+        models.append(kw["model"])
+        reply = '<<<PATCH op="replace" target="1">>>\n## 1. Fees\n\nNet 60.\n<<<END>>>'
+        return _recording_chat_model(reply, seen, record="kwargs", finish=finish)
+
+    monkeypatch.setattr(clients.ClientManager, "chat_model", _chat_model)
+    sid = client.post("/api/session/start", json={"title": "ToS"}).json()["session_id"]
+    client.post(f"/api/session/{sid}/document", json={"html": "# ToS\n\n## 1. Fees\n\nNet 30.\n", "title": "ToS"})
+    turn = {"session_id": sid, "mode": "patch", "message": {"role": "user", "content": "Make fees net 60"}}
+    assert client.post("/api/chat", json=turn).status_code == 200
+    # A small patch turn goes to the small model, but a reply may still use the full ceiling
+    assert models == ["gpt-4o-mini"] and seen[0]["max_tokens"] == settings.openai_max_tokens
+    from app.routing import choose_route
+
+    # The route logged and counted carries the max_tokens that is actually sent
+    assert choose_route("chat_patch", input_tokens=100, output_tokens=512, ceiling=4000, record=False).max_tokens == 1024
+    assert choose_route("chat_patch", input_tokens=100, output_tokens=512, ceiling=4000, record=False, sized=False).max_tokens == 4000
+    from app.services.store import get_store
+
+    assert get_store().get_meta(sid)["chat_tier"] == "small"
+    # A session on the large tier stays there, so its cached prompt prefix keeps matching
+    get_store().update_meta(sid, chat_tier="large")
+    client.post("/api/chat", json=turn)
+    assert models[-1] == "gpt-4o"
+
+    # A reply cut off at max_tokens is an error, and nothing from it is applied
+    finish.append("length")
+    version = client.get(f"/api/session/{sid}/document").json()["version"]
+    events = [_json.loads(line) for line in client.post("/api/chat", json=turn).text.splitlines()]
+    assert events[-1]["type"] == "error" and "max_tokens" in events[-1]["error"]
+    assert client.get(f"/api/session/{sid}/document").json()["version"] == version
+
+    metrics = client.get("/api/metrics").text
+    assert 'llm_routes_total{stage="generate",tier="large"}' in metrics
+    assert 'llm_routes_total{stage="chat_patch",tier="small"}' in metrics
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_sessions_export_and_import_as_ndjson(monkeypatch, tmp_path, backend):
+    import json as _json
+    from langchain_core.messages import AIMessage, HumanMessage
+
+    monkeypatch.setenv("SESSION_STORE", backend)
+    monkeypatch.setenv("SESSION_DB_URL", f"sqlite:///{tmp_path / 'source.db'}")
+    monkeypatch.setenv("SESSION_EXPORT_PAGE_SIZE", "2")
+    monkeypatch.setenv("SESSION_IMPORT_BATCH_SIZE", "2")
+    monkeypatch.delenv("ADMIN_TOKEN", raising=False)
+    app_mod = load_main_module()
+    client = TestClient(app_mod.app)
+    # Bulk access fails closed: without a configured token neither endpoint exists
+    assert client.get("/api/session/export").status_code == 404
+    assert client.post("/api/session/import", params={"replace": "true"}, content=b"").status_code == 404
+
+    monkeypatch.setenv("ADMIN_TOKEN", "secret")
+    app_mod = load_main_module()
+    client = TestClient(app_mod.app)
+    admin = {"X-Admin-Token": "secret"}
+    from app.config import reload_settings
+    from app.services.store import get_store, init_store
+
+    sids = []
+    for i in range(5):
+        sid = client.post("/api/session/start", json={"metadata": {"n": i}}).json()["session_id"]
+        client.post(f"/api/session/{sid}/document", json={"html": f"# Doc {i}\n\n## 1. Shared\n\nSame text.\n"})
+        client.post(f"/api/session/{sid}/document", json={"html": f"# Doc {i}\n\n## 1. Shared\n\nEdited {i}.\n", "title": f"T{i}"})
+        get_store().append_messages(sid, [HumanMessage(content=f"q{i}"), AIMessage(content=f"a{i}")])
+        sids.append(sid)
+
+    assert client.get("/api/session/export").status_code == 403
+    assert client.post("/api/session/import", headers={"X-Admin-Token": "secre"}, content=b"").status_code == 403
+    resp = client.get("/api/session/export", headers=admin)
+    assert resp.headers["content-type"].startswith("application/x-ndjson")
+    lines = [_json.loads(line) for line in resp.text.splitlines()]
+    assert lines[0]["type"] == "header" and lines[-1] == {"type": "end", "sessions": 5}
+    assert [line["session_id"] for line in lines[1:-1]] == sids[::-1]
+
+    # [since, until): sessions 1..3 by their last update
+    stamps = [get_store().get_meta(sid)["updated_at"] for sid in sids]
+    ranged = client.get("/api/session/export", params={"since": stamps[1], "until": stamps[4]}, headers=admin)
+    assert [_json.loads(line).get("session_id") for line in ranged.text.splitlines()][1:-1] == sids[3:0:-1]
+    assert client.get("/api/session/export", params={"since": "yesterday"}, headers=admin).status_code == 400
+
+    monkeypatch.setenv("SESSION_DB_URL", f"sqlite:///{tmp_path / 'target.db'}")
+    init_store(reload_settings())
+    result = client.post("/api/session/import", content=resp.content, headers=admin).json()
+    assert result == {"imported": 5, "skipped": 0, "filtered": 0, "batches": 3, "complete": True}
+
+    history = client.get(f"/api/session/{sids[2]}/history").json()
+    assert [m["content"] for m in history["messages"]] == ["q2", "a2"]
+    assert history["meta"]["updated_at"] == stamps[2] and history["meta"]["metadata"] == {"n": 2}
+    assert client.get(f"/api/session/{sids[2]}/document", params={"version": 1}).json()["html"].endswith("Same text.\n")
+    assert client.get(f"/api/session/{sids[2]}/document").json()["html"].endswith("Edited 2.\n")
+    assert [v["title"] for v in client.get(f"/api/session/{sids[2]}/document/versions").json()["versions"]] == [None, "T2"]
+
+    # Existing sessions are skipped; a stream cut before its end line is reported incomplete
+    cut = b"\n".join(resp.content.splitlines()[:3])
+    again = client.post("/api/session/import", params={"since": stamps[4]}, content=cut, headers=admin).json()
+    assert again == {"imported": 0, "skipped": 1, "filtered": 1, "batches": 1, "complete": False}
+
+    bad = resp.content.replace(b'"type":"session"', b'"type":"bogus"', 1)
+    failed = client.post("/api/session/import", content=bad, headers=admin)
+    assert failed.status_code == 400 and failed.json()["detail"]["error"].startswith("line 2:")
+
+    # A current-document manifest naming a chunk the archive lacks is refused too
+    line = _json.loads(resp.content.splitlines()[1])
+    line["meta"]["document_manifest"] = line["meta"]["document_manifest"] + ["0" * 64]
+    line["session_id"] = "orphan"
+    broken = client.post("/api/session/import", content=_json.dumps(line).encode(), headers=admin)
+    assert broken.status_code == 400 and "missing chunk" in broken.json()["detail"]["error"]
@@ -70,18 +70,6 @@ function App() {
     return ''
   }, [messages])
 
-  const unescapeJsonString = useCallback((s: string): string => {
-    try {
-      const quoted = '"' + s.replace(/\\/g, '\\\\').replace(/\"/g, '\\"') + '"'
-      return JSON.parse(quoted)
-    } catch {
-      return s
-        .replace(/\\\"/g, '"')
-        .replace(/\\\\/g, '\\')
-        .replace(/\\n/g, '\n')
-    }
-  }, [])
-
   const onAbort = useCallback(() => {
     abortRef.current?.abort()
   }, [])
@@ -149,7 +137,7 @@ function App() {
 
       const resp = await fetch(api('/api/chat'), {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: { 'Content-Type': 'application/json', Accept: 'application/x-ndjson' },
         body: JSON.stringify({ session_id: sid, message: { role: 'user', content: text } }),
         signal: controller.signal,
       })
@@ -161,27 +149,25 @@ function App() {
       const reader = resp.body.getReader()
       const decoder = new TextDecoder('utf-8')
       let buf = ''
-      let started = false
+      let content = ''
       while (true) {
         const { done, value } = await reader.read()
         if (done) break
-        const chunk = decoder.decode(value, { stream: true })
-        buf += chunk
-        if (!started) {
-          const idx = buf.indexOf('\"data\":\"')
-          if (idx >= 0) {
-            buf = buf.slice(idx + 8)
-            started = true
-          } else {
-            continue
-          }
+        buf += decoder.decode(value, { stream: true })
+        // One JSON event per line; keep a trailing partial line for the next read
+        const lines = buf.split('\n')
+        buf = lines.pop() || ''
+        for (const line of lines) {
+          if (!line.trim()) continue
+          const event = JSON.parse(line)
+          if (event.type === 'delta') content += event.data
+          else if (event.type === 'error') throw new Error(event.error || 'Stream failed')
         }
-        const display = buf.replace(/\"\}\s*$/, '')
-        const unescaped = unescapeJsonString(display)
+        const latest = content
         setMessages((prev) => {
           const next = [...prev]
           for (let i = next.length - 1; i >= 0; i--) {
-            if (next[i].role === 'assistant') { next[i] = { ...next[i], content: unescaped }; break }
+            if (next[i].role === 'assistant') { next[i] = { ...next[i], content: latest }; break }
           }
           return next
         })
@@ -196,7 +182,7 @@ function App() {
       setIsSending(false)
       abortRef.current = null
     }
-  }, [input, ensureSession, unescapeJsonString, lastAssistantHtml])
+  }, [input, ensureSession, lastAssistantHtml])
 
   const copyHtml = useCallback(async (md: string) => {
     try { await navigator.clipboard.writeText(md) } catch {}